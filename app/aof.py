@@ -0,0 +1,302 @@
+import os
+import threading
+import time
+
+from app.rdb_parser import fsync_directory, iter_rdb, save_rdb, value_type
+from app.resp import ProtocolError, RESPParser
+
+APPENDFSYNC_POLICIES = ("always", "everysec", "no")
+
+# Bytes read from the file per step while replaying it
+AOF_READ_CHUNK = 1024 * 1024
+
+# Elements per command when a rewrite spells out a collection
+AOF_REWRITE_ITEMS_PER_CMD = 64
+
+class AOFError(Exception):
+    pass
+
+def encode_command(args):
+    """
+    Encodes a command as a RESP array of bulk strings, the form it is
+    logged (and replicated) in.
+    """
+    out = bytearray(b"*%d\r\n" % len(args))
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        out += b"$%d\r\n" % len(arg)
+        out += arg
+        out += b"\r\n"
+    return out
+
+class AppendOnlyFile:
+    """
+    The append-only log of write commands.
+
+    append() only encodes a command into an in-memory buffer. flush() hands
+    everything buffered to the kernel with one write and, under
+    appendfsync always, one fsync, so the commands of every client served
+    since the last flush share a single disk sync (group commit). A thread
+    whose commands were already synced by another thread's flush returns
+    without touching the disk. Under everysec a background thread fsyncs
+    once a second; under no the kernel decides.
+
+    appended, written and synced are byte offsets into the stream of
+    everything ever appended, so flush() can tell what is already durable.
+    """
+    def __init__(self, filename, fsync_policy="everysec"):
+        self.filename = filename
+        self.fsync_policy = fsync_policy
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.lock = threading.Lock()       # Guards buf and rewrite_buf
+        self.write_lock = threading.Lock() # One thread writes the file at a time
+        self.sync_lock = threading.Lock()  # Held while fd is being fsynced
+        self.buf = bytearray()
+        self.appended = 0
+        self.written = 0
+        self.synced = 0
+        self.size = os.fstat(self.fd).st_size
+        self.base_size = self.size # Size right after the last rewrite
+        self.last_write_error = None
+        # Commands logged while a rewrite runs, added to the new file at the end
+        self.rewrite_buf = None
+        if fsync_policy == "everysec":
+            threading.Thread(target=self.fsync_every_second, daemon=True).start()
+
+    def append(self, args):
+        self.feed(encode_command(args))
+
+    def feed(self, data):
+        # append() for a command that is RESP-encoded already
+        with self.lock:
+            self.buf += data
+            self.appended += len(data)
+            if self.rewrite_buf is not None:
+                self.rewrite_buf += data
+
+    def flush(self):
+        """
+        Writes the buffered commands to the file, and under appendfsync
+        always makes sure they are on disk before returning.
+        """
+        always = self.fsync_policy == "always"
+        target = self.appended
+        if (self.synced if always else self.written) >= target:
+            return
+        with self.write_lock:
+            if (self.synced if always else self.written) >= target:
+                return # Another thread's flush covered these commands
+            with self.lock:
+                data = self.buf
+                self.buf = bytearray()
+                end = self.appended
+            try:
+                write_all(self.fd, data)
+                if always:
+                    os.fsync(self.fd)
+            except OSError as e:
+                with self.lock:
+                    # Keep the commands for the next attempt
+                    self.buf[:0] = data
+                self.last_write_error = str(e)
+                print(f"Error writing to the AOF file: {e}")
+                if always:
+                    # Replies promise durability we can no longer give
+                    print("Can't recover from AOF write error when the AOF fsync policy is 'always'. Exiting...")
+                    os._exit(1)
+                return
+            self.last_write_error = None
+            self.size += len(data)
+            self.written = end
+            if always:
+                self.synced = end
+
+    def fsync_every_second(self):
+        while True:
+            time.sleep(1)
+            with self.sync_lock:
+                target = self.written
+                if self.synced >= target:
+                    continue
+                try:
+                    os.fsync(self.fd)
+                except OSError as e:
+                    print(f"Error syncing the AOF file: {e}")
+                    continue
+                self.synced = target
+
+    def buffer_length(self):
+        return len(self.buf)
+
+    def start_rewrite(self):
+        with self.lock:
+            self.rewrite_buf = bytearray()
+
+    def abort_rewrite(self):
+        with self.lock:
+            self.rewrite_buf = None
+
+    def finish_rewrite(self, temp_filename):
+        """
+        Appends the commands logged during the rewrite to `temp_filename`,
+        the compacted file a rewrite produced, and swaps it in for the log.
+        Writers wait while this runs.
+        """
+        with self.write_lock, self.lock:
+            with open(temp_filename, "ab") as f:
+                f.write(self.rewrite_buf)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_filename, self.filename)
+            fsync_directory(os.path.dirname(self.filename) or ".")
+            fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            with self.sync_lock:
+                os.close(self.fd)
+                self.fd = fd
+            # Everything buffered is already in the rewrite buffer
+            self.buf = bytearray()
+            self.written = self.synced = self.appended
+            self.size = self.base_size = os.fstat(fd).st_size
+            self.rewrite_buf = None
+
+def write_all(fd, data):
+    with memoryview(data) as view:
+        while view:
+            n = os.write(fd, view)
+            view = view[n:]
+
+def rewrite_aof(filename, items, preamble=True, compression=False):
+    """
+    Writes the shortest log that rebuilds `items`, an iterable of (key,
+    value, expire_at_ms or None), to `filename`. With `preamble` that is an
+    RDB dump, which later commands are appended after; otherwise one
+    command per key. Returns (keys_written, bytes_written, seconds).
+    """
+    if preamble:
+        return save_rdb(filename, items, compression)
+
+    start = time.perf_counter()
+    directory = os.path.dirname(filename) or "."
+    temp_filename = os.path.join(directory, f"temp-rewriteaof-{os.getpid()}-{threading.get_ident()}.aof")
+    keys = 0
+    written = 0
+    buf = bytearray()
+    try:
+        with open(temp_filename, "wb") as f:
+            for key, value, expire_at in items:
+                for args in rebuild_commands(key, value, expire_at):
+                    buf += encode_command(args)
+                keys += 1
+                if len(buf) >= AOF_READ_CHUNK:
+                    f.write(buf)
+                    written += len(buf)
+                    buf.clear()
+            f.write(buf)
+            written += len(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+        raise
+    return keys, written, time.perf_counter() - start
+
+def rebuild_commands(key, value, expire_at):
+    kind = value_type(value)
+    if kind == "string":
+        if expire_at is not None:
+            return [["SET", key, value, "PXAT", int(expire_at)]]
+        return [["SET", key, value]]
+    if kind == "zset":
+        name = "ZADD"
+        items = [arg for member, score in value.items() for arg in (repr(score), member)]
+        step = 2
+    elif kind == "hash":
+        name = "HSET"
+        items = [arg for pair in value.items() for arg in pair]
+        step = 2
+    else:
+        name = "RPUSH" if kind == "list" else "SADD"
+        items = list(value)
+        step = 1
+    # Big collections take several commands, so replaying one never
+    # needs a huge argument list
+    chunk = AOF_REWRITE_ITEMS_PER_CMD * step
+    commands = [[name, key] + items[i:i + chunk] for i in range(0, len(items), chunk)]
+    if expire_at is not None:
+        commands.append(["PEXPIREAT", key, int(expire_at)])
+    return commands
+
+def load_aof(filename, load_key, run_command, progress=None, verify_checksum=True):
+    """
+    Replays an append-only file: the keys of an RDB preamble are passed to
+    load_key(key, value, expire_at), then every logged command, as it is
+    read, to run_command(args). The commands of a MULTI ... EXEC block are
+    run once its EXEC has been read, without the MULTI and EXEC. A command
+    cut short by a crash at the end of the file, or a transaction without
+    its EXEC, is dropped and the file truncated before it. Returns the
+    number of commands replayed.
+    """
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        preamble = f.read(5) == b"REDIS"
+
+    offset = 0
+    if preamble:
+        records = iter_rdb(filename, progress, verify_checksum)
+        while True:
+            try:
+                record = next(records)
+            except StopIteration as stop:
+                offset = stop.value or size
+                break
+            load_key(*record)
+
+    parser = RESPParser(AOF_READ_CHUNK)
+    commands = 0
+    read = offset
+    valid_end = offset
+    transaction = None # Commands read since a MULTI
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        while True:
+            n = f.readinto(parser.get_buffer(AOF_READ_CHUNK))
+            if not n:
+                break
+            parser.advance(n)
+            read += n
+            while True:
+                try:
+                    args = parser.get_command()
+                except ProtocolError as e:
+                    raise AOFError(f"Bad file format reading the append only file at offset {valid_end}: {e}") from None
+                if args is None:
+                    break
+                name = args[0].upper()
+                if name == b"MULTI":
+                    transaction = []
+                    continue
+                if transaction is not None:
+                    if name != b"EXEC":
+                        transaction.append(args)
+                        continue
+                    for queued in transaction:
+                        run_command(queued)
+                    commands += len(transaction)
+                    transaction = None
+                else:
+                    run_command(args)
+                    commands += 1
+                valid_end = read - (parser.end - parser.pos)
+            if progress:
+                progress(read, size)
+
+    if valid_end < size:
+        print(f"!!! Warning: short read while loading the AOF file {filename}!!!")
+        print(f"AOF {filename} loaded anyway because truncated; {size - valid_end} bytes dropped at offset {valid_end}")
+        os.truncate(filename, valid_end)
+    return commands
@@ -0,0 +1,83 @@
+import hashlib
+from array import array
+
+# Keys hash to one of this many slots, as in Redis Cluster
+CLUSTER_SLOTS = 16384
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+CRC16_TABLE = _crc16_table()
+
+def crc16(data):
+    """
+    CRC16-CCITT (XModem), the checksum Redis Cluster hashes keys with.
+    """
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+def key_hash_slot(key):
+    """
+    The slot `key` belongs to. Only the part between the first "{" and the
+    next "}" is hashed when it is not empty (a hash tag), so related keys
+    such as {user:1}:name and {user:1}:mail can be kept together.
+    """
+    start = key.find(b"{")
+    if start != -1:
+        end = key.find(b"}", start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key) & (CLUSTER_SLOTS - 1)
+
+class Cluster:
+    """
+    The slot layout of --workers mode: `workers` processes, each owning
+    one contiguous range of slots and listening on a port of its own
+    (`port` + 1 + its index) besides the shared `port`. `index` is the
+    worker this process is.
+    """
+    def __init__(self, workers, index, host, port):
+        self.workers = workers
+        self.index = index
+        self.host = host
+        self.port = port
+        self.owners = array("H", (slot * workers // CLUSTER_SLOTS for slot in range(CLUSTER_SLOTS)))
+
+    def slot_range(self, worker):
+        """
+        The first and last slot `worker` owns.
+        """
+        first = self.owners.index(worker)
+        last = first
+        while last + 1 < CLUSTER_SLOTS and self.owners[last + 1] == worker:
+            last += 1
+        return first, last
+
+    def worker_port(self, worker):
+        return self.port + 1 + worker
+
+    def node_id(self, worker):
+        # Stable for as long as the layout is, 40 hex digits like a Redis node ID
+        return hashlib.sha1(b"%s:%d" % (self.host.encode(), self.worker_port(worker))).hexdigest()
+
+    def keys_slot(self, keys):
+        """
+        The slot all of `keys` hash to: None when there are no keys and -1
+        when they hash to different slots.
+        """
+        slot = None
+        for key in keys:
+            key_slot = key_hash_slot(key)
+            if slot is None:
+                slot = key_slot
+            elif key_slot != slot:
+                return -1
+        return slot
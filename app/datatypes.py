@@ -0,0 +1,457 @@
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import islice
+
+from app.rdb_parser import SortedSet
+
+# Sizes past which a collection leaves its compact encoding, by config
+# name. main() overrides them from the command line.
+ENCODING_LIMITS = {
+    "hash-max-listpack-entries": 128,
+    "hash-max-listpack-value": 64,
+    "list-max-listpack-size": 128,
+    "set-max-intset-entries": 512,
+    "set-max-listpack-entries": 128,
+    "set-max-listpack-value": 64,
+    "zset-max-listpack-entries": 128,
+    "zset-max-listpack-value": 64,
+}
+
+# Rough cost of one element (a small bytes object) for memory accounting
+ELEMENT_OVERHEAD = 48
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+# Strings up to this long are "embstr" to OBJECT ENCODING, as in Redis
+EMBSTR_SIZE_LIMIT = 44
+
+def as_int64(value):
+    """
+    Returns `value` (bytes) as an int if it is the canonical decimal form of
+    a 64-bit integer ("12", "-3", not "012", "+3" or " 3"), else None.
+    """
+    if not value or len(value) > 20:
+        return None
+    try:
+        n = int(value)
+    except ValueError:
+        return None
+    if not INT64_MIN <= n <= INT64_MAX or b"%d" % n != value:
+        return None
+    return n
+
+def string_encoding(value):
+    if as_int64(value) is not None:
+        return "int"
+    return "embstr" if len(value) <= EMBSTR_SIZE_LIMIT else "raw"
+
+def all_short(values, limit):
+    return all(len(value) <= limit for value in values)
+
+class Hash:
+    """
+    A hash. A small one is a flat list [field, value, field, value, ...]
+    (the listpack encoding): a fraction of the size of a dict, and at that
+    size a linear search costs about as much as hashing. Past
+    hash-max-listpack-entries fields, or with a field or value longer than
+    hash-max-listpack-value bytes, it becomes a dict for good.
+    """
+    __slots__ = ("data",)
+    type_name = "hash"
+
+    def __init__(self, pairs=()):
+        table = dict(pairs)
+        limit = ENCODING_LIMITS["hash-max-listpack-value"]
+        if (len(table) <= ENCODING_LIMITS["hash-max-listpack-entries"]
+                and all_short(table, limit) and all_short(table.values(), limit)):
+            self.data = [item for pair in table.items() for item in pair]
+        else:
+            self.data = table
+
+    @property
+    def encoding(self):
+        return "listpack" if type(self.data) is list else "hashtable"
+
+    def __len__(self):
+        data = self.data
+        return len(data) // 2 if type(data) is list else len(data)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.data) + 2 * len(self) * ELEMENT_OVERHEAD
+
+    def _find(self, field):
+        # Position of `field` in the listpack, or -1. list.index() does the
+        # scanning; a hit at an odd position is a value, not a field.
+        data = self.data
+        i = 0
+        try:
+            while True:
+                i = data.index(field, i)
+                if not i & 1:
+                    return i
+                i += 1
+        except ValueError:
+            return -1
+
+    def _convert(self):
+        data = self.data
+        self.data = dict(zip(data[::2], data[1::2]))
+
+    def get(self, field):
+        data = self.data
+        if type(data) is not list:
+            return data.get(field)
+        i = self._find(field)
+        return data[i + 1] if i >= 0 else None
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+    def set(self, field, value):
+        """
+        Sets `field` to `value`. Returns True if the field is new.
+        """
+        data = self.data
+        if type(data) is not list:
+            new = field not in data
+            data[field] = value
+            return new
+        i = self._find(field)
+        if i >= 0:
+            data[i + 1] = value
+        else:
+            data += (field, value)
+        limit = ENCODING_LIMITS["hash-max-listpack-value"]
+        if len(data) > 2 * ENCODING_LIMITS["hash-max-listpack-entries"] or len(field) > limit or len(value) > limit:
+            self._convert()
+        return i < 0
+
+    def delete(self, field):
+        data = self.data
+        if type(data) is not list:
+            return data.pop(field, None) is not None
+        i = self._find(field)
+        if i < 0:
+            return False
+        del data[i:i + 2]
+        return True
+
+    def items(self):
+        data = self.data
+        if type(data) is list:
+            return zip(data[::2], data[1::2])
+        return data.items()
+
+    def copy(self):
+        return Hash(self.items())
+
+class List:
+    """
+    A list. A small one is a plain list (listpack); past
+    list-max-listpack-size elements it becomes a deque (quicklist), so
+    pushes and pops stay O(1) at the head as well as the tail.
+    """
+    __slots__ = ("data",)
+    type_name = "list"
+
+    def __init__(self, items=()):
+        self.data = list(items)
+        if len(self.data) > ENCODING_LIMITS["list-max-listpack-size"]:
+            self.data = deque(self.data)
+
+    @property
+    def encoding(self):
+        return "listpack" if type(self.data) is list else "quicklist"
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.data) + len(self.data) * ELEMENT_OVERHEAD
+
+    def push(self, items, left=False):
+        """
+        Pushes `items` one after the other at the head (`left`) or the tail.
+        """
+        data = self.data
+        if type(data) is list:
+            if left:
+                data[:0] = items[::-1]
+            else:
+                data += items
+            if len(data) > ENCODING_LIMITS["list-max-listpack-size"]:
+                self.data = deque(data)
+        elif left:
+            data.extendleft(items)
+        else:
+            data.extend(items)
+
+    def pop(self, count, left=False):
+        """
+        Removes and returns up to `count` elements from the head or the
+        tail, in the order they were popped.
+        """
+        data = self.data
+        count = min(count, len(data))
+        if type(data) is list:
+            if left:
+                items = data[:count]
+                del data[:count]
+            else:
+                items = data[len(data) - count:][::-1]
+                del data[len(data) - count:]
+            return items
+        pop = data.popleft if left else data.pop
+        return [pop() for _ in range(count)]
+
+    def range(self, start, stop):
+        # Elements start..stop inclusive; both already within bounds
+        if type(self.data) is list:
+            return self.data[start:stop + 1]
+        return list(islice(self.data, start, stop + 1))
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __setitem__(self, index, value):
+        self.data[index] = value
+
+    def copy(self):
+        return List(self.data)
+
+class Set:
+    """
+    A set. One of integers only is a sorted array of int64s (intset) up to
+    set-max-intset-entries members; another small one is a list (listpack)
+    up to set-max-listpack-entries members of at most
+    set-max-listpack-value bytes; anything bigger is a Python set.
+    """
+    __slots__ = ("data",)
+    type_name = "set"
+
+    def __init__(self, members=()):
+        members = set(members)
+        numbers = None
+        if len(members) <= ENCODING_LIMITS["set-max-intset-entries"]:
+            numbers = [as_int64(member) for member in members]
+        if numbers is not None and None not in numbers:
+            self.data = array("q", sorted(numbers))
+        elif (len(members) <= ENCODING_LIMITS["set-max-listpack-entries"]
+                and all_short(members, ENCODING_LIMITS["set-max-listpack-value"])):
+            self.data = list(members)
+        else:
+            self.data = members
+
+    @property
+    def encoding(self):
+        data = self.data
+        if type(data) is array:
+            return "intset"
+        return "listpack" if type(data) is list else "hashtable"
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        if type(self.data) is array:
+            return (b"%d" % n for n in self.data)
+        return iter(self.data)
+
+    def __sizeof__(self):
+        data = self.data
+        if type(data) is array:
+            return object.__sizeof__(self) + sys.getsizeof(data)
+        return object.__sizeof__(self) + sys.getsizeof(data) + len(data) * ELEMENT_OVERHEAD
+
+    def __contains__(self, member):
+        data = self.data
+        if type(data) is array:
+            n = as_int64(member)
+            if n is None:
+                return False
+            i = bisect_left(data, n)
+            return i < len(data) and data[i] == n
+        return member in data
+
+    def add(self, member):
+        """
+        Adds `member`. Returns True if it was not there yet.
+        """
+        data = self.data
+        if type(data) is array:
+            n = as_int64(member)
+            if n is not None:
+                i = bisect_left(data, n)
+                if i < len(data) and data[i] == n:
+                    return False
+                data.insert(i, n)
+                if len(data) > ENCODING_LIMITS["set-max-intset-entries"]:
+                    self.data = set(self)
+                return True
+            # Not an integer: re-encode what is there and add it below
+            self.data = data = list(self)
+            if (len(data) >= ENCODING_LIMITS["set-max-listpack-entries"]
+                    or len(member) > ENCODING_LIMITS["set-max-listpack-value"]):
+                self.data = data = set(data)
+        if type(data) is list:
+            if member in data:
+                return False
+            data.append(member)
+            if (len(data) > ENCODING_LIMITS["set-max-listpack-entries"]
+                    or len(member) > ENCODING_LIMITS["set-max-listpack-value"]):
+                self.data = set(data)
+            return True
+        if member in data:
+            return False
+        data.add(member)
+        return True
+
+    def remove(self, member):
+        data = self.data
+        if type(data) is array:
+            n = as_int64(member)
+            if n is None:
+                return False
+            i = bisect_left(data, n)
+            if i == len(data) or data[i] != n:
+                return False
+            del data[i]
+            return True
+        if member not in data:
+            return False
+        data.remove(member)
+        return True
+
+    def copy(self):
+        return Set(self)
+
+class ZSet:
+    """
+    A sorted set, as two parallel sequences kept sorted by (score, member):
+    the scores in an array of doubles and the members in a list. A range
+    by score is a binary search over the array and a range by rank a
+    slice. A small one is only that (listpack). Past
+    zset-max-listpack-entries members, or with a member longer than
+    zset-max-listpack-value bytes, a dict from member to score is kept
+    alongside for O(1) score lookups (reported as the skiplist encoding;
+    the sorted arrays stand in for the skiplist, inserting with a memmove).
+    """
+    __slots__ = ("scores", "members", "lookup")
+    type_name = "zset"
+
+    def __init__(self, pairs=()):
+        lookup = dict(pairs)
+        entries = sorted((score, member) for member, score in lookup.items())
+        self.scores = array("d", [score for score, _ in entries])
+        self.members = [member for _, member in entries]
+        self.lookup = lookup
+        if (len(lookup) <= ENCODING_LIMITS["zset-max-listpack-entries"]
+                and all_short(lookup, ENCODING_LIMITS["zset-max-listpack-value"])):
+            self.lookup = None
+
+    @property
+    def encoding(self):
+        return "listpack" if self.lookup is None else "skiplist"
+
+    def __len__(self):
+        return len(self.members)
+
+    def __sizeof__(self):
+        size = (object.__sizeof__(self) + sys.getsizeof(self.scores) + sys.getsizeof(self.members)
+                + len(self.members) * ELEMENT_OVERHEAD)
+        if self.lookup is not None:
+            size += sys.getsizeof(self.lookup)
+        return size
+
+    def score(self, member):
+        if self.lookup is not None:
+            return self.lookup.get(member)
+        try:
+            return self.scores[self.members.index(member)]
+        except ValueError:
+            return None
+
+    def _position(self, score, member):
+        # Where (score, member) is, or would go: among the members with an
+        # equal score, which are in byte order
+        lo = bisect_left(self.scores, score)
+        hi = bisect_right(self.scores, score, lo)
+        return bisect_left(self.members, member, lo, hi)
+
+    def add(self, member, score):
+        """
+        Sets the score of `member`. Returns True if it is a new member.
+        """
+        old = self.score(member)
+        if old is not None:
+            if old == score:
+                return False
+            i = self._position(old, member)
+            del self.scores[i]
+            del self.members[i]
+        i = self._position(score, member)
+        self.scores.insert(i, score)
+        self.members.insert(i, member)
+        if self.lookup is not None:
+            self.lookup[member] = score
+        elif (len(self.members) > ENCODING_LIMITS["zset-max-listpack-entries"]
+                or len(member) > ENCODING_LIMITS["zset-max-listpack-value"]):
+            self.lookup = dict(zip(self.members, self.scores))
+        return old is None
+
+    def remove(self, member):
+        score = self.score(member)
+        if score is None:
+            return False
+        i = self._position(score, member)
+        del self.scores[i]
+        del self.members[i]
+        if self.lookup is not None:
+            del self.lookup[member]
+        return True
+
+    def rank(self, member):
+        score = self.score(member)
+        if score is None:
+            return None
+        return self._position(score, member)
+
+    def entries(self, start, stop):
+        # (score, member) pairs at positions start <= i < stop
+        return list(zip(self.scores[start:stop], self.members[start:stop]))
+
+    def score_bounds(self, low, high, low_exclusive=False, high_exclusive=False):
+        """
+        Returns the positions (start, stop) of the members with scores
+        between `low` and `high`, found by binary search.
+        """
+        start = (bisect_right if low_exclusive else bisect_left)(self.scores, low)
+        stop = (bisect_left if high_exclusive else bisect_right)(self.scores, high)
+        return start, max(start, stop)
+
+    def items(self):
+        return zip(self.members, self.scores)
+
+    def copy(self):
+        return ZSet(self.items())
+
+def from_loaded(value):
+    """
+    Turns a value as the RDB loader produces it (bytes, list, set, dict or
+    SortedSet) into the keyspace's own types.
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, SortedSet):
+        return ZSet(value.items())
+    if isinstance(value, dict):
+        return Hash(value.items())
+    if isinstance(value, list):
+        return List(value)
+    return Set(value)
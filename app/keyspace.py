@@ -0,0 +1,771 @@
+import heapq
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+MAXMEMORY_POLICIES = ("noeviction", "allkeys-lru", "allkeys-lfu", "volatile-ttl")
+
+LRU_CLOCK_MAX = (1 << 24) - 1
+LFU_INIT_VAL = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_TIME = 1 # Minutes per counter decrement
+
+# Rough per-key cost of the dict slot and Entry object that back a key
+ENTRY_OVERHEAD = 96
+
+# Added to hash(key) to order keys by their hash as an unsigned 64-bit value
+SCAN_HASH_OFFSET = 1 << 63
+
+class WrongTypeError(Exception):
+    """
+    Raised when a command finds a key holding the wrong kind of value.
+    """
+
+def lru_clock_now():
+    return int(time.time()) & LRU_CLOCK_MAX
+
+class Entry:
+    """
+    A key's value together with its expiry (absolute ms as an int, or
+    None) and its eviction metadata: the LRU clock of its last access, or for LFU
+    policies the last decrement time in minutes (high 16 bits) and a
+    logarithmic access counter (low 8 bits).
+    """
+    __slots__ = ("value", "expire_at", "meta")
+
+    def __init__(self, value, expire_at, meta):
+        self.value = value
+        self.expire_at = expire_at
+        self.meta = meta
+
+class Shard:
+    """
+    One slice of the keyspace and everything needed to maintain it without
+    touching other shards.
+    """
+    __slots__ = ("lock", "data", "volatile", "expiry_index", "samples", "scan_index", "scan_pending",
+                 "watched", "used_memory", "dirty", "unchanged", "expired_keys", "evicted_keys", "hits", "misses")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = {}
+        self.volatile = 0 # Keys with a TTL
+        # Min-heap of (expire_at_ms, key). Entries are not removed when a
+        # key is deleted or its TTL changes; anything that no longer matches
+        # the key's Entry is skipped.
+        self.expiry_index = []
+        # Keys to draw random eviction candidates from, only kept while
+        # maxmemory is set. Deleted keys stay until a sample lands on them.
+        self.samples = []
+        # Keys in hash order for SCAN, built the first time SCAN reaches
+        # the shard. Keys added since then wait in scan_pending until there
+        # are enough of them to merge; deleted keys are dropped on merge.
+        self.scan_index = None
+        self.scan_pending = []
+        # Keys some client WATCHes: key -> [version, watchers]. The version
+        # goes up whenever the key changes, which EXEC checks.
+        self.watched = {}
+        self.used_memory = 0
+        self.dirty = 0 # Changes made, for the automatic save rules
+        # Set through unchanged() while update() has a value out
+        self.unchanged = False
+        self.expired_keys = 0
+        self.evicted_keys = 0
+        self.hits = 0 # Lookups by get() and get_many() that found the key
+        self.misses = 0
+
+class Keyspace:
+    """
+    The database. Keys are spread over a power-of-two number of shards by
+    hash; each shard is a dict of Entry objects guarded by its own lock, so
+    threads working on different shards never wait on each other.
+
+    Single-key methods lock the key's shard themselves. Multi-key commands
+    wrap their work in lock_keys(), which takes every shard involved in
+    shard order so two commands can never deadlock. The locks are
+    re-entrant, so the single-key methods can still be used inside.
+    """
+    def __init__(self, num_shards=16):
+        if num_shards < 1 or num_shards & (num_shards - 1):
+            raise ValueError("number of shards must be a power of two")
+        self.shards = [Shard() for _ in range(num_shards)]
+        self.shard_mask = num_shards - 1
+        self.shard_bits = num_shards.bit_length() - 1
+        self.maxmemory = 0
+        self.policy = "noeviction"
+        self.maxmemory_samples = 5
+        self.lru_clock = lru_clock_now()
+        # The time in ms as of the last tick(). While the server keeps it
+        # ticking, lookups check expiry against it instead of reading the
+        # system clock for every volatile key; None reads the clock.
+        self.clock_ms = None
+        self.expire_cursor = 0
+        # Called with every key that changes (None: all of them, on a
+        # flush) while the server needs to hear about it, for client-side
+        # caching; None otherwise, which costs the writes one check
+        self.on_change = None
+        # Called with every key the keyspace removes by itself, because it
+        # expired or was evicted, so the server can pass a DEL on
+        self.on_drop = None
+        # What a lookup does with a key whose TTL has passed: "delete" it
+        # (a master), "hide" it but wait for the master's DEL (a replica),
+        # or "keep" it live (a replica applying its master's stream)
+        self.expiry = "delete"
+
+    def shard_for(self, key):
+        return self.shards[hash(key) & self.shard_mask]
+
+    @contextmanager
+    def lock_keys(self, keys):
+        indexes = sorted({hash(key) & self.shard_mask for key in keys})
+        for i in indexes:
+            self.shards[i].lock.acquire()
+        try:
+            yield
+        finally:
+            for i in reversed(indexes):
+                self.shards[i].lock.release()
+
+    @contextmanager
+    def lock_all(self):
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            yield
+        finally:
+            for shard in reversed(self.shards):
+                shard.lock.release()
+
+    def __len__(self):
+        return sum(len(shard.data) for shard in self.shards)
+
+    def expires_count(self):
+        return sum(shard.volatile for shard in self.shards)
+
+    def used_memory(self):
+        return sum(shard.used_memory for shard in self.shards)
+
+    def dirty(self, keys=None):
+        """
+        Changes made so far, to the shards holding `keys` or to every shard.
+        Compared before and after a command run under lock_keys(keys), it
+        tells whether the command changed anything.
+        """
+        if keys is None:
+            return sum(shard.dirty for shard in self.shards)
+        return sum(shard.dirty for shard in {self.shard_for(key) for key in keys})
+
+    def expired_keys(self):
+        return sum(shard.expired_keys for shard in self.shards)
+
+    def evicted_keys(self):
+        return sum(shard.evicted_keys for shard in self.shards)
+
+    def keyspace_hits(self):
+        return sum(shard.hits for shard in self.shards)
+
+    def keyspace_misses(self):
+        return sum(shard.misses for shard in self.shards)
+
+    def update_clock(self):
+        self.lru_clock = lru_clock_now()
+
+    def tick(self):
+        """
+        Refreshes the cached clocks. The server calls this once per event
+        loop iteration (or per read, in threaded mode), so a whole batch of
+        commands sees one time, as Redis commands do.
+        """
+        now = time.time_ns() // 1000000
+        self.clock_ms = now
+        self.lru_clock = (now // 1000) & LRU_CLOCK_MAX
+
+    def now_ms(self):
+        if self.clock_ms is not None:
+            return self.clock_ms
+        return time.time_ns() // 1000000
+
+    # Single-key operations
+
+    def get(self, key):
+        shard = self.shard_for(key)
+        with shard.lock:
+            entry = self._lookup(shard, key)
+            if entry is None:
+                shard.misses += 1
+                return None
+            shard.hits += 1
+            if self.maxmemory:
+                self._touch(entry)
+            return entry.value
+
+    def exists(self, key):
+        shard = self.shard_for(key)
+        with shard.lock:
+            return self._lookup(shard, key) is not None
+
+    def set(self, key, value, expire_at=None, keep_ttl=False):
+        """
+        Sets `key` to `value`. Any existing TTL is cleared unless `keep_ttl`
+        is given; `expire_at` (absolute ms) sets a new one.
+        """
+        shard = self.shard_for(key)
+        with shard.lock:
+            self._set(shard, key, value, expire_at, keep_ttl)
+
+    def delete(self, key):
+        shard = self.shard_for(key)
+        with shard.lock:
+            return self._delete(shard, key) is not None
+
+    def expire(self, key, expire_at):
+        """
+        Sets the TTL of an existing key (absolute ms). Returns whether the
+        key exists.
+        """
+        shard = self.shard_for(key)
+        with shard.lock:
+            entry = self._lookup(shard, key)
+            if entry is None:
+                return False
+            self._set_expiry(shard, key, entry, expire_at)
+            shard.dirty += 1
+            if shard.watched or self.on_change is not None:
+                self._changed(shard, key)
+            return True
+
+    def expire_time(self, key):
+        """
+        Returns the expiry of `key` in absolute ms, -1 if it has no TTL or
+        -2 if there is no such key.
+        """
+        shard = self.shard_for(key)
+        with shard.lock:
+            entry = self._lookup(shard, key)
+            if entry is None:
+                return -2
+            return -1 if entry.expire_at is None else entry.expire_at
+
+    def persist(self, key):
+        """
+        Removes the TTL of `key`. Returns whether it had one.
+        """
+        shard = self.shard_for(key)
+        with shard.lock:
+            entry = self._lookup(shard, key)
+            if entry is None or entry.expire_at is None:
+                return False
+            # Its expiry_index entry goes stale and is skipped
+            entry.expire_at = None
+            shard.volatile -= 1
+            shard.dirty += 1
+            if shard.watched or self.on_change is not None:
+                self._changed(shard, key)
+            return True
+
+    def watch(self, key):
+        """
+        Starts tracking changes to `key` for one more watcher and returns
+        its current version, to compare against version() later.
+        """
+        shard = self.shard_for(key)
+        with shard.lock:
+            # A key that has already expired goes now, not as a change later
+            self._lookup(shard, key)
+            watch = shard.watched.get(key)
+            if watch is None:
+                watch = shard.watched[key] = [0, 0]
+            watch[1] += 1
+            return watch[0]
+
+    def unwatch(self, key):
+        shard = self.shard_for(key)
+        with shard.lock:
+            watch = shard.watched[key]
+            watch[1] -= 1
+            if not watch[1]:
+                del shard.watched[key]
+
+    def version(self, key):
+        # How many times a watched key has changed since anyone started watching it
+        shard = self.shard_for(key)
+        with shard.lock:
+            return shard.watched[key][0]
+
+    @contextmanager
+    def update(self, key, value_class, create=True):
+        """
+        Yields the value of `key`, a `value_class` instance, for the caller
+        to change in place: a new empty one if the key is missing and
+        `create` is given, else None. Raises WrongTypeError if the key holds
+        something else. Afterwards the key's memory use is brought up to
+        date, and a collection left empty is deleted, as in Redis. A caller
+        that left the value as it was says so with unchanged(), so that no
+        change is recorded.
+        """
+        shard = self.shard_for(key)
+        with shard.lock:
+            shard.unchanged = False
+            entry = self._lookup(shard, key)
+            if entry is None:
+                if not create:
+                    yield None
+                    return
+                value = value_class()
+                yield value
+                if len(value):
+                    self._set(shard, key, value)
+                return
+            value = entry.value
+            if not isinstance(value, value_class):
+                raise WrongTypeError()
+            if self.maxmemory:
+                self._touch(entry)
+            size = sys.getsizeof(value)
+            try:
+                yield value
+            finally:
+                if shard.data.get(key) is entry and not shard.unchanged:
+                    if not len(value):
+                        self._delete(shard, key)
+                    else:
+                        shard.used_memory += sys.getsizeof(value) - size
+                        shard.dirty += 1
+                        if shard.watched or self.on_change is not None:
+                            self._changed(shard, key)
+
+    def unchanged(self, key):
+        """
+        Called inside update(key) when the value was not changed after all
+        (an HSETNX of a field that exists, a SADD of members already there),
+        so the key's version, the dirty count and on_change are left alone.
+        """
+        self.shard_for(key).unchanged = True
+
+    # Multi-key operations. Each locks the shards involved once for the
+    # whole batch, which also makes it atomic.
+
+    def get_many(self, keys):
+        """
+        Returns the value of each key, or None for a missing one.
+        """
+        values = []
+        with self.lock_keys(keys):
+            for key in keys:
+                shard = self.shards[hash(key) & self.shard_mask]
+                entry = self._lookup(shard, key)
+                if entry is None:
+                    shard.misses += 1
+                    values.append(None)
+                    continue
+                shard.hits += 1
+                if self.maxmemory:
+                    self._touch(entry)
+                values.append(entry.value)
+        return values
+
+    def set_many(self, pairs, only_if_none_exist=False):
+        """
+        Sets every (key, value) pair, clearing any TTLs. With
+        `only_if_none_exist` nothing is set if any of the keys exists.
+        Returns whether the keys were set.
+        """
+        with self.lock_keys([key for key, _ in pairs]):
+            if only_if_none_exist and self.count_existing(key for key, _ in pairs):
+                return False
+            for key, value in pairs:
+                self._set(self.shards[hash(key) & self.shard_mask], key, value)
+        return True
+
+    def count_existing(self, keys):
+        """
+        Counts the keys that exist; a key given twice is counted twice.
+        """
+        keys = list(keys)
+        count = 0
+        with self.lock_keys(keys):
+            for key in keys:
+                if self._lookup(self.shards[hash(key) & self.shard_mask], key) is not None:
+                    count += 1
+        return count
+
+    def delete_many(self, keys, release=None):
+        """
+        Deletes the keys and returns how many existed. The deleted values
+        are passed to `release`, if given, in a list nothing else refers to
+        them from, which it can keep to free them later.
+        """
+        values = []
+        with self.lock_keys(keys):
+            for key in keys:
+                entry = self._delete(self.shards[hash(key) & self.shard_mask], key)
+                if entry is not None:
+                    values.append(entry.value)
+            entry = None
+        deleted = len(values)
+        if release is not None and values:
+            release(values)
+        return deleted
+
+    def flush(self):
+        """
+        Empties the keyspace and returns the shards' old key dicts, which
+        the caller can drop or hand to a thread to free.
+        """
+        old = []
+        with self.lock_all():
+            for shard in self.shards:
+                old.append(shard.data)
+                shard.dirty += len(shard.data)
+                for watch in shard.watched.values():
+                    watch[0] += 1
+                shard.data = {}
+                shard.volatile = 0
+                shard.expiry_index = []
+                shard.samples = []
+                shard.scan_index = None
+                shard.scan_pending = []
+                shard.used_memory = 0
+            if self.on_change is not None:
+                self.on_change(None)
+        return old
+
+    def keys(self):
+        now = self.now_ms()
+        keys = []
+        for shard in self.shards:
+            with shard.lock:
+                keys.extend(key for key, entry in shard.data.items()
+                            if entry.expire_at is None or now <= entry.expire_at)
+        return keys
+
+    def scan(self, cursor, count=10, value_filter=None):
+        """
+        One step of SCAN: returns (next_cursor, keys), next_cursor being 0
+        once the whole keyspace has been visited.
+
+        Shards are walked in order and each shard's keys in the order of
+        their hash, so the cursor is a position in hash space (high bits)
+        plus a shard number (low bits) rather than a place in a table that
+        could be resized under it. Like Redis's reverse-binary cursor, that
+        means a key that exists for the whole scan is always returned,
+        whatever is added or deleted meanwhile; keys that come and go may
+        or may not be. About `count` keys are visited per call. Expired
+        keys, and with `value_filter` keys whose value it rejects, are
+        skipped.
+        """
+        shard_index = cursor & self.shard_mask
+        start = cursor >> self.shard_bits
+        keys = []
+        while True:
+            shard = self.shards[shard_index]
+            with shard.lock:
+                stop = self._scan_shard(shard, start, count - len(keys), keys, value_filter)
+            if stop is not None:
+                return (stop << self.shard_bits) | shard_index, keys
+            shard_index += 1
+            start = 0
+            if shard_index == len(self.shards):
+                return 0, keys
+            if len(keys) >= count:
+                return shard_index, keys
+
+    def items(self):
+        """
+        Yields (key, value, expire_at) for every live key. Takes no locks:
+        the caller must hold lock_all() or be the only thread running, as
+        in a forked save child.
+        """
+        now = self.now_ms()
+        for shard in self.shards:
+            for key, entry in shard.data.items():
+                if entry.expire_at is not None and now > entry.expire_at:
+                    continue
+                yield key, entry.value, entry.expire_at
+
+    def snapshot(self):
+        """
+        Returns a point-in-time list of (key, value, expire_at) for every
+        live key, taken with every shard locked. Collections, which
+        commands change in place, are copied.
+        """
+        with self.lock_all():
+            return [(key, value.copy() if hasattr(value, "copy") else value, expire_at)
+                    for key, value, expire_at in self.items()]
+
+    def load(self, data, expiry):
+        for key, value in data.items():
+            self.set(key, value, expiry.get(key))
+
+    # Internals; callers hold the shard lock
+
+    def _lookup(self, shard, key):
+        entry = shard.data.get(key)
+        if entry is None:
+            return None
+        if (entry.expire_at is not None and self.expiry != "keep"
+                and self.now_ms() > entry.expire_at):
+            if self.expiry == "delete":
+                # Lazy expiry
+                self._drop(shard, key)
+                shard.expired_keys += 1
+            return None
+        return entry
+
+    def _set(self, shard, key, value, expire_at=None, keep_ttl=False):
+        entry = self._lookup(shard, key)
+        if entry is None:
+            entry = Entry(value, None, self._new_meta())
+            shard.data[key] = entry
+            shard.used_memory += sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD
+            if self.maxmemory:
+                shard.samples.append(key)
+                if len(shard.samples) > 2 * len(shard.data) + 64:
+                    shard.samples[:] = list(shard.data)
+            if shard.scan_index is not None:
+                shard.scan_pending.append(key)
+        else:
+            shard.used_memory += sys.getsizeof(value) - sys.getsizeof(entry.value)
+            entry.value = value
+            if self.maxmemory:
+                self._touch(entry)
+            if not keep_ttl and entry.expire_at is not None:
+                entry.expire_at = None
+                shard.volatile -= 1
+        if expire_at is not None:
+            self._set_expiry(shard, key, entry, expire_at)
+        shard.dirty += 1
+        if shard.watched or self.on_change is not None:
+            self._changed(shard, key)
+
+    def _delete(self, shard, key, dirty=True):
+        # Returns the removed Entry, or None if there was no such key
+        entry = shard.data.pop(key, None)
+        if entry is None:
+            return None
+        if entry.expire_at is not None:
+            shard.volatile -= 1
+        shard.used_memory -= sys.getsizeof(key) + sys.getsizeof(entry.value) + ENTRY_OVERHEAD
+        if dirty:
+            shard.dirty += 1
+        if shard.watched or self.on_change is not None:
+            self._changed(shard, key)
+        return entry
+
+    def _drop(self, shard, key):
+        # Deletes a key that expired or was evicted. That is not a change a
+        # command made, so the dirty count is left alone; on_drop hears of it
+        entry = self._delete(shard, key, dirty=False)
+        if entry is not None and self.on_drop is not None:
+            self.on_drop(key)
+        return entry
+
+    def _changed(self, shard, key):
+        watch = shard.watched.get(key)
+        if watch is not None:
+            watch[0] += 1
+        if self.on_change is not None:
+            self.on_change(key)
+
+    def _set_expiry(self, shard, key, entry, expire_at):
+        if entry.expire_at is None:
+            shard.volatile += 1
+        entry.expire_at = expire_at
+        heapq.heappush(shard.expiry_index, (expire_at, key))
+
+    def _expiry_top(self, shard):
+        # Soonest-expiring live entry of the shard's heap, or None
+        heap = shard.expiry_index
+        while heap:
+            expire_at, key = heap[0]
+            entry = shard.data.get(key)
+            if entry is not None and entry.expire_at == expire_at:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def _scan_shard(self, shard, start, count, keys, value_filter):
+        # Visits the shard's keys from hash position `start` on, stopping
+        # once `count` have been seen and the position is about to change;
+        # positions are hash values with the shard bits dropped, so several
+        # keys can share one. Returns where the next call should start, or
+        # None when the shard is done.
+        index = shard.scan_index
+        if (index is None or len(shard.scan_pending) > len(index) // 8 + 64
+                or len(index) > 2 * len(shard.data) + 64):
+            self._rebuild_scan_index(shard)
+        index = shard.scan_index
+        shift = self.shard_bits
+        i = bisect_left(index, (start << shift) - SCAN_HASH_OFFSET, key=hash)
+        stop = None
+        visited = 0
+        found = []
+        last = None
+        while i < len(index):
+            key = index[i]
+            position = (hash(key) + SCAN_HASH_OFFSET) >> shift
+            if visited >= count and position != last:
+                stop = position
+                break
+            found.append(key)
+            last = position
+            visited += 1
+            i += 1
+        # Keys added since the index was built, in the same range
+        for key in shard.scan_pending:
+            position = (hash(key) + SCAN_HASH_OFFSET) >> shift
+            if position >= start and (stop is None or position < stop):
+                found.append(key)
+        for key in dict.fromkeys(found):
+            entry = self._lookup(shard, key)
+            if entry is not None and (value_filter is None or value_filter(entry.value)):
+                keys.append(key)
+        return stop
+
+    def _rebuild_scan_index(self, shard):
+        data = shard.data
+        if shard.scan_index is None:
+            shard.scan_index = sorted(data, key=hash)
+        else:
+            # The index is already sorted, so this is mostly a merge
+            keys = list(filter(data.__contains__, shard.scan_index))
+            keys += filter(data.__contains__, shard.scan_pending)
+            shard.scan_index = sorted(dict.fromkeys(keys), key=hash)
+        shard.scan_pending = []
+
+    # Active expiry
+
+    def active_expire_cycle(self, time_limit_us):
+        """
+        Deletes keys whose TTL has passed, soonest first within each shard,
+        visiting shards round-robin until none are left or `time_limit_us`
+        has been used. Returns (expired, hit_time_limit).
+        """
+        deadline = time.perf_counter() + time_limit_us / 1000000
+        now = self.now_ms()
+        expired = 0
+        num_shards = len(self.shards)
+        for _ in range(num_shards):
+            shard = self.shards[self.expire_cursor]
+            with shard.lock:
+                heap = shard.expiry_index
+                checked = 0
+                while heap and heap[0][0] < now:
+                    expire_at, key = heapq.heappop(heap)
+                    entry = shard.data.get(key)
+                    if entry is not None and entry.expire_at == expire_at:
+                        self._drop(shard, key)
+                        shard.expired_keys += 1
+                        expired += 1
+                    checked += 1
+                    # Checking the clock is not free; do it every 16 entries
+                    if checked % 16 == 0 and time.perf_counter() > deadline:
+                        return expired, True
+
+                # Drop stale entries once they outnumber the live ones
+                if len(heap) > 2 * shard.volatile + 64:
+                    heap[:] = [(entry.expire_at, key) for key, entry in shard.data.items()
+                               if entry.expire_at is not None]
+                    heapq.heapify(heap)
+
+            self.expire_cursor = (self.expire_cursor + 1) % num_shards
+            if time.perf_counter() > deadline:
+                return expired, True
+        return expired, False
+
+    # Eviction
+
+    def lfu_time_minutes(self):
+        return (self.lru_clock // 60) & 0xFFFF
+
+    def lfu_decayed_counter(self, meta):
+        counter = meta & 0xFF
+        elapsed = (self.lfu_time_minutes() - (meta >> 8)) & 0xFFFF
+        return max(0, counter - elapsed // LFU_DECAY_TIME)
+
+    def _new_meta(self):
+        if self.policy == "allkeys-lfu":
+            return (self.lfu_time_minutes() << 8) | LFU_INIT_VAL
+        return self.lru_clock
+
+    def _touch(self, entry):
+        """
+        Records an access for the LRU/LFU policies. Other policies never
+        look at the metadata, so nothing is updated for them.
+        """
+        if self.policy == "allkeys-lru":
+            entry.meta = self.lru_clock
+        elif self.policy == "allkeys-lfu":
+            counter = self.lfu_decayed_counter(entry.meta)
+            # Logarithmic increment: the busier a key already is, the less
+            # likely one more access moves its 8-bit counter.
+            if counter < 255 and random.random() < 1.0 / (max(counter - LFU_INIT_VAL, 0) * LFU_LOG_FACTOR + 1):
+                counter += 1
+            entry.meta = (self.lfu_time_minutes() << 8) | counter
+
+    def _sample_key(self, shard):
+        samples = shard.samples
+        while samples:
+            i = random.randrange(len(samples))
+            key = samples[i]
+            if key in shard.data:
+                return key
+            # Stale entry for a deleted key: swap-remove it
+            samples[i] = samples[-1]
+            samples.pop()
+        return None
+
+    def _eviction_candidate(self):
+        if self.policy == "volatile-ttl":
+            # The expiry heaps already order volatile keys by deadline, so
+            # the soonest-to-expire key is exact rather than sampled.
+            best = None
+            for shard in self.shards:
+                with shard.lock:
+                    top = self._expiry_top(shard)
+                if top is not None and (best is None or top[0] < best[0]):
+                    best = (top[0], shard, top[1])
+            return best and best[1:]
+
+        best = None
+        best_score = -1
+        sampled = 0
+        # Empty shards don't count as samples, but give up eventually
+        for _ in range(self.maxmemory_samples * 4):
+            if sampled == self.maxmemory_samples:
+                break
+            shard = random.choice(self.shards)
+            with shard.lock:
+                key = self._sample_key(shard)
+                if key is None:
+                    continue
+                meta = shard.data[key].meta
+            sampled += 1
+            if self.policy == "allkeys-lru":
+                score = (self.lru_clock - meta) & LRU_CLOCK_MAX # Idle time
+            else:
+                score = 255 - self.lfu_decayed_counter(meta)
+            if score > best_score:
+                best = (shard, key)
+                best_score = score
+        return best
+
+    def perform_evictions(self):
+        """
+        Evicts keys under the configured policy until the dataset fits in
+        maxmemory. Returns False if memory is still over the limit.
+        """
+        while self.used_memory() > self.maxmemory:
+            if self.policy == "noeviction":
+                return False
+            candidate = self._eviction_candidate()
+            if candidate is None:
+                return False
+            shard, key = candidate
+            with shard.lock:
+                if self._drop(shard, key):
+                    shard.evicted_keys += 1
+        return True
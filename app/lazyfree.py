@@ -0,0 +1,95 @@
+import queue
+import sys
+import threading
+from collections import deque
+
+# Values with more elements than this are freed in the background; smaller
+# ones cost less to free than to hand over
+LAZYFREE_THRESHOLD = 64
+
+# Elements freed per step, between which other threads can take the GIL
+LAZYFREE_CHUNK = 1024
+
+def free_effort(value):
+    """
+    Roughly how much work freeing `value` is: its number of elements, or 1
+    for a string, which is a single allocation however long it is.
+    """
+    if isinstance(value, (bytes, str)):
+        return 1
+    try:
+        return len(value)
+    except TypeError:
+        return 1
+
+class LazyFree:
+    """
+    A background thread that frees values a command no longer needs, so
+    UNLINK and FLUSHALL ASYNC can reply without paying for it.
+
+    Dropping the last reference to a large container frees all of it in a
+    single step that holds the GIL throughout, which would stall the
+    request thread just the same. So the thread empties containers a chunk
+    at a time instead, giving other threads a chance to run in between.
+    A container something else still refers to (a background save's
+    snapshot, say) is only let go of, never emptied.
+
+    Values are handed over in a list the caller gives up, and the thread
+    takes them out of it one at a time. That way the only reference to a
+    value is the thread's own once it has it, whatever becomes of the list.
+    """
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.pending = 0 # Objects queued and not yet freed
+        self.freed = 0
+        self.thread = None
+
+    def free(self, values):
+        """
+        Frees the list `values`: those big enough to be worth it in the
+        background, the rest right away.
+        """
+        values[:] = [value for value in values if free_effort(value) > LAZYFREE_THRESHOLD]
+        if values:
+            self.free_later(values)
+
+    def free_later(self, values):
+        with self.lock:
+            self.pending += len(values)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put(values)
+
+    def run(self):
+        while True:
+            values = self.queue.get()
+            while values:
+                value = values.pop()
+                # 2: this frame's reference and getrefcount's own argument
+                if sys.getrefcount(value) == 2:
+                    release(value)
+                del value
+                with self.lock:
+                    self.pending -= 1
+                    self.freed += 1
+            del values
+
+def release(value):
+    # Empties a container we hold the only reference to, chunk by chunk
+    if hasattr(value, "type_name"):
+        # One of the keyspace's collection types: empty what it is made of
+        for name in value.__slots__:
+            release(getattr(value, name))
+    elif isinstance(value, list):
+        while value:
+            del value[-LAZYFREE_CHUNK:]
+    elif isinstance(value, dict):
+        while value:
+            for _ in range(min(LAZYFREE_CHUNK, len(value))):
+                value.popitem()
+    elif isinstance(value, (set, deque)):
+        while value:
+            for _ in range(min(LAZYFREE_CHUNK, len(value))):
+                value.pop()
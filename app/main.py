@@ -1,258 +1,3060 @@
+import gc
+import itertools
+import os
+import platform
+import selectors
+import signal
 import socket  # noqa: F401
+import sys
 import threading
 import time
 
-DATA_STORE = {}
-EXPIRY_STORE = {}
+from app.aof import APPENDFSYNC_POLICIES, AOFError, AppendOnlyFile, encode_command, load_aof, rewrite_aof
+from app.cluster import Cluster, key_hash_slot
+from app.datatypes import (ENCODING_LIMITS, INT64_MAX, INT64_MIN, Hash, List, Set, ZSet, as_int64, from_loaded,
+                           string_encoding)
+from app.keyspace import MAXMEMORY_POLICIES, Keyspace, WrongTypeError
+from app.lazyfree import LazyFree
+from app.monitoring import LatencyMonitor, SlowLog
+from app.pubsub import PubSub
+from app.rdb_parser import RDBError, iter_rdb, save_rdb, value_type
+from app.replication import REPL_TIMEOUT, ReplicationBacklog, ReplicationError, new_replid, sync_with_master
+from app.resp import (LOADING_ERROR, NOT_INTEGER_ERROR, NULL_ARRAY, NULL_BULK, OK, ONE, OOM_ERROR, PONG,
+                      QUEUED, RESP3_NULL, SYNTAX_ERROR, WRONGTYPE_ERROR, ZERO, ProtocolError, RESPParser,
+                      encode_array, encode_bulk_string, encode_error, encode_integer, encode_map, encode_push,
+                      encode_simple_string)
+from app.stringmatch import compile_pattern
+from app.tracking import TrackingTable
+
+KEYSPACE = Keyspace()
 SERVER_CONFIG = {}
 
-class RESPParser:
-    def __init__(self, data):
-        self.data = data
-        self.pos = 0
+# The append-only file, when appendonly is on
+AOF = None
 
-    def parse(self):
-        if self.pos >= len(self.data):
-            return None
-        
-        byte = self.data[self.pos]
-        # Array
-        if byte == 42:  # '*'
-            return self.parse_array()
-        # Bulk String
-        elif byte == 36: # '$'
-            return self.parse_bulk_string()
-        # Simple String (Inline commands often behave like this too for PING)
-        elif byte == 43: # '+'
-            return self.read_line()
-        else:
-            # Fallback for inline commands (like PING sent via netcat without RESP)
-            return self.read_line().split()
-
-    def read_line(self):
-        start = self.pos
-        while self.pos < len(self.data) and self.data[self.pos] != 13: # \r
-            self.pos += 1
-        line = self.data[start:self.pos].decode()
-        self.pos += 2 # Skip \r\n
-        return line
-
-    def read_int(self):
-        return int(self.read_line())
-
-    def parse_bulk_string(self):
-        self.pos += 1 # Skip $
-        length = self.read_int()
-        if length == -1:
-            return None
-        start = self.pos
-        self.pos += length
-        data = self.data[start:self.pos].decode()
-        self.pos += 2 # Skip \r\n
-        return data
-
-    def parse_array(self):
-        self.pos += 1 # Skip *
-        count = self.read_int()
-        items = []
-        for _ in range(count):
-            byte = self.data[self.pos]
-            if byte == 36: # '$' indicates bulk string
-                items.append(self.parse_bulk_string())
-            elif byte == 58: # ':' integer
-                # Not standard for command arrays but good for completeness
-                self.pos += 1
-                items.append(self.read_int())
-        return items
-
-def encode_bulk_string(s):
-    if s is None:
-        return b"$-1\r\n"
-    return f"${len(s)}\r\n{s}\r\n".encode()
-
-def encode_simple_string(s):
-    return f"+{s}\r\n".encode()
-
-def encode_error(msg):
-    return f"-ERR {msg}\r\n".encode()
-
-def encode_array(arr):
-    res = f"*{len(arr)}\r\n".encode()
-    for item in arr:
-         res += encode_bulk_string(item)
-    return res
-
-def handle_command(args):
+# Frees large deleted values (UNLINK, FLUSHALL ASYNC) in the background
+LAZYFREE = LazyFree()
+
+# The slot layout, in the worker processes of --workers mode
+CLUSTER = None
+
+CROSSSLOT_ERROR = b"-CROSSSLOT Keys in request don't hash to the same slot\r\n"
+
+# Commands a client in MULTI runs at once instead of queueing
+TRANSACTION_COMMANDS = {b"multi", b"exec", b"discard", b"watch"}
+MULTI_COMMAND = encode_command([b"MULTI"])
+EXEC_COMMAND = encode_command([b"EXEC"])
+EXECABORT_ERROR = b"-EXECABORT Transaction discarded because of previous errors.\r\n"
+
+# Version reported by INFO; clients use it to tell which commands exist
+REDIS_VERSION = "7.2.0"
+START_TIME = time.time()
+
+SLOWLOG = SlowLog()
+LATENCY = LatencyMonitor()
+
+# Connected clients by id
+CLIENTS = {}
+CLIENT_IDS = itertools.count(1)
+
+STATS = {
+    "instantaneous_expired_per_sec": 0,
+    "expire_cycle_last_duration_us": 0,
+    "expire_cycle_cpu_milliseconds": 0,
+    "expired_time_cap_reached_count": 0,
+    "latest_fork_usec": 0,
+    "total_connections_received": 0,
+    "total_commands_processed": 0,
+    "instantaneous_ops_per_sec": 0,
+    "total_net_input_bytes": 0,
+    "total_net_output_bytes": 0,
+    "client_output_buffer_limit_disconnections": 0,
+}
+
+# Highest used_memory seen by the cron
+MEMORY_PEAK = {"used_memory_peak": 0}
+
+# RDB snapshot state. A background save runs in a forked child (child_pid)
+# or, where fork is unavailable, a thread (child_thread).
+PERSISTENCE = {
+    "lastsave": int(time.time()),
+    "dirty_at_lastsave": 0,
+    "dirty_before_bgsave": 0,
+    "child_pid": None,
+    "child_thread": None,
+    "child_result": None,
+    "bgsave_start": None,
+    "last_bgsave_status": "ok",
+    "last_bgsave_time_sec": -1,
+    "last_bgsave_try": 0,
+    # Same for BGREWRITEAOF
+    "aof_child_pid": None,
+    "aof_child_thread": None,
+    "aof_child_result": None,
+    "aof_rewrite_start": None,
+    "aof_rewrite_scheduled": False,
+    "aof_temp_filename": None,
+    "aof_last_bgrewrite_status": "ok",
+    "aof_last_rewrite_time_sec": -1,
+}
+PERSISTENCE_LOCK = threading.Lock()
+
+# Startup load of the RDB file. Until it finishes, commands without the
+# "loading" flag are refused.
+LOADING = {
+    "loading": False,
+    "start_time": 0,
+    "total_bytes": 0,
+    "loaded_bytes": 0,
+    "last_log": 0,
+}
+
+# Replication. Replicas are clients that sent PSYNC, in REPLICAS; on a
+# replica, the master's stream is read from a client too (master_client),
+# set up by a thread that runs the handshake and the initial transfer.
+REPLICATION = {
+    "replid": new_replid(),
+    "replid2": "0" * 40,           # The ID this history had before, if any
+    "second_replid_offset": -1,    # and up to where replid2 is valid
+    "backlog": None,               # Created when a replica first attaches
+    "master_host": None,
+    "master_port": None,
+    "master_client": None,
+    "sync_thread": None,
+    "sync_result": None,           # Handed from the sync thread to the event loop
+    "last_sync_attempt": 0,
+    "last_ping": 0,
+    "last_ack": 0,
+}
+REPLICAS = []
+
+# Seconds between the PINGs a master sends its replicas, and between a
+# replica's REPLCONF ACKs
+REPL_PING_REPLICA_PERIOD = 10
+REPL_ACK_PERIOD = 1
+
+READONLY_ERROR = b"-READONLY You can't write against a read only replica.\r\n"
+
+# Clients given output outside their own request (replicas fed a write,
+# unblocked WAITs), for the event loop to write out
+PENDING_WRITES = set()
+
+# Clients blocked in WAIT
+BLOCKED_CLIENTS = set()
+
+PUBSUB = PubSub()
+
+# Output a subscriber may fall behind by: (hard limit, soft limit, seconds).
+# Past the hard limit, or over the soft one for that many seconds, it is
+# disconnected, so a slow reader never holds up the publishers.
+PUBSUB_OUTPUT_BUFFER_LIMIT = (32 * 1024 * 1024, 8 * 1024 * 1024, 60)
+
+# Client-side caching: which clients may have cached which keys
+TRACKING = TrackingTable()
+
+# Commands a RESP2 client that has subscribed to something can still run
+PUBSUB_CONTEXT_COMMANDS = {b"subscribe", b"unsubscribe", b"psubscribe", b"punsubscribe", b"ping"}
+
+# Seconds to wait after a failed automatic save before trying again
+BGSAVE_RETRY_DELAY = 5
+
+# Share of each cron tick the active expire cycle may spend, in percent
+ACTIVE_EXPIRE_CYCLE_TIME_PERC = 25
+
+# (seconds, changes) pairs from the "save" setting
+SAVE_RULES = []
+
+# Replies buffered per client before the server stops reading from it
+OUTPUT_BUFFER_LIMIT = 1024 * 1024
+
+def parse_memory(value):
+    """
+    Parses a Redis-style memory amount such as "100mb" or "1gb" into bytes.
+    """
+    units = {"b": 1, "k": 1000, "kb": 1024, "m": 1000 ** 2, "mb": 1024 ** 2, "g": 1000 ** 3, "gb": 1024 ** 3}
+    value = value.strip().lower()
+    digits = value.rstrip("bkmg")
+    unit = value[len(digits):] or "b"
+    if unit not in units:
+        raise ValueError(f"invalid memory amount {value!r}")
+    return int(digits) * units[unit]
+
+def bytes_to_human(n):
+    for unit, size in (("G", 1024 ** 3), ("M", 1024 ** 2), ("K", 1024)):
+        if n >= size:
+            return f"{n / size:.2f}{unit}"
+    return f"{n}B"
+
+def active_expire_cycle(time_limit_us):
+    start = time.perf_counter()
+    expired, hit_time_limit = KEYSPACE.active_expire_cycle(time_limit_us)
+    elapsed = time.perf_counter() - start
+    if hit_time_limit:
+        STATS["expired_time_cap_reached_count"] += 1
+    LATENCY.add_sample("expire-cycle", int(elapsed * 1000))
+    STATS["expire_cycle_last_duration_us"] = int(elapsed * 1000000)
+    STATS["expire_cycle_cpu_milliseconds"] += elapsed * 1000
+    return expired
+
+class Command:
+    """
+    Command table entry. Arity follows Redis: N means exactly N arguments
+    (including the name), -N means at least N. first_key, last_key and
+    key_step give the key positions (last_key -1 means "to the end").
+    """
+    __slots__ = ("name", "handler", "arity", "flags", "first_key", "last_key", "key_step", "denyoom", "loading", "write",
+                 "readonly", "info", "calls", "usec", "rejected_calls", "failed_calls")
+
+    def __init__(self, name, handler, arity, flags, first_key, last_key, key_step):
+        self.name = name
+        self.handler = handler
+        self.arity = arity
+        self.flags = flags
+        self.first_key = first_key
+        self.last_key = last_key
+        self.key_step = key_step
+        self.denyoom = "denyoom" in flags
+        self.loading = "loading" in flags # Allowed while the dataset loads
+        self.write = "write" in flags
+        self.readonly = "readonly" in flags # Its keys are tracked for client-side caching
+        # COMMAND / COMMAND INFO reply entry, built once
+        self.info = encode_array([name, arity, list(flags), first_key, last_key, key_step])
+        # INFO commandstats. calls, usec and failed_calls are only kept
+        # while commands are timed; see configure_instrumentation().
+        self.calls = 0
+        self.usec = 0
+        self.rejected_calls = 0 # Refused before running: arity, LOADING, OOM, MISCONF
+        self.failed_calls = 0   # Ran and replied with an error
+
+COMMAND_TABLE = {}
+
+def command(name, arity, flags, first_key=0, last_key=0, key_step=0):
+    """
+    Registers the decorated function as the handler for `name`. Handlers are
+    called as handler(client, args) and return the encoded reply.
+    """
+    def register(handler):
+        cmd = Command(name, handler, arity, tuple(flags.split()), first_key, last_key, key_step)
+        # Clients send either case, so both are looked up without .upper().
+        # Names arrive as bytes, straight from the parser.
+        COMMAND_TABLE[name.upper().encode()] = cmd
+        COMMAND_TABLE[name.encode()] = cmd
+        return handler
+    return register
+
+def all_commands():
+    return [cmd for name, cmd in COMMAND_TABLE.items() if name == cmd.name.encode()]
+
+def lookup_command(name):
+    cmd = COMMAND_TABLE.get(name)
+    if cmd is None:
+        cmd = COMMAND_TABLE.get(name.lower())
+    return cmd
+
+def command_keys(cmd, args):
+    if not cmd.first_key:
+        return []
+    last_key = cmd.last_key if cmd.last_key >= 0 else len(args) + cmd.last_key
+    return args[cmd.first_key:last_key + 1:cmd.key_step]
+
+def cluster_redirect(cmd, args):
+    """
+    In --workers mode, the error sending a command to the worker that owns
+    its keys, or None if that is this one.
+    """
+    slot = CLUSTER.keys_slot(command_keys(cmd, args))
+    if slot is None:
+        return None
+    if slot == -1:
+        return CROSSSLOT_ERROR
+    owner = CLUSTER.owners[slot]
+    if owner == CLUSTER.index:
+        return None
+    return b"-MOVED %d %b:%d\r\n" % (slot, CLUSTER.host.encode(), CLUSTER.worker_port(owner))
+
+def dispatch_command(args, client=None):
     if not args:
         return encode_error("no command")
+    if client is not None:
+        if client.multi is not None and args[0].lower() not in TRANSACTION_COMMANDS:
+            return queue_command(args, client)
+        if ((client.channels or client.patterns) and client.resp == 2
+                and args[0].lower() not in PUBSUB_CONTEXT_COMMANDS):
+            return encode_error(f"Can't execute '{args[0].decode(errors='replace').lower()}': only (P)SUBSCRIBE / "
+                                "(P)UNSUBSCRIBE / PING are allowed in this context")
+
+    cmd = lookup_command(args[0])
+    if cmd is None:
+        preview = " ".join(f"'{arg.decode(errors='replace')}'" for arg in args[1:])
+        return encode_error(f"unknown command '{args[0].decode(errors='replace')}', with args beginning with: {preview}")
+    if (cmd.arity > 0 and len(args) != cmd.arity) or len(args) < -cmd.arity:
+        cmd.rejected_calls += 1
+        return encode_error(f"wrong number of arguments for '{cmd.name}' command")
+    if CLUSTER is not None and cmd.first_key:
+        redirect = cluster_redirect(cmd, args)
+        if redirect is not None:
+            cmd.rejected_calls += 1
+            return redirect
+    if LOADING["loading"] and not cmd.loading:
+        cmd.rejected_calls += 1
+        return LOADING_ERROR
+    if cmd.write and REPLICATION["master_host"] is not None and client is not None and not client.is_master:
+        cmd.rejected_calls += 1
+        return READONLY_ERROR
+    # Commands EXEC runs don't evict: EXEC did before locking their shards,
+    # and evicting would take other shards out of order. A replica never
+    # evicts; it drops what its master evicted when the DELs come in.
+    if (KEYSPACE.maxmemory and REPLICATION["master_host"] is None
+            and not (client is not None and client.in_exec)
+            and KEYSPACE.used_memory() > KEYSPACE.maxmemory and not KEYSPACE.perform_evictions()
+            and denies_oom(cmd, client)):
+        cmd.rejected_calls += 1
+        if cmd.handler is exec_command:
+            # As in Redis, the whole transaction is dropped
+            discard_transaction(client)
+            return b"-EXECABORT Transaction discarded because of: " + OOM_ERROR[1:]
+        return OOM_ERROR
+    STATS["total_commands_processed"] += 1
+    try:
+        if not cmd.write or (AOF is None and REPLICATION["backlog"] is None):
+            if client is None or not client.tracking:
+                return cmd.handler(client, args)
+            return call_tracked(cmd, client, args)
+        if AOF is not None and AOF.last_write_error:
+            cmd.rejected_calls += 1
+            return f"-MISCONF Errors writing to the AOF file: {AOF.last_write_error}\r\n".encode()
+        # The keys stay locked until the command is logged, so the log has
+        # writes to a key in the order they ran and a rewrite starting under
+        # lock_all() sees each write either in its snapshot or in its buffer.
+        # Only a command that changed something is logged: a SET NX on a
+        # key that exists, or a PERSIST of a key without a TTL, is not.
+        keys = command_keys(cmd, args) or None
+        with KEYSPACE.lock_keys(keys) if keys else KEYSPACE.lock_all():
+            dirty = KEYSPACE.dirty(keys)
+            if client is None or not client.tracking:
+                reply = cmd.handler(client, args)
+            else:
+                reply = call_tracked(cmd, client, args)
+            if KEYSPACE.dirty(keys) != dirty:
+                # Handlers may have rewritten args into a replay-safe form
+                propagate(args, client)
+        return reply
+    except WrongTypeError:
+        return WRONGTYPE_ERROR
+
+def call_tracked(cmd, client, args):
+    """
+    Runs a command for a client with CLIENT TRACKING on. In the default
+    mode the keys a read-only command looks at are remembered for it; with
+    NOLOOP, it is left out of the invalidations its own writes cause.
+    """
+    # CLIENT CACHING applies to the one command after it
+    caching, client.tracking_caching = client.tracking_caching, None
+    writer, TRACKING.writer = TRACKING.writer, client
+    try:
+        reply = cmd.handler(client, args)
+    finally:
+        TRACKING.writer = writer
+    if cmd.readonly and cmd.first_key and not client.tracking_bcast:
+        if client.tracking_opt is None or (caching if client.tracking_opt == b"OPTIN" else caching is not False):
+            for key, ids in TRACKING.remember(client.id, command_keys(cmd, args)):
+                send_invalidation(ids, [key])
+    return reply
+
+def denies_oom(cmd, client):
+    # EXEC is refused over maxmemory when a command it would run is
+    if cmd.denyoom:
+        return True
+    return (cmd.handler is exec_command and client is not None and client.multi is not None
+            and any(lookup_command(args[0]).denyoom for args in client.multi))
+
+def queue_command(args, client):
+    """
+    Queues a command sent after MULTI to run at EXEC. One that can't run
+    (unknown, wrong arity, keys on another worker) is refused now, and
+    makes the EXEC fail.
+    """
+    cmd = lookup_command(args[0])
+    if (cmd is None or (cmd.arity > 0 and len(args) != cmd.arity) or len(args) < -cmd.arity
+            or (CLUSTER is not None and cmd.first_key and cluster_redirect(cmd, args) is not None)):
+        client.multi_error = True
+        # The same error it gets outside MULTI; nothing runs
+        return dispatch_command(args)
+    client.multi.append(args)
+    return QUEUED
+
+def propagate(args, client, aof=True):
+    """
+    Logs a write that just ran to the AOF and sends it to the replicas,
+    encoded once for both; with `aof` false it only goes to the replicas.
+    What a replica gets from its master is passed on as it came, by
+    process_master_command().
+    """
+    data = encode_command(args)
+    to_aof = AOF is not None and aof
+    to_replicas = REPLICATION["backlog"] is not None and not (client is not None and client.is_master)
+    if client is not None and client.in_exec:
+        # A transaction reaches the AOF and the replicas wrapped in
+        # MULTI/EXEC, opened by the first of its commands to get there
+        opened = client.exec_opened
+        feed_streams(MULTI_COMMAND, client, to_aof and "aof" not in opened,
+                     to_replicas and "replicas" not in opened)
+        if to_aof:
+            opened.add("aof")
+        if to_replicas:
+            opened.add("replicas")
+    feed_streams(data, client, to_aof, to_replicas)
+
+def propagate_drop(key):
+    # KEYSPACE.on_drop. Only a master expires and evicts keys; its AOF and
+    # replicas get a DEL for each, so an AOF replay or a replica with a
+    # different memory use or clock ends up with the same keys
+    if AOF is not None or REPLICATION["backlog"] is not None:
+        propagate([b"DEL", key], None)
+
+def feed_streams(data, client, to_aof, to_replicas):
+    if to_aof:
+        AOF.feed(data)
+    if to_replicas:
+        replication_feed(data)
+        if client is not None:
+            client.woff = REPLICATION["backlog"].offset
+
+def timed_dispatch_command(args, client=None):
+    """
+    dispatch_command() plus the timing behind INFO commandstats, the slow
+    log and the latency monitor.
+    """
+    cmd = lookup_command(args[0]) if args else None
+    if cmd is None:
+        return dispatch_command(args, client)
+    rejected = cmd.rejected_calls
+    start = time.perf_counter_ns()
+    reply = dispatch_command(args, client)
+    usec = (time.perf_counter_ns() - start) // 1000
+    if cmd.rejected_calls != rejected:
+        return reply
+    cmd.calls += 1
+    cmd.usec += usec
+    if reply.startswith(b"-"):
+        cmd.failed_calls += 1
+    if 0 <= SLOWLOG.threshold_us <= usec:
+        if client is not None:
+            SLOWLOG.add(args, usec, f"{client.addr[0]}:{client.addr[1]}", client.name)
+        else:
+            SLOWLOG.add(args, usec)
+    if LATENCY.threshold_ms:
+        LATENCY.add_sample("fast-command" if "fast" in cmd.flags else "command", usec // 1000)
+    return reply
+
+# Runs a command and returns its reply. While the slow log and the latency
+# monitor are both off this is dispatch_command() itself, so the timing
+# costs nothing then; see configure_instrumentation().
+handle_command = dispatch_command
+
+def configure_instrumentation():
+    global handle_command
+    SLOWLOG.threshold_us = int(SERVER_CONFIG["slowlog-log-slower-than"])
+    SLOWLOG.resize(max(int(SERVER_CONFIG["slowlog-max-len"]), 0))
+    LATENCY.threshold_ms = int(SERVER_CONFIG["latency-monitor-threshold"])
+    if SLOWLOG.threshold_us >= 0 or LATENCY.threshold_ms:
+        handle_command = timed_dispatch_command
+    else:
+        handle_command = dispatch_command
+
+@command("config", -2, "admin loading stale")
+def config_command(client, args):
+    if len(args) < 3 or args[1].upper() != b"GET":
+        return encode_error("commands other than CONFIG GET are not supported")
     
-    cmd = args[0].upper()
-    
-    if cmd == "CONFIG":
-        if len(args) < 3 or args[1].upper() != "GET":
-            return encode_error("commands other than CONFIG GET are not supported")
-        
-        param = args[2]
-        value = SERVER_CONFIG.get(param)
-        
-        if value is None:
-             return encode_array([]) 
-             
-        # CONFIG GET returns a 2-element array: [param_name, param_value]
-        # We need to compose the array manually or use a helper
-        return f"*2\r\n${len(param)}\r\n{param}\r\n${len(value)}\r\n{value}\r\n".encode()
-
-    if cmd == "PING":
-        return encode_simple_string("PONG")
+    param = args[2].decode(errors="replace")
+    value = SERVER_CONFIG.get(param)
     
-    if cmd == "ECHO":
-        if len(args) < 2:
-            return encode_error("wrong number of arguments for 'echo' command")
+    if value is None:
+         return encode_array([]) 
+         
+    # CONFIG GET returns a 2-element array: [param_name, param_value]
+    return encode_array([param, value])
+
+@command("command", -1, "loading stale")
+def command_command(client, args):
+    if len(args) == 1:
+        infos = [cmd.info for cmd in all_commands()]
+        return f"*{len(infos)}\r\n".encode() + b"".join(infos)
+
+    sub = args[1].upper()
+    if sub == b"COUNT":
+        return encode_integer(len(all_commands()))
+    if sub == b"INFO":
+        infos = []
+        for name in args[2:]:
+            cmd = lookup_command(name)
+            infos.append(cmd.info if cmd else NULL_ARRAY)
+        return f"*{len(infos)}\r\n".encode() + b"".join(infos)
+    if sub == b"LIST":
+        return encode_array([cmd.name for cmd in all_commands()])
+    if sub == b"DOCS":
+        return encode_array([])
+    return encode_error(f"unknown subcommand '{args[1].decode(errors='replace')}'. Try COMMAND HELP.")
+
+@command("ping", -1, "fast stale")
+def ping_command(client, args):
+    if client is not None and (client.channels or client.patterns) and client.resp == 2:
+        # A subscriber's replies are arrays, like the messages around them
+        return encode_array([b"pong", args[1] if len(args) > 1 else b""])
+    if len(args) > 1:
         return encode_bulk_string(args[1])
-        
-    if cmd == "SET":
-        if len(args) < 3:
-            return encode_error("wrong number of arguments for 'set' command")
-        key = args[1]
-        val = args[2]
-        expiry = None
-        
-        # Handle PX argument
-        if len(args) > 3:
-            for i in range(3, len(args)):
-                if args[i].upper() == "PX" and i + 1 < len(args):
-                    try:
-                        px = int(args[i+1])
-                        expiry = time.time() * 1000 + px
-                    except ValueError:
-                        return encode_error("value is not an integer or out of range")
-        
-        DATA_STORE[key] = val
-        if expiry:
-            EXPIRY_STORE[key] = expiry
+    return PONG
+
+@command("echo", 2, "fast")
+def echo_command(client, args):
+    return encode_bulk_string(args[1])
+
+# Strings. A string is kept as bytes, or as an int once a counter command
+# has stored a number in it (the int encoding), so the next increment does
+# not have to parse it again.
+
+# The units of the SET and GETEX expiry options: how many ms one is, and
+# whether the time is relative to now
+EXPIRE_UNITS = {b"EX": (1000, True), b"PX": (1, True), b"EXAT": (1000, False), b"PXAT": (1, False)}
+
+def expire_at_ms(option, n):
+    """
+    The absolute expiry time in ms that `n` EX, PX, EXAT or PXAT units
+    stand for, or None if it is out of range.
+    """
+    scale, relative = EXPIRE_UNITS[option]
+    expire_at = n * scale + (KEYSPACE.now_ms() if relative else 0)
+    return expire_at if INT64_MIN <= expire_at <= INT64_MAX else None
+
+def as_bytes(value):
+    # A string value as it is sent back: ints are counters in the int encoding
+    return b"%d" % value if type(value) is int else value
+
+def read_string(key):
+    """
+    Returns the string value of `key` as bytes, or None if the key is
+    missing; raises WrongTypeError if it holds a collection.
+    """
+    value = KEYSPACE.get(key)
+    if value is None or isinstance(value, bytes):
+        return value
+    if type(value) is int:
+        return b"%d" % value
+    raise WrongTypeError()
+
+@command("set", -3, "write denyoom", 1, 1, 1)
+def set_command(client, args):
+    key = args[1]
+    val = args[2]
+    expiry = None
+    condition = None
+    get = keep_ttl = False
+
+    i = 3
+    while i < len(args):
+        option = args[i].upper()
+        if option in (b"NX", b"XX") and condition is None:
+            condition = option
+        elif option == b"GET" and not get:
+            get = True
+        elif option == b"KEEPTTL" and not keep_ttl and expiry is None:
+            keep_ttl = True
+        elif option in EXPIRE_UNITS and expiry is None and not keep_ttl and i + 1 < len(args):
+            n = parse_int(args[i+1])
+            if n is None:
+                return NOT_INTEGER_ERROR
+            expiry = expire_at_ms(option, n) if n > 0 else None
+            if expiry is None:
+                return encode_error("invalid expire time in 'set' command")
+            # Logged as an absolute time so a replay doesn't extend it
+            args[i] = b"PXAT"
+            args[i+1] = b"%d" % expiry
+            i += 1
+        else:
+            return SYNTAX_ERROR
+        i += 1
+
+    if condition is None and not get:
+        KEYSPACE.set(key, val, expiry, keep_ttl)
+        return OK
+    with KEYSPACE.lock_keys((key,)):
+        old = read_string(key) if get else None
+        exists = old is not None if get else KEYSPACE.exists(key)
+        if condition is None or exists == (condition == b"XX"):
+            KEYSPACE.set(key, val, expiry, keep_ttl)
+        elif not get:
+            return NULL_BULK
+    return encode_bulk_string(old) if get else OK
+
+@command("getset", 3, "write denyoom fast", 1, 1, 1)
+def getset_command(client, args):
+    with KEYSPACE.lock_keys((args[1],)):
+        old = read_string(args[1])
+        KEYSPACE.set(args[1], args[2])
+    args[:] = [b"SET", args[1], args[2]]
+    return encode_bulk_string(old)
+
+@command("getdel", 2, "write fast", 1, 1, 1)
+def getdel_command(client, args):
+    with KEYSPACE.lock_keys((args[1],)):
+        value = read_string(args[1])
+        if value is not None:
+            KEYSPACE.delete(args[1])
+    args[0] = b"DEL"
+    return encode_bulk_string(value)
+
+@command("getex", -2, "write fast", 1, 1, 1)
+def getex_command(client, args):
+    key = args[1]
+    option = args[2].upper() if len(args) > 2 else None
+    expiry = None
+    if option == b"PERSIST" and len(args) == 3:
+        pass
+    elif option in EXPIRE_UNITS and len(args) == 4:
+        n = parse_int(args[3])
+        if n is None:
+            return NOT_INTEGER_ERROR
+        expiry = expire_at_ms(option, n) if n > 0 else None
+        if expiry is None:
+            return encode_error("invalid expire time in 'getex' command")
+    elif option is not None:
+        return SYNTAX_ERROR
+
+    with KEYSPACE.lock_keys((key,)):
+        value = read_string(key)
+        if value is None or option is None:
+            return encode_bulk_string(value)
+        # Logged as what it did to the TTL
+        if option == b"PERSIST":
+            KEYSPACE.persist(key)
+            args[:] = [b"PERSIST", key]
+        elif expiry <= KEYSPACE.now_ms():
+            KEYSPACE.delete(key)
+            args[:] = [b"DEL", key]
+        else:
+            KEYSPACE.expire(key, expiry)
+            args[:] = [b"PEXPIREAT", key, b"%d" % expiry]
+    return encode_bulk_string(value)
+
+@command("get", 2, "readonly fast", 1, 1, 1)
+def get_command(client, args):
+    return encode_bulk_string(read_string(args[1]))
+
+@command("mget", -2, "readonly fast", 1, -1, 1)
+def mget_command(client, args):
+    values = KEYSPACE.get_many(args[1:])
+    # Like GET on a missing key, a key holding another type reads as nil
+    return encode_array([as_bytes(value) if isinstance(value, (bytes, int)) else None for value in values])
+
+def increment_by(key, increment):
+    # INCR, INCRBY, DECR and DECRBY: the key's new value as a reply
+    with KEYSPACE.lock_keys((key,)):
+        value = KEYSPACE.get(key)
+        if value is None:
+            number = 0
+        elif type(value) is int:
+            number = value
+        elif isinstance(value, bytes):
+            number = as_int64(value)
+            if number is None:
+                return NOT_INTEGER_ERROR
+        else:
+            raise WrongTypeError()
+        number += increment
+        if not INT64_MIN <= number <= INT64_MAX:
+            return encode_error("increment or decrement would overflow")
+        KEYSPACE.set(key, number, keep_ttl=True)
+    return encode_integer(number)
+
+@command("incr", 2, "write denyoom fast", 1, 1, 1)
+def incr_command(client, args):
+    return increment_by(args[1], 1)
+
+@command("decr", 2, "write denyoom fast", 1, 1, 1)
+def decr_command(client, args):
+    return increment_by(args[1], -1)
+
+@command("incrby", 3, "write denyoom fast", 1, 1, 1)
+def incrby_command(client, args):
+    increment = parse_int(args[2])
+    if increment is None or not INT64_MIN <= increment <= INT64_MAX:
+        return NOT_INTEGER_ERROR
+    return increment_by(args[1], increment)
+
+@command("decrby", 3, "write denyoom fast", 1, 1, 1)
+def decrby_command(client, args):
+    decrement = parse_int(args[2])
+    if decrement is None or not INT64_MIN <= decrement <= INT64_MAX:
+        return NOT_INTEGER_ERROR
+    if decrement == INT64_MIN:
+        return encode_error("decrement would overflow")
+    return increment_by(args[1], -decrement)
+
+@command("incrbyfloat", 3, "write denyoom fast", 1, 1, 1)
+def incrbyfloat_command(client, args):
+    increment = parse_score(args[2])
+    if increment is None:
+        return encode_error("value is not a valid float")
+    key = args[1]
+    with KEYSPACE.lock_keys((key,)):
+        value = read_string(key)
+        number = parse_score(value) if value is not None else 0.0
+        if number is None:
+            return encode_error("value is not a valid float")
+        number += increment
+        if number != number or number in (float("inf"), float("-inf")):
+            return encode_error("increment would produce NaN or Infinity")
+        text = format_score(number)
+        KEYSPACE.set(key, text, keep_ttl=True)
+    # Logged as the value it came to, so a replay can't round differently
+    args[:] = [b"SET", key, text, b"KEEPTTL"]
+    return encode_bulk_string(text)
+
+@command("mset", -3, "write denyoom", 1, -1, 2)
+def mset_command(client, args):
+    if len(args) % 2 == 0:
+        return encode_error("wrong number of arguments for 'mset' command")
+    KEYSPACE.set_many(list(zip(args[1::2], args[2::2])))
+    return OK
+
+@command("msetnx", -3, "write denyoom", 1, -1, 2)
+def msetnx_command(client, args):
+    if len(args) % 2 == 0:
+        return encode_error("wrong number of arguments for 'msetnx' command")
+    return encode_integer(int(KEYSPACE.set_many(list(zip(args[1::2], args[2::2])), only_if_none_exist=True)))
+
+@command("del", -2, "write", 1, -1, 1)
+def del_command(client, args):
+    return encode_integer(KEYSPACE.delete_many(args[1:]))
+
+@command("unlink", -2, "write fast", 1, -1, 1)
+def unlink_command(client, args):
+    return encode_integer(KEYSPACE.delete_many(args[1:], LAZYFREE.free))
+
+@command("exists", -2, "readonly fast", 1, -1, 1)
+def exists_command(client, args):
+    return encode_integer(KEYSPACE.count_existing(args[1:]))
+
+@command("flushall", -1, "write")
+@command("flushdb", -1, "write") # There is only one database
+def flushall_command(client, args):
+    lazy = False
+    if len(args) > 2:
+        return SYNTAX_ERROR
+    if len(args) == 2:
+        option = args[1].upper()
+        if option not in (b"ASYNC", b"SYNC"):
+            return SYNTAX_ERROR
+        lazy = option == b"ASYNC"
+    if lazy:
+        LAZYFREE.free_later(KEYSPACE.flush())
+    else:
+        KEYSPACE.flush()
+    return OK
+
+@command("type", 2, "readonly fast", 1, 1, 1)
+def type_command(client, args):
+    value = KEYSPACE.get(args[1])
+    if value is None:
+        return encode_simple_string("none")
+    return encode_simple_string(value_type(value))
+
+@command("keys", 2, "readonly")
+def keys_command(client, args):
+    pattern = args[1]
+    keys = KEYSPACE.keys()
+    if pattern != b"*":
+        matches = compile_pattern(pattern)
+        keys = [key for key in keys if matches(key)]
+    return encode_array(keys)
+
+@command("scan", -2, "readonly")
+def scan_command(client, args):
+    try:
+        cursor = int(args[1])
+    except ValueError:
+        cursor = -1
+    if not 0 <= cursor < 1 << 64:
+        return encode_error("invalid cursor")
+    count = 10
+    matches = None
+    value_filter = None
+    i = 2
+    while i < len(args):
+        option = args[i].upper()
+        if i + 1 == len(args):
+            return SYNTAX_ERROR
+        if option == b"COUNT":
+            try:
+                count = int(args[i+1])
+            except ValueError:
+                return NOT_INTEGER_ERROR
+            if count < 1:
+                return SYNTAX_ERROR
+        elif option == b"MATCH":
+            if args[i+1] != b"*":
+                matches = compile_pattern(args[i+1])
+        elif option == b"TYPE":
+            type_name = args[i+1].decode(errors="replace").lower()
+            value_filter = lambda value: value_type(value) == type_name
+        else:
+            return SYNTAX_ERROR
+        i += 2
+
+    cursor, keys = KEYSPACE.scan(cursor, count, value_filter)
+    if matches is not None:
+        keys = [key for key in keys if matches(key)]
+    return encode_array([b"%d" % cursor, keys])
+
+def read_value(key, value_class):
+    """
+    Returns the value of `key` if it is a `value_class`, None if the key is
+    missing; raises WrongTypeError if it holds anything else.
+    """
+    value = KEYSPACE.get(key)
+    if value is not None and not isinstance(value, value_class):
+        raise WrongTypeError()
+    return value
+
+def parse_int(arg):
+    try:
+        return int(arg)
+    except ValueError:
+        return None
+
+def index_range(start, stop, length):
+    """
+    Clamps an inclusive start..stop range, where negative indexes count
+    from the end, to a list of `length`. Returns None if it is empty.
+    """
+    if start < 0:
+        start += length
+    if stop < 0:
+        stop += length
+    start = max(start, 0)
+    stop = min(stop, length - 1)
+    if start > stop:
+        return None
+    return start, stop
+
+def parse_score(arg):
+    try:
+        score = float(arg)
+    except ValueError:
+        return None
+    return None if score != score else score # NaN is not a score
+
+def parse_score_bound(arg):
+    # ZRANGEBYSCORE-style bound: "1.5", "(1.5" (exclusive), "-inf", "+inf"
+    exclusive = arg.startswith(b"(")
+    score = parse_score(arg[1:] if exclusive else arg)
+    return None if score is None else (score, exclusive)
+
+def format_score(score):
+    if score.is_integer() and abs(score) < 1 << 53:
+        return b"%d" % score
+    return repr(score).encode()
+
+# Hashes
+
+@command("hset", -4, "write denyoom fast", 1, 1, 1)
+def hset_command(client, args):
+    if len(args) % 2:
+        return encode_error("wrong number of arguments for 'hset' command")
+    with KEYSPACE.update(args[1], Hash) as value:
+        added = sum(value.set(field, field_value) for field, field_value in zip(args[2::2], args[3::2]))
+    return encode_integer(added)
+
+@command("hsetnx", 4, "write denyoom fast", 1, 1, 1)
+def hsetnx_command(client, args):
+    with KEYSPACE.update(args[1], Hash) as value:
+        if args[2] in value:
+            KEYSPACE.unchanged(args[1])
+            return ZERO
+        value.set(args[2], args[3])
+    return ONE
+
+@command("hget", 3, "readonly fast", 1, 1, 1)
+def hget_command(client, args):
+    value = read_value(args[1], Hash)
+    return encode_bulk_string(value.get(args[2]) if value is not None else None)
+
+@command("hmget", -3, "readonly fast", 1, 1, 1)
+def hmget_command(client, args):
+    value = read_value(args[1], Hash)
+    if value is None:
+        return encode_array([None] * (len(args) - 2))
+    return encode_array([value.get(field) for field in args[2:]])
+
+@command("hdel", -3, "write fast", 1, 1, 1)
+def hdel_command(client, args):
+    with KEYSPACE.update(args[1], Hash, create=False) as value:
+        if value is None:
+            return ZERO
+        deleted = sum(value.delete(field) for field in args[2:])
+        if not deleted:
+            KEYSPACE.unchanged(args[1])
+    return encode_integer(deleted)
+
+@command("hlen", 2, "readonly fast", 1, 1, 1)
+def hlen_command(client, args):
+    value = read_value(args[1], Hash)
+    return encode_integer(len(value) if value is not None else 0)
+
+@command("hexists", 3, "readonly fast", 1, 1, 1)
+def hexists_command(client, args):
+    value = read_value(args[1], Hash)
+    return ONE if value is not None and args[2] in value else ZERO
+
+@command("hgetall", 2, "readonly", 1, 1, 1)
+def hgetall_command(client, args):
+    value = read_value(args[1], Hash)
+    return encode_array([item for pair in value.items() for item in pair] if value is not None else [])
+
+@command("hkeys", 2, "readonly", 1, 1, 1)
+def hkeys_command(client, args):
+    value = read_value(args[1], Hash)
+    return encode_array([field for field, _ in value.items()] if value is not None else [])
+
+@command("hvals", 2, "readonly", 1, 1, 1)
+def hvals_command(client, args):
+    value = read_value(args[1], Hash)
+    return encode_array([field_value for _, field_value in value.items()] if value is not None else [])
+
+@command("hincrby", 4, "write denyoom fast", 1, 1, 1)
+def hincrby_command(client, args):
+    increment = parse_int(args[3])
+    if increment is None:
+        return NOT_INTEGER_ERROR
+    with KEYSPACE.update(args[1], Hash) as value:
+        current = value.get(args[2])
+        number = as_int64(current) if current is not None else 0
+        if number is None:
+            KEYSPACE.unchanged(args[1])
+            return encode_error("hash value is not an integer")
+        number += increment
+        if not INT64_MIN <= number <= INT64_MAX:
+            KEYSPACE.unchanged(args[1])
+            return encode_error("increment or decrement would overflow")
+        value.set(args[2], b"%d" % number)
+    return encode_integer(number)
+
+# Lists
+
+@command("lpush", -3, "write denyoom fast", 1, 1, 1)
+def lpush_command(client, args):
+    with KEYSPACE.update(args[1], List) as value:
+        value.push(args[2:], left=True)
+        return encode_integer(len(value))
+
+@command("rpush", -3, "write denyoom fast", 1, 1, 1)
+def rpush_command(client, args):
+    with KEYSPACE.update(args[1], List) as value:
+        value.push(args[2:])
+        return encode_integer(len(value))
+
+def pop_command(args, left):
+    count = None
+    if len(args) > 3:
+        return SYNTAX_ERROR
+    if len(args) == 3:
+        count = parse_int(args[2])
+        if count is None or count < 0:
+            return encode_error("value is out of range, must be positive")
+    with KEYSPACE.update(args[1], List, create=False) as value:
+        if value is None:
+            return NULL_ARRAY if count is not None else encode_bulk_string(None)
+        items = value.pop(1 if count is None else count, left)
+    return encode_array(items) if count is not None else encode_bulk_string(items[0])
+
+@command("lpop", -2, "write fast", 1, 1, 1)
+def lpop_command(client, args):
+    return pop_command(args, left=True)
+
+@command("rpop", -2, "write fast", 1, 1, 1)
+def rpop_command(client, args):
+    return pop_command(args, left=False)
+
+@command("llen", 2, "readonly fast", 1, 1, 1)
+def llen_command(client, args):
+    value = read_value(args[1], List)
+    return encode_integer(len(value) if value is not None else 0)
+
+@command("lrange", 4, "readonly", 1, 1, 1)
+def lrange_command(client, args):
+    start, stop = parse_int(args[2]), parse_int(args[3])
+    if start is None or stop is None:
+        return NOT_INTEGER_ERROR
+    value = read_value(args[1], List)
+    bounds = index_range(start, stop, len(value)) if value is not None else None
+    return encode_array(value.range(*bounds) if bounds else [])
+
+@command("lindex", 3, "readonly", 1, 1, 1)
+def lindex_command(client, args):
+    index = parse_int(args[2])
+    if index is None:
+        return NOT_INTEGER_ERROR
+    value = read_value(args[1], List)
+    if value is None or not -len(value) <= index < len(value):
+        return encode_bulk_string(None)
+    return encode_bulk_string(value[index])
+
+@command("lset", 4, "write denyoom", 1, 1, 1)
+def lset_command(client, args):
+    index = parse_int(args[2])
+    if index is None:
+        return NOT_INTEGER_ERROR
+    with KEYSPACE.update(args[1], List, create=False) as value:
+        if value is None:
+            return encode_error("no such key")
+        if not -len(value) <= index < len(value):
+            KEYSPACE.unchanged(args[1])
+            return encode_error("index out of range")
+        value[index] = args[3]
+    return OK
+
+# Sets
+
+@command("sadd", -3, "write denyoom fast", 1, 1, 1)
+def sadd_command(client, args):
+    with KEYSPACE.update(args[1], Set) as value:
+        added = sum(value.add(member) for member in args[2:])
+        if not added:
+            KEYSPACE.unchanged(args[1])
+    return encode_integer(added)
+
+@command("srem", -3, "write fast", 1, 1, 1)
+def srem_command(client, args):
+    with KEYSPACE.update(args[1], Set, create=False) as value:
+        if value is None:
+            return ZERO
+        removed = sum(value.remove(member) for member in args[2:])
+        if not removed:
+            KEYSPACE.unchanged(args[1])
+    return encode_integer(removed)
+
+@command("sismember", 3, "readonly fast", 1, 1, 1)
+def sismember_command(client, args):
+    value = read_value(args[1], Set)
+    return ONE if value is not None and args[2] in value else ZERO
+
+@command("smembers", 2, "readonly", 1, 1, 1)
+def smembers_command(client, args):
+    value = read_value(args[1], Set)
+    return encode_array(list(value) if value is not None else [])
+
+@command("scard", 2, "readonly fast", 1, 1, 1)
+def scard_command(client, args):
+    value = read_value(args[1], Set)
+    return encode_integer(len(value) if value is not None else 0)
+
+# Sorted sets
+
+@command("zadd", -4, "write denyoom fast", 1, 1, 1)
+def zadd_command(client, args):
+    i = 2
+    flags = set()
+    while i < len(args) and args[i].upper() in (b"NX", b"XX", b"CH"):
+        flags.add(args[i].upper())
+        i += 1
+    pairs = args[i:]
+    if not pairs or len(pairs) % 2:
+        return SYNTAX_ERROR
+    if b"NX" in flags and b"XX" in flags:
+        return encode_error("XX and NX options at the same time are not compatible")
+    scores = [parse_score(score) for score in pairs[::2]]
+    if None in scores:
+        return encode_error("value is not a valid float")
+    added = changed = 0
+    with KEYSPACE.update(args[1], ZSet) as value:
+        for score, member in zip(scores, pairs[1::2]):
+            old = value.score(member)
+            if (old is None and b"XX" in flags) or (old is not None and b"NX" in flags):
+                continue
+            if value.add(member, score):
+                added += 1
+            elif old != score:
+                changed += 1
+        if not added and not changed:
+            KEYSPACE.unchanged(args[1])
+    return encode_integer(added + changed if b"CH" in flags else added)
+
+@command("zincrby", 4, "write denyoom fast", 1, 1, 1)
+def zincrby_command(client, args):
+    increment = parse_score(args[2])
+    if increment is None:
+        return encode_error("value is not a valid float")
+    with KEYSPACE.update(args[1], ZSet) as value:
+        score = (value.score(args[3]) or 0.0) + increment
+        if score != score:
+            KEYSPACE.unchanged(args[1])
+            return encode_error("resulting score is not a number (NaN)")
+        value.add(args[3], score)
+    return encode_bulk_string(format_score(score))
+
+@command("zscore", 3, "readonly fast", 1, 1, 1)
+def zscore_command(client, args):
+    value = read_value(args[1], ZSet)
+    score = value.score(args[2]) if value is not None else None
+    return encode_bulk_string(format_score(score) if score is not None else None)
+
+@command("zrem", -3, "write fast", 1, 1, 1)
+def zrem_command(client, args):
+    with KEYSPACE.update(args[1], ZSet, create=False) as value:
+        if value is None:
+            return ZERO
+        removed = sum(value.remove(member) for member in args[2:])
+        if not removed:
+            KEYSPACE.unchanged(args[1])
+    return encode_integer(removed)
+
+@command("zcard", 2, "readonly fast", 1, 1, 1)
+def zcard_command(client, args):
+    value = read_value(args[1], ZSet)
+    return encode_integer(len(value) if value is not None else 0)
+
+@command("zrank", 3, "readonly fast", 1, 1, 1)
+def zrank_command(client, args):
+    value = read_value(args[1], ZSet)
+    rank = value.rank(args[2]) if value is not None else None
+    return encode_bulk_string(None) if rank is None else encode_integer(rank)
+
+def encode_scored(entries, with_scores):
+    if with_scores:
+        return encode_array([item for score, member in entries for item in (member, format_score(score))])
+    return encode_array([member for _, member in entries])
+
+@command("zrange", -4, "readonly", 1, 1, 1)
+def zrange_command(client, args):
+    start, stop = parse_int(args[2]), parse_int(args[3])
+    if start is None or stop is None:
+        return NOT_INTEGER_ERROR
+    if len(args) > 5 or (len(args) == 5 and args[4].upper() != b"WITHSCORES"):
+        return SYNTAX_ERROR
+    value = read_value(args[1], ZSet)
+    bounds = index_range(start, stop, len(value)) if value is not None else None
+    return encode_scored(value.entries(bounds[0], bounds[1] + 1) if bounds else [], len(args) == 5)
+
+@command("zrangebyscore", -4, "readonly", 1, 1, 1)
+def zrangebyscore_command(client, args):
+    low, high = parse_score_bound(args[2]), parse_score_bound(args[3])
+    if low is None or high is None:
+        return encode_error("min or max is not a float")
+    with_scores = False
+    offset, count = 0, -1
+    i = 4
+    while i < len(args):
+        option = args[i].upper()
+        if option == b"WITHSCORES":
+            with_scores = True
+            i += 1
+        elif option == b"LIMIT" and i + 2 < len(args):
+            offset, count = parse_int(args[i + 1]), parse_int(args[i + 2])
+            if offset is None or count is None:
+                return NOT_INTEGER_ERROR
+            i += 3
+        else:
+            return SYNTAX_ERROR
+    value = read_value(args[1], ZSet)
+    if value is None or offset < 0:
+        return encode_array([])
+    start, stop = value.score_bounds(low[0], high[0], low[1], high[1])
+    start += offset
+    if count >= 0:
+        stop = min(stop, start + count)
+    return encode_scored(value.entries(start, stop), with_scores)
+
+@command("zcount", 4, "readonly fast", 1, 1, 1)
+def zcount_command(client, args):
+    low, high = parse_score_bound(args[2]), parse_score_bound(args[3])
+    if low is None or high is None:
+        return encode_error("min or max is not a float")
+    value = read_value(args[1], ZSet)
+    if value is None:
+        return ZERO
+    start, stop = value.score_bounds(low[0], high[0], low[1], high[1])
+    return encode_integer(stop - start)
+
+# Keys
+
+# The unit of each EXPIRE command's time, as the SET option of that unit
+EXPIRE_COMMANDS = {b"expire": b"EX", b"pexpire": b"PX", b"expireat": b"EXAT", b"pexpireat": b"PXAT"}
+
+@command("expire", -3, "write fast", 1, 1, 1)
+@command("pexpire", -3, "write fast", 1, 1, 1)
+@command("expireat", -3, "write fast", 1, 1, 1)
+@command("pexpireat", -3, "write fast", 1, 1, 1)
+def expire_command(client, args):
+    key = args[1]
+    name = args[0].lower()
+    n = parse_int(args[2])
+    if n is None:
+        return NOT_INTEGER_ERROR
+    expire_at = expire_at_ms(EXPIRE_COMMANDS[name], n)
+    if expire_at is None:
+        return encode_error(f"invalid expire time in '{name.decode()}' command")
+    flags = set()
+    for arg in args[3:]:
+        flag = arg.upper()
+        if flag not in (b"NX", b"XX", b"GT", b"LT"):
+            return encode_error(f"Unsupported option {arg.decode(errors='replace')}")
+        flags.add(flag)
+    if b"NX" in flags and len(flags) > 1:
+        return encode_error("NX and XX, GT or LT options at the same time are not compatible")
+    if b"GT" in flags and b"LT" in flags:
+        return encode_error("GT and LT options at the same time are not compatible")
+    # Logged as an absolute time so a replay doesn't extend it
+    args[:] = [b"PEXPIREAT", key, b"%d" % expire_at] + args[3:]
+
+    with KEYSPACE.lock_keys((key,)):
+        current = KEYSPACE.expire_time(key)
+        if current == -2:
+            return ZERO
+        # No TTL counts as an infinite one for GT and LT
+        if ((b"NX" in flags and current != -1) or (b"XX" in flags and current == -1)
+                or (b"GT" in flags and (current == -1 or expire_at <= current))
+                or (b"LT" in flags and current != -1 and expire_at >= current)):
+            return ZERO
+        if expire_at <= KEYSPACE.now_ms():
+            KEYSPACE.delete(key)
+            args[:] = [b"DEL", key]
         else:
-            if key in EXPIRY_STORE:
-                del EXPIRY_STORE[key] # Remove old expiry if overwriting
-                
-        return encode_simple_string("OK")
-        
-    if cmd == "GET":
-        if len(args) < 2:
-            return encode_error("wrong number of arguments for 'get' command")
-        key = args[1]
-        
-        if key in EXPIRY_STORE:
-            if time.time() * 1000 > EXPIRY_STORE[key]:
-                del DATA_STORE[key]
-                del EXPIRY_STORE[key]
-                return encode_bulk_string(None)
-                
-        val = DATA_STORE.get(key)
-        return encode_bulk_string(val)
-        
-    if cmd == "KEYS":
-        if len(args) < 2:
-            return encode_error("wrong number of arguments for 'keys' command")
-        pattern = args[1]
-        keys = []
-        if pattern == "*":
-            keys = list(DATA_STORE.keys())
-        return encode_array(keys)
-
-    if cmd == "SAVE":
-        import os
-        from app.rdb_parser import save_rdb
-        db_path = os.path.join(SERVER_CONFIG.get("dir", "."), SERVER_CONFIG.get("dbfilename", "dump.rdb"))
+            KEYSPACE.expire(key, expire_at)
+    return ONE
+
+@command("persist", 2, "write fast", 1, 1, 1)
+def persist_command(client, args):
+    return ONE if KEYSPACE.persist(args[1]) else ZERO
+
+@command("ttl", 2, "readonly fast", 1, 1, 1)
+@command("pttl", 2, "readonly fast", 1, 1, 1)
+def ttl_command(client, args):
+    expire_at = KEYSPACE.expire_time(args[1])
+    if expire_at < 0:
+        return encode_integer(expire_at)
+    ms = max(0, expire_at - KEYSPACE.now_ms())
+    return encode_integer(ms if args[0].lower() == b"pttl" else (ms + 500) // 1000)
+
+@command("object", -2, "readonly", 2, 2, 1)
+def object_command(client, args):
+    if args[1].upper() != b"ENCODING" or len(args) != 3:
+        return encode_error(f"unknown subcommand '{args[1].decode(errors='replace')}'. Try OBJECT HELP.")
+    value = KEYSPACE.get(args[2])
+    if value is None:
+        return encode_bulk_string(None)
+    if type(value) is int:
+        return encode_bulk_string("int")
+    return encode_bulk_string(string_encoding(value) if isinstance(value, bytes) else value.encoding)
+
+# Transactions. MULTI starts queueing a client's commands and EXEC runs
+# the queue with the keys of every command locked, so no other client's
+# command lands in between, in any I/O mode. WATCH is optimistic locking:
+# EXEC does nothing if a watched key has changed since, which the keyspace
+# tells by a version it keeps for each watched key.
+
+@command("multi", 1, "fast loading stale")
+def multi_command(client, args):
+    if client is None:
+        return encode_error("MULTI needs a client connection")
+    if client.multi is not None:
+        return encode_error("MULTI calls can not be nested")
+    client.multi = []
+    return OK
+
+@command("discard", 1, "fast loading stale")
+def discard_command(client, args):
+    if client is None or client.multi is None:
+        return encode_error("DISCARD without MULTI")
+    discard_transaction(client)
+    return OK
+
+def discard_transaction(client):
+    client.multi = None
+    client.multi_error = False
+    unwatch_all(client)
+
+@command("watch", -2, "fast loading stale", 1, -1, 1)
+def watch_command(client, args):
+    if client is None:
+        return encode_error("WATCH needs a client connection")
+    if client.multi is not None:
+        return encode_error("WATCH inside MULTI is not allowed")
+    for key in args[1:]:
+        if key not in client.watched:
+            client.watched[key] = KEYSPACE.watch(key)
+    return OK
+
+@command("unwatch", 1, "fast loading stale")
+def unwatch_command(client, args):
+    if client is not None:
+        unwatch_all(client)
+    return OK
+
+def unwatch_all(client):
+    for key in client.watched:
+        KEYSPACE.unwatch(key)
+    client.watched = {}
+
+@command("exec", 1, "loading stale")
+def exec_command(client, args):
+    if client is None or client.multi is None:
+        return encode_error("EXEC without MULTI")
+    queued, client.multi = client.multi, None
+    try:
+        if client.multi_error:
+            return EXECABORT_ERROR
+        commands = [(lookup_command(queued_args[0]), queued_args) for queued_args in queued]
+        keys = list(client.watched)
+        # A command without keys (FLUSHALL, KEYS, SCAN, DBSIZE...) may go
+        # through every shard, which under the locks of some would take the
+        # others out of order: then all of them are locked up front
+        keyless = False
+        for cmd, queued_args in commands:
+            keys += command_keys(cmd, queued_args)
+            keyless = keyless or not cmd.first_key
+        with KEYSPACE.lock_all() if keyless else KEYSPACE.lock_keys(keys):
+            if any(KEYSPACE.version(key) != version for key, version in client.watched.items()):
+                return NULL_ARRAY
+            client.in_exec = True
+            client.exec_opened = set()
+            try:
+                replies = [handle_command(queued_args, client) for queued_args in queued]
+            finally:
+                client.in_exec = False
+            # Close the transaction wherever propagate() opened it: nowhere
+            # if none of its commands changed anything
+            opened = client.exec_opened
+            feed_streams(EXEC_COMMAND, client, "aof" in opened, "replicas" in opened)
+    finally:
+        client.multi_error = False
+        unwatch_all(client)
+    return b"*%d\r\n" % len(replies) + b"".join(replies)
+
+# Pub/Sub. PUBLISH hands each subscriber the same encoded message, added
+# to its output buffer for the event loop to write out.
+
+def pubsub_needs_event_loop(client):
+    # Other clients' output is only written out by the event loop
+    return client is None or SERVER_CONFIG.get("io-mode") == "threaded"
+
+@command("subscribe", -2, "loading stale")
+@command("psubscribe", -2, "loading stale")
+def subscribe_command(client, args):
+    if pubsub_needs_event_loop(client):
+        return encode_error("pub/sub needs --io-mode eventloop")
+    pattern = args[0].lower() == b"psubscribe"
+    subscribe = PUBSUB.psubscribe if pattern else PUBSUB.subscribe
+    kind = b"psubscribe" if pattern else b"subscribe"
+    encode = encode_push if client.resp == 3 else encode_array
+    replies = []
+    for name in args[1:]:
+        subscribe(client, name)
+        replies.append(encode([kind, name, len(client.channels) + len(client.patterns)]))
+    return b"".join(replies)
+
+@command("unsubscribe", -1, "loading stale")
+@command("punsubscribe", -1, "loading stale")
+def unsubscribe_command(client, args):
+    if client is None:
+        return encode_error("pub/sub needs --io-mode eventloop")
+    pattern = args[0].lower() == b"punsubscribe"
+    unsubscribe = PUBSUB.punsubscribe if pattern else PUBSUB.unsubscribe
+    kind = b"punsubscribe" if pattern else b"unsubscribe"
+    # Without arguments, from everything subscribed to
+    names = args[1:] or sorted(client.patterns if pattern else client.channels)
+    encode = encode_push if client.resp == 3 else encode_array
+    if not names:
+        return encode([kind, None, len(client.channels) + len(client.patterns)])
+    replies = []
+    for name in names:
+        unsubscribe(client, name)
+        replies.append(encode([kind, name, len(client.channels) + len(client.patterns)]))
+    return b"".join(replies)
+
+@command("publish", 3, "loading stale fast")
+def publish_command(client, args):
+    receivers = PUBSUB.publish(args[1], args[2], deliver_message)
+    # As in Redis, the replicas' subscribers get the message too; it is not
+    # data, so the AOF does not. A replica's stream is its master's alone:
+    # what its master publishes reaches its own replicas through
+    # process_master_command(), and what its clients publish stays local.
+    if REPLICATION["backlog"] is not None and REPLICATION["master_host"] is None:
+        propagate(args, client, aof=False)
+    return encode_integer(receivers)
+
+def deliver_message(client, data):
+    """
+    Adds a published message (or an invalidation) to a client's output. A subscriber too far
+    behind is disconnected instead, with whatever it had not read yet.
+    """
+    client.outbuf += data
+    PENDING_WRITES.add(client)
+    hard, soft, seconds = PUBSUB_OUTPUT_BUFFER_LIMIT
+    pending = client.pending_output()
+    if soft and pending > soft:
+        now = time.monotonic()
+        if client.soft_limit_since is None:
+            client.soft_limit_since = now
+        over_soft = now - client.soft_limit_since >= seconds
+    else:
+        client.soft_limit_since = None
+        over_soft = False
+    if (hard and pending > hard) or over_soft:
+        print(f"Client {client.addr} scheduled to be closed for overcoming of output buffer limits")
+        STATS["client_output_buffer_limit_disconnections"] += 1
+        PUBSUB.unsubscribe_all(client)
+        client.outbuf.clear()
+        client.sent = 0
+        client.close_after_reply = True
+
+@command("pubsub", -2, "loading stale")
+def pubsub_command(client, args):
+    sub = args[1].upper()
+    if sub == b"CHANNELS" and len(args) <= 3:
+        channels = list(PUBSUB.channels)
+        if len(args) == 3:
+            matches = compile_pattern(args[2])
+            channels = [channel for channel in channels if matches(channel)]
+        return encode_array(channels)
+    if sub == b"NUMSUB":
+        return encode_array([item for channel in args[2:] for item in (channel, PUBSUB.numsub(channel))])
+    if sub == b"NUMPAT" and len(args) == 2:
+        return encode_integer(len(PUBSUB.patterns))
+    return encode_error(f"unknown subcommand '{args[1].decode(errors='replace')}'. Try PUBSUB HELP.")
+
+# Connections. HELLO picks the protocol: RESP3 clients get maps and push
+# messages, which is what lets a tracking client read invalidations on
+# its own connection.
+
+def valid_client_name(name):
+    return all(33 <= c <= 126 for c in name)
+
+@command("hello", -1, "fast loading stale")
+def hello_command(client, args):
+    if client is None:
+        return encode_error("HELLO needs a client connection")
+    resp, name = client.resp, None
+    if len(args) > 1:
+        resp = parse_int(args[1])
+        if resp is None:
+            return encode_error("Protocol version is not an integer or out of range")
+        if resp not in (2, 3):
+            return b"-NOPROTO unsupported protocol version\r\n"
+    i = 2
+    while i < len(args):
+        option = args[i].upper()
+        if option == b"AUTH" and i + 2 < len(args):
+            # There are no users but the default one, without a password
+            if args[i + 1] != b"default":
+                return b"-WRONGPASS invalid username-password pair or user is disabled.\r\n"
+            i += 3
+        elif option == b"SETNAME" and i + 1 < len(args):
+            name = args[i + 1]
+            if not valid_client_name(name):
+                return encode_error("Client names cannot contain spaces, newlines or special characters.")
+            i += 2
+        else:
+            return encode_error(f"Syntax error in HELLO option '{args[i].decode(errors='replace')}'")
+    client.resp = resp
+    if name is not None:
+        client.name = name
+    info = {
+        b"server": b"redis",
+        b"version": REDIS_VERSION,
+        b"proto": resp,
+        b"id": client.id,
+        b"mode": b"standalone" if CLUSTER is None else b"cluster",
+        b"role": b"master" if REPLICATION["master_host"] is None else b"replica",
+        b"modules": [],
+    }
+    if resp == 3:
+        return encode_map(info)
+    return encode_array([item for pair in info.items() for item in pair])
+
+@command("client", -2, "loading stale")
+def client_command(client, args):
+    if client is None:
+        return encode_error("CLIENT needs a client connection")
+    sub = args[1].upper()
+    if sub == b"ID" and len(args) == 2:
+        return encode_integer(client.id)
+    if sub == b"GETNAME" and len(args) == 2:
+        return encode_bulk_string(client.name or None)
+    if sub == b"SETNAME" and len(args) == 3:
+        if not valid_client_name(args[2]):
+            return encode_error("Client names cannot contain spaces, newlines or special characters.")
+        client.name = args[2]
+        return OK
+    if sub == b"TRACKING" and len(args) >= 3:
+        return client_tracking(client, args)
+    if sub == b"CACHING" and len(args) == 3:
+        return client_caching(client, args[2].upper())
+    if sub == b"GETREDIR" and len(args) == 2:
+        return encode_integer(client.tracking_redirect if client.tracking else -1)
+    return encode_error(f"unknown subcommand '{args[1].decode(errors='replace')}'. Try CLIENT HELP.")
+
+# Client-side caching (CLIENT TRACKING). In the default mode the server
+# remembers which keys each tracking client read; in BCAST mode, which key
+# prefixes it wants to hear about. Every change to a key, whether a write,
+# an expiry, an eviction or a flush, reaches invalidate_key() through the
+# keyspace's on_change hook, which is only set while someone is tracking.
+# The invalidation is a push on the client's own connection under RESP3,
+# or a message on __redis__:invalidate to the RESP2 client it redirects to.
+
+def client_tracking(client, args):
+    state = args[2].upper()
+    if state not in (b"ON", b"OFF"):
+        return SYNTAX_ERROR
+    redirect, bcast, prefixes, opt, noloop = 0, False, [], None, False
+    i = 3
+    while i < len(args):
+        option = args[i].upper()
+        if option == b"REDIRECT" and i + 1 < len(args):
+            redirect = parse_int(args[i + 1])
+            if redirect is None:
+                return NOT_INTEGER_ERROR
+            i += 2
+            continue
+        if option == b"PREFIX" and i + 1 < len(args):
+            prefixes.append(args[i + 1])
+            i += 2
+            continue
+        if option == b"BCAST":
+            bcast = True
+        elif option in (b"OPTIN", b"OPTOUT"):
+            if opt is not None and opt != option:
+                return encode_error("You can't use both OPTIN and OPTOUT")
+            opt = option
+        elif option == b"NOLOOP":
+            noloop = True
+        else:
+            return SYNTAX_ERROR
+        i += 1
+    if state == b"OFF":
+        disable_tracking(client)
+        return OK
+
+    if pubsub_needs_event_loop(client):
+        return encode_error("client tracking needs --io-mode eventloop")
+    if prefixes and not bcast:
+        return encode_error("PREFIX option requires BCAST mode to be enabled")
+    if bcast and opt is not None:
+        return encode_error("OPTIN and OPTOUT are not compatible with BCAST")
+    if client.tracking and (bcast != client.tracking_bcast or opt != client.tracking_opt):
+        return encode_error("You can't switch BCAST mode on/off or OPTIN/OPTOUT before disabling tracking for "
+                            "this client, and then re-enabling it with a different mode.")
+    if redirect and redirect not in CLIENTS:
+        return encode_error("The client ID you want redirect to does not exist")
+    if bcast:
+        prefixes = [prefix for prefix in dict.fromkeys(prefixes or [b""]) if prefix not in client.tracking_prefixes]
+        # A key must not match two prefixes of the same client
+        for prefix in prefixes:
+            for other in client.tracking_prefixes + prefixes:
+                if other != prefix and (prefix.startswith(other) or other.startswith(prefix)):
+                    return encode_error(f"Prefix '{prefix.decode(errors='replace')}' overlaps with an existing "
+                                        f"prefix '{other.decode(errors='replace')}'. Prefixes for a single client "
+                                        "must not overlap.")
+    TRACKING.enable(client.id, prefixes)
+    client.tracking = True
+    client.tracking_redirect = redirect
+    client.tracking_bcast = bcast
+    client.tracking_prefixes += prefixes
+    client.tracking_opt = opt
+    client.tracking_noloop = noloop
+    client.tracking_caching = None
+    KEYSPACE.on_change = invalidate_key
+    return OK
+
+def client_caching(client, value):
+    if not client.tracking or client.tracking_opt is None:
+        return encode_error("CLIENT CACHING can be called only when the client is in tracking mode with OPTIN or "
+                            "OPTOUT mode enabled")
+    if value == b"YES" and client.tracking_opt == b"OPTIN":
+        client.tracking_caching = True
+    elif value == b"NO" and client.tracking_opt == b"OPTOUT":
+        client.tracking_caching = False
+    elif value in (b"YES", b"NO"):
+        return encode_error(f"CLIENT CACHING {value.decode()} is only valid when tracking is enabled in "
+                            f"{'OPTIN' if value == b'YES' else 'OPTOUT'} mode.")
+    else:
+        return SYNTAX_ERROR
+    return OK
+
+def disable_tracking(client):
+    if not client.tracking:
+        return
+    TRACKING.disable(client.id, client.tracking_prefixes)
+    client.tracking = False
+    client.tracking_redirect = 0
+    client.tracking_bcast = False
+    client.tracking_prefixes = []
+    client.tracking_opt = None
+    client.tracking_noloop = False
+    client.tracking_caching = None
+    if not TRACKING.clients:
+        KEYSPACE.on_change = None
+
+def invalidate_key(key):
+    """
+    The keyspace's on_change hook: tells the clients that may have cached
+    `key` (None: every key, on a flush) that it changed.
+    """
+    ids = TRACKING.flushed() if key is None else TRACKING.changed(key)
+    if ids:
+        send_invalidation(ids, None if key is None else [key])
+
+def send_invalidation(ids, keys):
+    """
+    Sends an invalidation of `keys` (None: all of them) to the tracking
+    clients with these IDs, encoded once for each protocol.
+    """
+    payload = encode_array(keys) if keys is not None else None
+    push = b">2\r\n$10\r\ninvalidate\r\n" + (payload or RESP3_NULL)
+    message = b"*3\r\n$7\r\nmessage\r\n$20\r\n__redis__:invalidate\r\n" + (payload or NULL_BULK)
+    for client_id in ids:
+        client = CLIENTS.get(client_id)
+        # IDs of clients that turned tracking off linger in the table
+        if client is None or not client.tracking:
+            continue
+        if client.tracking_noloop and client is TRACKING.writer:
+            continue
+        target = client
+        if client.tracking_redirect:
+            target = CLIENTS.get(client.tracking_redirect)
+            if target is None:
+                if client.resp == 3:
+                    deliver_message(client, encode_push([b"tracking-redir-broken", client.tracking_redirect]))
+                continue
+        if target.resp == 3:
+            deliver_message(target, push)
+        elif target.channels or target.patterns:
+            deliver_message(target, message)
+
+def worker_filename(filename, port):
+    # Each --workers process keeps its own files: dump.rdb -> dump-6380.rdb
+    root, ext = os.path.splitext(filename)
+    return f"{root}-{port}{ext}"
+
+def rdb_path():
+    return os.path.join(SERVER_CONFIG.get("dir", "."), SERVER_CONFIG.get("dbfilename", "dump.rdb"))
+
+def parse_save_rules(value):
+    """
+    Parses a "save" setting ("<seconds> <changes> [<seconds> <changes> ...]")
+    into a list of (seconds, changes) pairs.
+    """
+    parts = value.split()
+    if len(parts) % 2:
+        raise ValueError(f"invalid save rules {value!r}")
+    return [(int(parts[i]), int(parts[i + 1])) for i in range(0, len(parts), 2)]
+
+def rdb_compression():
+    return SERVER_CONFIG.get("rdb-compression") == "yes"
+
+def rdb_checksum():
+    # Whether saves compute the CRC64 trailer; loads check any they find
+    return SERVER_CONFIG.get("rdb-checksum", "no") == "yes"
+
+def log_save_stats(stats, what="DB saved on disk"):
+    keys, size, seconds = stats
+    seconds = max(seconds, 1e-9)
+    print(f"{what}: {keys} keys, {size / 1e6:.2f} MB in {seconds:.3f}s "
+          f"({keys / seconds:.0f} keys/s, {size / 1e6 / seconds:.2f} MB/s)")
+
+def bgsave_in_progress():
+    return PERSISTENCE["child_pid"] is not None or PERSISTENCE["child_thread"] is not None
+
+def start_background_save():
+    """
+    Starts writing the dataset, as it is right now, to the RDB file without
+    blocking the server. With fork() the child writes from its copy-on-write
+    view of memory; elsewhere a snapshot is copied and written by a thread.
+    Returns an error message, or None once the save has started.
+    """
+    with PERSISTENCE_LOCK:
+        if bgsave_in_progress():
+            return "Background save already in progress"
+        if aof_rewrite_in_progress():
+            return "Another child process is active (AOF?): can't BGSAVE right now"
+        PERSISTENCE["last_bgsave_try"] = time.time()
+        db_path = rdb_path()
+
+        if not hasattr(os, "fork"):
+            with KEYSPACE.lock_all():
+                items = KEYSPACE.snapshot()
+                attach_replicas_to_save()
+            PERSISTENCE["dirty_before_bgsave"] = KEYSPACE.dirty()
+            thread = threading.Thread(target=background_save_thread, args=(db_path, items), daemon=True)
+            PERSISTENCE["child_thread"] = thread
+            PERSISTENCE["bgsave_start"] = time.time()
+            thread.start()
+            print("Background saving started in a thread")
+            return None
+
+        sys.stdout.flush()
+        start = time.perf_counter()
+        # Keep the collector from touching (and so copying) every page the
+        # child shares with us.
+        gc.freeze()
+        # Holding every shard lock makes the fork a consistent point in time
+        with KEYSPACE.lock_all():
+            dirty = KEYSPACE.dirty()
+            attach_replicas_to_save()
+            pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                # The child is single-threaded, so no locks are needed
+                log_save_stats(save_rdb(db_path, KEYSPACE.items(), rdb_compression(), rdb_checksum()))
+            except Exception as e:
+                print(f"Background save failed: {e}")
+                exit_code = 1
+            sys.stdout.flush()
+            os._exit(exit_code)
+
+        gc.unfreeze()
+        STATS["latest_fork_usec"] = int((time.perf_counter() - start) * 1000000)
+        LATENCY.add_sample("fork", STATS["latest_fork_usec"] // 1000)
+        PERSISTENCE["child_pid"] = pid
+        PERSISTENCE["dirty_before_bgsave"] = dirty
+        PERSISTENCE["bgsave_start"] = time.time()
+        print(f"Background saving started by pid {pid}")
+        return None
+
+def background_save_thread(db_path, items):
+    try:
+        log_save_stats(save_rdb(db_path, items, rdb_compression(), rdb_checksum()))
+        PERSISTENCE["child_result"] = True
+    except Exception as e:
+        print(f"Background save failed: {e}")
+        PERSISTENCE["child_result"] = False
+
+def check_background_save():
+    """
+    Reaps a finished background save and records its outcome.
+    """
+    with PERSISTENCE_LOCK:
+        if PERSISTENCE["child_pid"] is not None:
+            pid, status = os.waitpid(PERSISTENCE["child_pid"], os.WNOHANG)
+            if pid == 0:
+                return
+            ok = os.waitstatus_to_exitcode(status) == 0
+            PERSISTENCE["child_pid"] = None
+        elif PERSISTENCE["child_thread"] is not None:
+            if PERSISTENCE["child_thread"].is_alive():
+                return
+            ok = PERSISTENCE["child_result"]
+            PERSISTENCE["child_thread"] = None
+        else:
+            return
+
+        PERSISTENCE["last_bgsave_time_sec"] = int(time.time() - PERSISTENCE["bgsave_start"])
+        PERSISTENCE["bgsave_start"] = None
+        if ok:
+            PERSISTENCE["lastsave"] = int(time.time())
+            PERSISTENCE["dirty_at_lastsave"] = PERSISTENCE["dirty_before_bgsave"]
+            PERSISTENCE["last_bgsave_status"] = "ok"
+            print("Background saving terminated with success")
+        else:
+            PERSISTENCE["last_bgsave_status"] = "err"
+            print("Background saving error")
+        send_rdb_to_replicas(ok)
+
+def load_dataset(path, append_only=False):
+    """
+    Loads the RDB file, or with `append_only` replays the AOF, into the
+    keyspace, streaming keys straight from the memory-mapped dump. Runs in
+    its own thread so clients can connect (and be told LOADING) meanwhile.
+    Keys that expired while the server was down are skipped. A corrupt file
+    stops the server.
+    """
+    LOADING["start_time"] = time.time()
+    LOADING["last_log"] = time.monotonic()
+    LOADING["total_bytes"] = os.path.getsize(path)
+    LOADING["loaded_bytes"] = 0
+    start = time.perf_counter()
+    now = KEYSPACE.now_ms()
+
+    def load_key(key, value, expire_at):
+        if expire_at is None or expire_at >= now:
+            KEYSPACE.set(key, from_loaded(value), expire_at)
+
+    try:
+        if append_only:
+            load_aof(path, load_key, replay_command, loading_progress)
+        else:
+            for key, value, expire_at in iter_rdb(path, loading_progress):
+                load_key(key, value, expire_at)
+    except Exception as e:
+        # A corrupt file, or a record the keyspace or a command rejects:
+        # either way the data can't be trusted, and the server must not be
+        # left LOADING forever
+        reason = e if isinstance(e, (RDBError, AOFError)) else f"{type(e).__name__}: {e}"
+        print(f"Failed to load {path} past offset {LOADING['loaded_bytes']}: {reason}")
+        sys.stdout.flush()
+        os._exit(1)
+    PERSISTENCE["dirty_at_lastsave"] = KEYSPACE.dirty()
+    if SERVER_CONFIG.get("appendonly") == "yes":
+        open_append_only_file()
+        if not append_only:
+            # Give the new AOF the data that so far only the RDB file has
+            PERSISTENCE["aof_rewrite_scheduled"] = True
+    LOADING["loading"] = False
+    keys = len(KEYSPACE)
+    seconds = max(time.perf_counter() - start, 1e-9)
+    size = LOADING["total_bytes"]
+    print(f"DB loaded from {'append only file' if append_only else 'disk'}: {keys} keys, "
+          f"{size / 1e6:.2f} MB in {seconds:.3f}s ({keys / seconds:.0f} keys/s, {size / 1e6 / seconds:.2f} MB/s)")
+
+def replay_command(args):
+    cmd = lookup_command(args[0])
+    if cmd is None:
+        raise AOFError(f"Unknown command '{args[0].decode(errors='replace')}' reading the append only file")
+    cmd.handler(None, args)
+
+def open_append_only_file():
+    global AOF
+    AOF = AppendOnlyFile(aof_path(), SERVER_CONFIG["appendfsync"])
+
+def loading_progress(loaded, total):
+    LOADING["loaded_bytes"] = loaded
+    now = time.monotonic()
+    if now - LOADING["last_log"] >= 1:
+        LOADING["last_log"] = now
+        print(f"Loading RDB: {loaded / 1e6:.1f}/{total / 1e6:.1f} MB ({100 * loaded / max(total, 1):.1f}%)")
+
+def aof_path():
+    return os.path.join(SERVER_CONFIG.get("dir", "."), SERVER_CONFIG.get("appendfilename", "appendonly.aof"))
+
+def aof_rewrite_in_progress():
+    return PERSISTENCE["aof_child_pid"] is not None or PERSISTENCE["aof_child_thread"] is not None
+
+def start_aof_rewrite():
+    """
+    Starts compacting the AOF into the commands (or, with
+    aof-use-rdb-preamble, the RDB dump) that rebuild the dataset as it is
+    right now, in a forked child or a thread like BGSAVE. Writes made
+    meanwhile are logged to the old file as usual and also buffered, and
+    the buffer is added to the new file before it replaces the old one.
+    Returns an error message, or None once the rewrite has started.
+    """
+    with PERSISTENCE_LOCK:
+        if aof_rewrite_in_progress():
+            return "Background append only file rewriting already in progress"
+        if bgsave_in_progress():
+            return "Can't BGREWRITEAOF while BGSAVE is in progress"
+        PERSISTENCE["aof_rewrite_scheduled"] = False
+        temp_filename = os.path.join(SERVER_CONFIG.get("dir", "."), f"temp-rewriteaof-bg-{os.getpid()}.aof")
+        PERSISTENCE["aof_temp_filename"] = temp_filename
+        preamble = SERVER_CONFIG.get("aof-use-rdb-preamble") == "yes"
+
+        if not hasattr(os, "fork"):
+            with KEYSPACE.lock_all():
+                items = KEYSPACE.snapshot()
+                if AOF is not None:
+                    AOF.start_rewrite()
+            thread = threading.Thread(target=aof_rewrite_thread, args=(temp_filename, items, preamble), daemon=True)
+            PERSISTENCE["aof_child_thread"] = thread
+            PERSISTENCE["aof_rewrite_start"] = time.time()
+            thread.start()
+            print("Background append only file rewriting started in a thread")
+            return None
+
+        sys.stdout.flush()
+        start = time.perf_counter()
+        gc.freeze()
+        with KEYSPACE.lock_all():
+            if AOF is not None:
+                AOF.start_rewrite()
+            pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                log_save_stats(rewrite_aof(temp_filename, KEYSPACE.items(), preamble, rdb_compression()),
+                               "Append only file rewritten")
+            except Exception as e:
+                print(f"Background AOF rewrite failed: {e}")
+                exit_code = 1
+            sys.stdout.flush()
+            os._exit(exit_code)
+
+        gc.unfreeze()
+        STATS["latest_fork_usec"] = int((time.perf_counter() - start) * 1000000)
+        LATENCY.add_sample("fork", STATS["latest_fork_usec"] // 1000)
+        PERSISTENCE["aof_child_pid"] = pid
+        PERSISTENCE["aof_rewrite_start"] = time.time()
+        print(f"Background append only file rewriting started by pid {pid}")
+        return None
+
+def aof_rewrite_thread(temp_filename, items, preamble):
+    try:
+        log_save_stats(rewrite_aof(temp_filename, items, preamble, rdb_compression()), "Append only file rewritten")
+        PERSISTENCE["aof_child_result"] = True
+    except Exception as e:
+        print(f"Background AOF rewrite failed: {e}")
+        PERSISTENCE["aof_child_result"] = False
+
+def check_aof_rewrite():
+    """
+    Reaps a finished AOF rewrite and, if it worked, swaps the new file in.
+    """
+    with PERSISTENCE_LOCK:
+        if PERSISTENCE["aof_child_pid"] is not None:
+            pid, status = os.waitpid(PERSISTENCE["aof_child_pid"], os.WNOHANG)
+            if pid == 0:
+                return
+            ok = os.waitstatus_to_exitcode(status) == 0
+            PERSISTENCE["aof_child_pid"] = None
+        elif PERSISTENCE["aof_child_thread"] is not None:
+            if PERSISTENCE["aof_child_thread"].is_alive():
+                return
+            ok = PERSISTENCE["aof_child_result"]
+            PERSISTENCE["aof_child_thread"] = None
+        else:
+            return
+
+        temp_filename = PERSISTENCE["aof_temp_filename"]
+        PERSISTENCE["aof_last_rewrite_time_sec"] = int(time.time() - PERSISTENCE["aof_rewrite_start"])
+        PERSISTENCE["aof_rewrite_start"] = None
+        if ok:
+            try:
+                if AOF is not None:
+                    AOF.finish_rewrite(temp_filename)
+                else:
+                    os.replace(temp_filename, aof_path())
+            except OSError as e:
+                print(f"Failed to install the rewritten AOF: {e}")
+                ok = False
+        if ok:
+            PERSISTENCE["aof_last_bgrewrite_status"] = "ok"
+            print("Background AOF rewrite finished successfully")
+            return
+        if AOF is not None:
+            AOF.abort_rewrite()
         try:
-             save_rdb(db_path, DATA_STORE, EXPIRY_STORE)
-             return encode_simple_string("OK")
-        except Exception as e:
-             return encode_error(str(e))
+            os.remove(temp_filename)
+        except OSError:
+            pass
+        PERSISTENCE["aof_last_bgrewrite_status"] = "err"
+        print("Background AOF rewrite terminated with error")
+
+def aof_rewrite_due():
+    # auto-aof-rewrite-percentage: growth since the last rewrite
+    percentage = int(SERVER_CONFIG.get("auto-aof-rewrite-percentage", 0))
+    if AOF is None or not percentage or AOF.size < parse_memory(SERVER_CONFIG.get("auto-aof-rewrite-min-size", "0")):
+        return False
+    return (AOF.size - AOF.base_size) * 100 >= percentage * max(AOF.base_size, 1)
 
+def flush_append_only_file():
+    if AOF is None:
+        return
+    if not LATENCY.threshold_ms:
+        AOF.flush()
+        return
+    start = time.perf_counter()
+    AOF.flush()
+    LATENCY.add_sample("aof-write", int((time.perf_counter() - start) * 1000))
 
-    return encode_simple_string("PONG") # Fallback for unknown commands in early stages or return error
+def save_rules_due():
+    changes = KEYSPACE.dirty() - PERSISTENCE["dirty_at_lastsave"]
+    elapsed = time.time() - PERSISTENCE["lastsave"]
+    if PERSISTENCE["last_bgsave_status"] != "ok" and time.time() - PERSISTENCE["last_bgsave_try"] < BGSAVE_RETRY_DELAY:
+        return False
+    return any(changes >= min_changes and elapsed >= seconds for seconds, min_changes in SAVE_RULES)
+
+@command("save", 1, "admin")
+def save_command(client, args):
+    if bgsave_in_progress():
+        return encode_error("Background save already in progress")
+    try:
+         with KEYSPACE.lock_all():
+             dirty = KEYSPACE.dirty()
+             log_save_stats(save_rdb(rdb_path(), KEYSPACE.items(), rdb_compression(), rdb_checksum()))
+         PERSISTENCE["lastsave"] = int(time.time())
+         PERSISTENCE["dirty_at_lastsave"] = dirty
+         return OK
+    except Exception as e:
+         return encode_error(str(e))
+
+@command("bgsave", -1, "admin")
+def bgsave_command(client, args):
+    error = start_background_save()
+    if error:
+        return encode_error(error)
+    return encode_simple_string("Background saving started")
+
+@command("bgrewriteaof", 1, "admin")
+def bgrewriteaof_command(client, args):
+    if aof_rewrite_in_progress():
+        return encode_error("Background append only file rewriting already in progress")
+    if bgsave_in_progress():
+        PERSISTENCE["aof_rewrite_scheduled"] = True
+        return encode_simple_string("Background append only file rewriting scheduled")
+    error = start_aof_rewrite()
+    if error:
+        return encode_error(error)
+    return encode_simple_string("Background append only file rewriting started")
+
+@command("lastsave", 1, "fast stale loading")
+def lastsave_command(client, args):
+    return encode_integer(PERSISTENCE["lastsave"])
+
+def master_repl_offset():
+    backlog = REPLICATION["backlog"]
+    return backlog.offset if backlog is not None else 0
+
+def create_backlog(offset=0):
+    REPLICATION["backlog"] = ReplicationBacklog(parse_memory(SERVER_CONFIG.get("repl-backlog-size", "1mb")), offset)
+
+def replication_feed(data):
+    """
+    Adds `data` to the replication stream: the backlog, every replica that
+    is online, and the buffers of those waiting for their RDB file.
+    """
+    REPLICATION["backlog"].feed(data)
+    for replica in REPLICAS:
+        if replica.replica_state == "online":
+            replica.outbuf += data
+            PENDING_WRITES.add(replica)
+        elif replica.replica_state == "wait_bgsave_end":
+            replica.repl_buf += data
+
+def attach_replicas_to_save():
+    # Called with every shard locked as a background save starts: the
+    # replicas waiting for a full resync get the dataset as of now, then
+    # the writes made after it
+    offset = master_repl_offset()
+    for replica in REPLICAS:
+        if replica.replica_state == "wait_bgsave_start":
+            replica.replica_state = "wait_bgsave_end"
+            replica.repl_buf = bytearray()
+            replica.outbuf += b"+FULLRESYNC %b %d\r\n" % (REPLICATION["replid"].encode(), offset)
+            PENDING_WRITES.add(replica)
+
+def send_rdb_to_replicas(ok):
+    """
+    Once a background save ends, sends the file to the replicas it was
+    made for, followed by the writes buffered for them meanwhile. If it
+    failed they are disconnected, to try again.
+    """
+    waiting = [replica for replica in REPLICAS if replica.replica_state == "wait_bgsave_end"]
+    if not waiting:
+        return
+    data = None
+    if ok:
+        try:
+            with open(rdb_path(), "rb") as f:
+                data = f.read()
+        except OSError as e:
+            print(f"Can't read the RDB file for replicas: {e}")
+    for replica in waiting:
+        if data is None:
+            replica.close_after_reply = True
+        else:
+            replica.outbuf += b"$%d\r\n" % len(data)
+            replica.outbuf += data
+            replica.outbuf += replica.repl_buf
+            replica.replica_state = "online"
+            print(f"Synchronization with replica {replica.addr[0]}:{replica.repl_listening_port} succeeded")
+        replica.repl_buf = None
+        PENDING_WRITES.add(replica)
+
+def replicas_acked(offset):
+    return sum(replica.replica_state == "online" and replica.repl_ack_offset >= offset for replica in REPLICAS)
+
+def shift_replid():
+    # A replica that becomes a master starts a new history, but its own
+    # replicas can still continue where they were in the old one
+    REPLICATION["replid2"] = REPLICATION["replid"]
+    REPLICATION["second_replid_offset"] = master_repl_offset() + 1
+    REPLICATION["replid"] = new_replid()
+
+def drop_master_link():
+    client = REPLICATION["master_client"]
+    if client is not None:
+        client.close_after_reply = True
+        PENDING_WRITES.add(client)
+    REPLICATION["master_client"] = None
+
+def start_master_sync():
+    REPLICATION["last_sync_attempt"] = time.monotonic()
+    host, port = REPLICATION["master_host"], REPLICATION["master_port"]
+    # Asking to continue our own history lets a replica of a replica that
+    # was promoted, or one that reconnects, skip the full resync
+    replid = REPLICATION["replid"] if REPLICATION["backlog"] is not None else None
+    thread = threading.Thread(target=master_sync_thread, args=(host, port, replid, master_repl_offset()), daemon=True)
+    REPLICATION["sync_thread"] = thread
+    print(f"Connecting to MASTER {host}:{port}")
+    thread.start()
+
+def master_sync_thread(host, port, replid, offset):
+    path = os.path.join(SERVER_CONFIG.get("dir", "."), f"temp-{os.getpid()}.rdb")
+    try:
+        REPLICATION["sync_result"] = sync_with_master(host, port, int(SERVER_CONFIG.get("port", 6379)), replid, offset, path)
+    except (OSError, ReplicationError, ValueError) as e:
+        print(f"Error syncing with MASTER {host}:{port}: {e}")
+    REPLICATION["sync_thread"] = None
+
+def attach_master(selector):
+    """
+    Takes over the connection a finished sync thread left: loads the
+    dataset it received, if it was a full resync, and from then on reads
+    the master's stream like a client's commands.
+    """
+    result = REPLICATION["sync_result"]
+    REPLICATION["sync_result"] = None
+    if result.master != (REPLICATION["master_host"], REPLICATION["master_port"]):
+        result.sock.close() # REPLICAOF changed meanwhile
+        return
+    if result.full:
+        try:
+            load_master_rdb(result.rdb_path)
+        except RDBError as e:
+            print(f"Failed to load the RDB file from MASTER: {e}")
+            result.sock.close()
+            return
+        # Our replicas have a history that no longer exists
+        for replica in REPLICAS:
+            replica.close_after_reply = True
+            PENDING_WRITES.add(replica)
+        create_backlog(result.offset)
+    elif result.replid != REPLICATION["replid"]:
+        # The master started a new history from where we are
+        shift_replid()
+    REPLICATION["replid"] = result.replid
+
+    sock = result.sock
+    sock.setblocking(False)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client = ClientConnection(sock, sock.getpeername())
+    client.is_master = True
+    CLIENTS[client.id] = client
+    selector.register(sock, selectors.EVENT_READ, client)
+    REPLICATION["master_client"] = client
+    print(f"MASTER <-> REPLICA sync: {'full' if result.full else 'partial'} resync at offset {result.offset} succeeded")
+    client.parser.feed(result.leftover)
+    process_input(client)
+
+def load_master_rdb(path):
+    # Replaces the dataset with the one the master sent, which then
+    # becomes our RDB file. Keys past their TTL are kept as well: the
+    # master sends a DEL for them.
+    with KEYSPACE.lock_all():
+        KEYSPACE.flush()
+        for key, value, expire_at in iter_rdb(path):
+            KEYSPACE.set(key, from_loaded(value), expire_at)
+    os.replace(path, rdb_path())
+    PERSISTENCE["dirty_at_lastsave"] = KEYSPACE.dirty()
+    if AOF is not None:
+        PERSISTENCE["aof_rewrite_scheduled"] = True
+
+def process_master_command(client, args):
+    # The master's stream is applied without replies (REPLCONF GETACK
+    # answers by itself) and passed on as it came
+    data = encode_command(args)
+    client.last_interaction = time.monotonic()
+    # Keys the stream touches are live until the master's DEL says not
+    KEYSPACE.expiry = "keep"
+    try:
+        handle_command(args, client)
+    finally:
+        KEYSPACE.expiry = "hide"
+    replication_feed(data)
+
+def unblock_clients():
+    """
+    Answers the WAITs whose replicas have acknowledged enough, or whose
+    timeout is up, and runs the commands their clients sent after them.
+    """
+    now = time.monotonic()
+    for client in list(BLOCKED_CLIENTS):
+        numreplicas, offset, deadline = client.blocked
+        acked = replicas_acked(offset)
+        if acked >= numreplicas or (deadline is not None and now >= deadline):
+            BLOCKED_CLIENTS.discard(client)
+            client.blocked = None
+            client.outbuf += encode_integer(acked)
+            process_input(client)
+            PENDING_WRITES.add(client)
+
+def replication_cron():
+    now = time.monotonic()
+    if REPLICATION["master_host"] is not None:
+        client = REPLICATION["master_client"]
+        if client is None:
+            if REPLICATION["sync_thread"] is None and REPLICATION["sync_result"] is None \
+                    and now - REPLICATION["last_sync_attempt"] >= 1:
+                start_master_sync()
+        elif now - client.last_interaction > REPL_TIMEOUT:
+            print("MASTER timeout: no data nor PING received")
+            drop_master_link()
+        elif now - REPLICATION["last_ack"] >= REPL_ACK_PERIOD:
+            REPLICATION["last_ack"] = now
+            client.outbuf += encode_command([b"REPLCONF", b"ACK", b"%d" % master_repl_offset()])
+            PENDING_WRITES.add(client)
+    elif REPLICAS and now - REPLICATION["last_ping"] >= REPL_PING_REPLICA_PERIOD:
+        REPLICATION["last_ping"] = now
+        replication_feed(encode_command([b"PING"]))
+
+    if any(replica.replica_state == "wait_bgsave_start" for replica in REPLICAS) \
+            and not bgsave_in_progress() and not aof_rewrite_in_progress():
+        start_background_save()
+
+def partial_resync_data(replid, offset):
+    # What a replica asking to continue from `offset` of `replid` missed,
+    # or None if it needs a full resync
+    if offset is None or REPLICATION["backlog"] is None:
+        return None
+    if replid != REPLICATION["replid"] and (replid != REPLICATION["replid2"] or
+                                             offset > REPLICATION["second_replid_offset"]):
+        return None
+    return REPLICATION["backlog"].since(offset)
+
+@command("psync", 3, "admin")
+def psync_command(client, args):
+    if client is None or SERVER_CONFIG.get("io-mode") == "threaded":
+        return encode_error("replication needs --io-mode eventloop")
+    if REPLICATION["master_host"] is not None and REPLICATION["master_client"] is None:
+        return b"-NOMASTERLINK Can't SYNC while not connected with my master\r\n"
+    if REPLICATION["backlog"] is None:
+        create_backlog()
+    data = partial_resync_data(args[1].decode(errors="replace"), parse_int(args[2]))
+    REPLICAS.append(client)
+    client.repl_ack_time = time.time()
+    if data is not None:
+        client.replica_state = "online"
+        print(f"Partial resynchronization request from {client.addr[0]}:{client.repl_listening_port} accepted")
+        return b"+CONTINUE %b\r\n" % REPLICATION["replid"].encode() + data
+    print(f"Full resync requested by replica {client.addr[0]}:{client.repl_listening_port}")
+    client.replica_state = "wait_bgsave_start"
+    if not bgsave_in_progress() and not aof_rewrite_in_progress():
+        start_background_save()
+    return b""
+
+@command("replconf", -1, "admin loading stale")
+def replconf_command(client, args):
+    if len(args) % 2 == 0:
+        return SYNTAX_ERROR
+    for i in range(1, len(args), 2):
+        option, value = args[i].lower(), args[i + 1]
+        if option == b"listening-port":
+            port = parse_int(value)
+            if port is None:
+                return NOT_INTEGER_ERROR
+            if client is not None:
+                client.repl_listening_port = port
+        elif option == b"capa":
+            pass
+        elif option == b"ack":
+            # From a replica: how much of the stream it has processed. Never answered.
+            offset = parse_int(value)
+            if client is not None and client.replica_state is not None and offset is not None:
+                client.repl_ack_offset = max(client.repl_ack_offset, offset)
+                client.repl_ack_time = time.time()
+            return b""
+        elif option == b"getack":
+            # From our master, which wants an ACK now
+            if client is not None and client.is_master:
+                client.outbuf += encode_command([b"REPLCONF", b"ACK", b"%d" % master_repl_offset()])
+            return b""
+        else:
+            return encode_error(f"Unrecognized REPLCONF option: {option.decode(errors='replace')}")
+    return OK
+
+@command("replicaof", 3, "admin stale")
+@command("slaveof", 3, "admin stale")
+def replicaof_command(client, args):
+    if SERVER_CONFIG.get("io-mode") == "threaded":
+        return encode_error("replication needs --io-mode eventloop")
+    if CLUSTER is not None:
+        return encode_error("REPLICAOF not allowed in cluster mode.")
+    if args[1].upper() == b"NO" and args[2].upper() == b"ONE":
+        if REPLICATION["master_host"] is not None:
+            drop_master_link()
+            REPLICATION["master_host"] = REPLICATION["master_port"] = None
+            KEYSPACE.expiry = "delete"
+            shift_replid()
+            print("MASTER MODE enabled")
+        return OK
+    port = parse_int(args[2])
+    if port is None:
+        return NOT_INTEGER_ERROR
+    host = args[1].decode(errors="replace")
+    if (host, port) == (REPLICATION["master_host"], REPLICATION["master_port"]):
+        return encode_simple_string("OK Already connected to specified master")
+    drop_master_link()
+    REPLICATION["master_host"], REPLICATION["master_port"] = host, port
+    KEYSPACE.expiry = "hide"
+    REPLICATION["last_sync_attempt"] = 0
+    print(f"REPLICAOF {host}:{port} enabled")
+    return OK
+
+@command("wait", 3, "")
+def wait_command(client, args):
+    if REPLICATION["master_host"] is not None:
+        return encode_error("WAIT cannot be used with replica instances.")
+    numreplicas, timeout = parse_int(args[1]), parse_int(args[2])
+    if numreplicas is None or timeout is None:
+        return NOT_INTEGER_ERROR
+    if timeout < 0:
+        return encode_error("timeout is negative")
+    offset = client.woff if client is not None else master_repl_offset()
+    acked = replicas_acked(offset)
+    if acked >= numreplicas or client is None or client.in_exec or SERVER_CONFIG.get("io-mode") == "threaded":
+        return encode_integer(acked)
+    client.blocked = (numreplicas, offset, time.monotonic() + timeout / 1000 if timeout else None)
+    BLOCKED_CLIENTS.add(client)
+    if REPLICATION["backlog"] is not None:
+        replication_feed(encode_command([b"REPLCONF", b"GETACK", b"*"]))
+    return b""
+
+INFO_SECTIONS = {}
+
+# Sections INFO leaves out unless asked for by name, "all" or "everything"
+INFO_EXTRA_SECTIONS = set()
+
+def info_section(name, default=True):
+    def register(fn):
+        INFO_SECTIONS[name] = fn
+        if not default:
+            INFO_EXTRA_SECTIONS.add(name)
+        return fn
+    return register
+
+@info_section("server")
+def info_server():
+    uptime = int(time.time() - START_TIME)
+    return {
+        "redis_version": REDIS_VERSION,
+        "redis_mode": "standalone" if CLUSTER is None else "cluster",
+        "os": f"{platform.system()} {platform.release()} {platform.machine()}",
+        "arch_bits": 64 if sys.maxsize > 2 ** 32 else 32,
+        "io_mode": SERVER_CONFIG.get("io-mode", "eventloop"),
+        "python_version": platform.python_version(),
+        "process_id": os.getpid(),
+        "tcp_port": int(SERVER_CONFIG.get("port", 6379)),
+        "server_time_usec": int(time.time() * 1000000),
+        "uptime_in_seconds": uptime,
+        "uptime_in_days": uptime // 86400,
+        "hz": SERVER_CONFIG.get("hz", 10),
+        "executable": os.path.abspath(sys.argv[0]),
+    }
+
+@info_section("clients")
+def info_clients():
+    clients = list(CLIENTS.values())
+    return {
+        "connected_clients": len(clients),
+        "client_recent_max_input_buffer": max((client.parser.end - client.parser.pos for client in clients), default=0),
+        "client_recent_max_output_buffer": max((client.pending_output() for client in clients), default=0),
+        "blocked_clients": len(BLOCKED_CLIENTS),
+        "tracking_clients": len(TRACKING.clients),
+    }
+
+def process_rss():
+    # Resident set size, where the platform tells us cheaply
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+@info_section("memory")
+def info_memory():
+    used_memory = KEYSPACE.used_memory()
+    peak = max(MEMORY_PEAK["used_memory_peak"], used_memory)
+    rss = process_rss()
+    return {
+        "used_memory": used_memory,
+        "used_memory_human": bytes_to_human(used_memory),
+        "used_memory_rss": rss,
+        "used_memory_rss_human": bytes_to_human(rss),
+        "used_memory_peak": peak,
+        "used_memory_peak_human": bytes_to_human(peak),
+        "maxmemory": KEYSPACE.maxmemory,
+        "maxmemory_human": bytes_to_human(KEYSPACE.maxmemory),
+        "maxmemory_policy": KEYSPACE.policy,
+        "lazyfree_pending_objects": LAZYFREE.pending,
+    }
+
+@info_section("persistence")
+def info_persistence():
+    start = PERSISTENCE["bgsave_start"]
+    return {
+        "rdb_changes_since_last_save": KEYSPACE.dirty() - PERSISTENCE["dirty_at_lastsave"],
+        "rdb_bgsave_in_progress": int(bgsave_in_progress()),
+        "rdb_last_save_time": PERSISTENCE["lastsave"],
+        "rdb_last_bgsave_status": PERSISTENCE["last_bgsave_status"],
+        "rdb_last_bgsave_time_sec": PERSISTENCE["last_bgsave_time_sec"],
+        "rdb_current_bgsave_time_sec": int(time.time() - start) if start is not None else -1,
+        **info_aof(),
+        **info_loading(),
+    }
+
+def info_aof():
+    start = PERSISTENCE["aof_rewrite_start"]
+    fields = {
+        "aof_enabled": int(AOF is not None),
+        "aof_rewrite_in_progress": int(aof_rewrite_in_progress()),
+        "aof_rewrite_scheduled": int(PERSISTENCE["aof_rewrite_scheduled"]),
+        "aof_last_rewrite_time_sec": PERSISTENCE["aof_last_rewrite_time_sec"],
+        "aof_current_rewrite_time_sec": int(time.time() - start) if start is not None else -1,
+        "aof_last_bgrewrite_status": PERSISTENCE["aof_last_bgrewrite_status"],
+    }
+    if AOF is not None:
+        fields.update({
+            "aof_last_write_status": "err" if AOF.last_write_error else "ok",
+            "aof_current_size": AOF.size,
+            "aof_base_size": AOF.base_size,
+            "aof_buffer_length": AOF.buffer_length(),
+        })
+    return fields
+
+def info_loading():
+    if not LOADING["loading"]:
+        return {"loading": 0}
+    loaded = LOADING["loaded_bytes"]
+    total = LOADING["total_bytes"]
+    elapsed = time.time() - LOADING["start_time"]
+    return {
+        "loading": 1,
+        "loading_start_time": int(LOADING["start_time"]),
+        "loading_total_bytes": total,
+        "loading_loaded_bytes": loaded,
+        "loading_loaded_perc": f"{100 * loaded / max(total, 1):.2f}",
+        "loading_eta_seconds": int(elapsed * (total - loaded) / loaded) if loaded else 1,
+    }
+
+@info_section("stats")
+def info_stats():
+    return {
+        "expired_keys": KEYSPACE.expired_keys(),
+        **STATS,
+        "expire_cycle_cpu_milliseconds": int(STATS["expire_cycle_cpu_milliseconds"]),
+        "evicted_keys": KEYSPACE.evicted_keys(),
+        "keyspace_hits": KEYSPACE.keyspace_hits(),
+        "keyspace_misses": KEYSPACE.keyspace_misses(),
+        "lazyfreed_objects": LAZYFREE.freed,
+        "pubsub_channels": len(PUBSUB.channels),
+        "pubsub_patterns": len(PUBSUB.patterns),
+        "tracking_total_keys": len(TRACKING.keys),
+        "tracking_total_prefixes": len(TRACKING.prefixes),
+    }
+
+@info_section("replication")
+def info_replication():
+    info = {"role": "master" if REPLICATION["master_host"] is None else "slave"}
+    if REPLICATION["master_host"] is not None:
+        client = REPLICATION["master_client"]
+        info.update({
+            "master_host": REPLICATION["master_host"],
+            "master_port": REPLICATION["master_port"],
+            "master_link_status": "down" if client is None else "up",
+            "master_last_io_seconds_ago": -1 if client is None else int(time.monotonic() - client.last_interaction),
+            "master_sync_in_progress": int(REPLICATION["sync_thread"] is not None),
+            "slave_repl_offset": master_repl_offset(),
+            "slave_read_only": 1,
+        })
+    info["connected_slaves"] = len(REPLICAS)
+    for i, replica in enumerate(REPLICAS):
+        state = "online" if replica.replica_state == "online" else "wait_bgsave"
+        info[f"slave{i}"] = (f"ip={replica.addr[0]},port={replica.repl_listening_port},state={state},"
+                             f"offset={replica.repl_ack_offset},lag={int(time.time() - replica.repl_ack_time)}")
+    backlog = REPLICATION["backlog"]
+    info.update({
+        "master_replid": REPLICATION["replid"],
+        "master_replid2": REPLICATION["replid2"],
+        "master_repl_offset": master_repl_offset(),
+        "second_repl_offset": REPLICATION["second_replid_offset"],
+        "repl_backlog_active": int(backlog is not None),
+        "repl_backlog_size": backlog.size if backlog is not None else parse_memory(SERVER_CONFIG.get("repl-backlog-size", "1mb")),
+        "repl_backlog_first_byte_offset": backlog.first_byte_offset() if backlog is not None else 0,
+        "repl_backlog_histlen": backlog.histlen if backlog is not None else 0,
+    })
+    return info
+
+@info_section("cpu")
+def info_cpu():
+    times = os.times()
+    return {
+        "used_cpu_sys": f"{times.system:.6f}",
+        "used_cpu_user": f"{times.user:.6f}",
+    }
+
+@info_section("commandstats", default=False)
+def info_commandstats():
+    return {
+        f"cmdstat_{cmd.name}": f"calls={cmd.calls},usec={cmd.usec},"
+                               f"usec_per_call={cmd.usec / cmd.calls if cmd.calls else 0:.2f},"
+                               f"rejected_calls={cmd.rejected_calls},failed_calls={cmd.failed_calls}"
+        for cmd in all_commands() if cmd.calls or cmd.rejected_calls
+    }
+
+@info_section("cluster")
+def info_cluster():
+    return {"cluster_enabled": int(CLUSTER is not None)}
+
+@info_section("keyspace")
+def info_keyspace():
+    keys = len(KEYSPACE)
+    if not keys:
+        return {}
+    return {"db0": f"keys={keys},expires={KEYSPACE.expires_count()}"}
+
+@command("cluster", -2, "loading stale")
+def cluster_command(client, args):
+    if CLUSTER is None:
+        return encode_error("This instance has cluster support disabled")
+    sub = args[1].upper()
+    if sub == b"KEYSLOT" and len(args) == 3:
+        return encode_integer(key_hash_slot(args[2]))
+    if sub == b"MYID" and len(args) == 2:
+        return encode_bulk_string(CLUSTER.node_id(CLUSTER.index))
+    if sub == b"SLOTS" and len(args) == 2:
+        host = CLUSTER.host.encode()
+        return encode_array([[*CLUSTER.slot_range(worker), [host, CLUSTER.worker_port(worker), CLUSTER.node_id(worker)]]
+                             for worker in range(CLUSTER.workers)])
+    if sub == b"NODES" and len(args) == 2:
+        lines = []
+        for worker in range(CLUSTER.workers):
+            first, last = CLUSTER.slot_range(worker)
+            flags = "myself,master" if worker == CLUSTER.index else "master"
+            port = CLUSTER.worker_port(worker)
+            lines.append(f"{CLUSTER.node_id(worker)} {CLUSTER.host}:{port}@{port + 10000} {flags} - 0 0 "
+                         f"{worker + 1} connected {first}-{last}\n")
+        return encode_bulk_string("".join(lines))
+    if sub == b"INFO" and len(args) == 2:
+        fields = {
+            "cluster_enabled": 1,
+            "cluster_state": "ok",
+            "cluster_slots_assigned": len(CLUSTER.owners),
+            "cluster_slots_ok": len(CLUSTER.owners),
+            "cluster_known_nodes": CLUSTER.workers,
+            "cluster_size": CLUSTER.workers,
+            "cluster_current_epoch": CLUSTER.workers,
+            "cluster_my_epoch": CLUSTER.index + 1,
+        }
+        return encode_bulk_string("".join(f"{name}:{value}\r\n" for name, value in fields.items()))
+    return encode_error(f"unknown subcommand or wrong number of arguments for '{args[1].decode(errors='replace')}'")
+
+@command("info", -1, "loading stale")
+def info_command(client, args):
+    requested = [arg.decode(errors="replace").lower() for arg in args[1:]]
+    if "all" in requested or "everything" in requested:
+        requested = list(INFO_SECTIONS)
+    elif not requested or "default" in requested:
+        requested = [name for name in INFO_SECTIONS if name not in INFO_EXTRA_SECTIONS]
+    lines = []
+    for name in requested:
+        fn = INFO_SECTIONS.get(name)
+        if fn is None:
+            continue
+        if lines:
+            lines.append("")
+        lines.append(f"# {name.capitalize()}")
+        lines.extend(f"{field}:{value}" for field, value in fn().items())
+    return encode_bulk_string("\r\n".join(lines) + "\r\n" if lines else "")
+
+@command("slowlog", -2, "admin loading stale")
+def slowlog_command(client, args):
+    sub = args[1].upper()
+    if sub == b"GET" and len(args) <= 3:
+        count = 10
+        if len(args) == 3:
+            count = parse_int(args[2])
+            if count is None or count < -1:
+                return encode_error("count should be greater than or equal to -1")
+        return encode_array([list(entry) for entry in SLOWLOG.get(count)])
+    if sub == b"LEN" and len(args) == 2:
+        return encode_integer(len(SLOWLOG.entries))
+    if sub == b"RESET" and len(args) == 2:
+        SLOWLOG.reset()
+        return OK
+    return encode_error(f"unknown subcommand or wrong number of arguments for '{args[1].decode(errors='replace')}'")
+
+@command("latency", -2, "admin loading stale")
+def latency_command(client, args):
+    sub = args[1].upper()
+    if sub == b"LATEST" and len(args) == 2:
+        return encode_array([list(event) for event in LATENCY.latest()])
+    if sub == b"HISTORY" and len(args) == 3:
+        return encode_array([list(sample) for sample in LATENCY.history(args[2].decode(errors="replace"))])
+    if sub == b"RESET":
+        return encode_integer(LATENCY.reset([event.decode(errors="replace") for event in args[2:]]))
+    return encode_error(f"unknown subcommand or wrong number of arguments for '{args[1].decode(errors='replace')}'")
+
+def server_cron(state):
+    """
+    Periodic housekeeping, run SERVER_CONFIG["hz"] times per second.
+    `state` carries bookkeeping between calls.
+    """
+    KEYSPACE.update_clock()
+    hz = int(SERVER_CONFIG.get("hz", 10))
+    if REPLICATION["master_host"] is None:
+        active_expire_cycle(1000000 * ACTIVE_EXPIRE_CYCLE_TIME_PERC // 100 // hz)
+
+    if bgsave_in_progress():
+        check_background_save()
+    if aof_rewrite_in_progress():
+        check_aof_rewrite()
+    if not bgsave_in_progress() and not aof_rewrite_in_progress() and not LOADING["loading"]:
+        if PERSISTENCE["aof_rewrite_scheduled"] or aof_rewrite_due():
+            start_aof_rewrite()
+        elif SAVE_RULES and save_rules_due():
+            print("Save rule met, saving in the background")
+            start_background_save()
+    if SERVER_CONFIG.get("io-mode") != "threaded":
+        replication_cron()
+
+    now = time.monotonic()
+    elapsed = now - state.get("sample_time", now)
+    if elapsed >= 1 or "sample_time" not in state:
+        if elapsed:
+            STATS["instantaneous_expired_per_sec"] = int((KEYSPACE.expired_keys() - state["sample_expired"]) / elapsed)
+            STATS["instantaneous_ops_per_sec"] = int(
+                (STATS["total_commands_processed"] - state["sample_commands"]) / elapsed)
+        state["sample_time"] = now
+        state["sample_expired"] = KEYSPACE.expired_keys()
+        state["sample_commands"] = STATS["total_commands_processed"]
+        MEMORY_PEAK["used_memory_peak"] = max(MEMORY_PEAK["used_memory_peak"], KEYSPACE.used_memory())
+
+def run_cron_thread():
+    # Threaded mode has no event loop to piggyback on
+    state = {}
+    while True:
+        time.sleep(1 / int(SERVER_CONFIG.get("hz", 10)))
+        server_cron(state)
 
 def main():
+    global OUTPUT_BUFFER_LIMIT, PUBSUB_OUTPUT_BUFFER_LIMIT, KEYSPACE, SAVE_RULES
     print("Logs from your program will appear here!")
     
     # Default Configuration
+    SERVER_CONFIG["port"] = "6379"
+    SERVER_CONFIG["workers"] = "1"
     SERVER_CONFIG["dir"] = "."
     SERVER_CONFIG["dbfilename"] = "dump.rdb"
+    SERVER_CONFIG["io-mode"] = "eventloop"
+    SERVER_CONFIG["output-buffer-limit"] = str(OUTPUT_BUFFER_LIMIT)
+    SERVER_CONFIG["hz"] = "10"
+    SERVER_CONFIG["maxmemory"] = "0"
+    SERVER_CONFIG["maxmemory-policy"] = "noeviction"
+    SERVER_CONFIG["maxmemory-samples"] = "5"
+    SERVER_CONFIG["keyspace-shards"] = "16"
+    SERVER_CONFIG["save"] = ""
+    SERVER_CONFIG["rdb-compression"] = "no"
+    SERVER_CONFIG["rdb-checksum"] = "no"
+    SERVER_CONFIG["appendonly"] = "no"
+    SERVER_CONFIG["appendfilename"] = "appendonly.aof"
+    SERVER_CONFIG["appendfsync"] = "everysec"
+    SERVER_CONFIG["aof-use-rdb-preamble"] = "yes"
+    SERVER_CONFIG["auto-aof-rewrite-percentage"] = "100"
+    SERVER_CONFIG["auto-aof-rewrite-min-size"] = "64mb"
+    for name, limit in ENCODING_LIMITS.items():
+        SERVER_CONFIG[name] = str(limit)
+    SERVER_CONFIG["slowlog-log-slower-than"] = "10000"
+    SERVER_CONFIG["slowlog-max-len"] = "128"
+    SERVER_CONFIG["latency-monitor-threshold"] = "0"
+    SERVER_CONFIG["replicaof"] = ""
+    SERVER_CONFIG["repl-backlog-size"] = "1mb"
+    SERVER_CONFIG["pubsub-output-buffer-limit"] = "32mb 8mb 60"
+    SERVER_CONFIG["tracking-table-max-keys"] = "1000000"
     
     # Parse CLI arguments
-    import sys
     args = sys.argv[1:]
     for i in range(len(args)):
         if args[i] == "--dir" and i + 1 < len(args):
             SERVER_CONFIG["dir"] = args[i+1]
         elif args[i] == "--dbfilename" and i + 1 < len(args):
             SERVER_CONFIG["dbfilename"] = args[i+1]
-            
-    # Load RDB file if exists
-    import os
-    # Load RDB file if exists
-    import os
-    from app.rdb_parser import load_rdb, save_rdb
-    
+        elif args[i] == "--io-mode" and i + 1 < len(args):
+            SERVER_CONFIG["io-mode"] = args[i+1]
+        elif args[i] == "--output-buffer-limit" and i + 1 < len(args):
+            SERVER_CONFIG["output-buffer-limit"] = args[i+1]
+        elif args[i] == "--save":
+            # "--save 900 1 300 10" or "--save '900 1'", and may be repeated
+            rules = []
+            for value in args[i+1:]:
+                if value.startswith("--"):
+                    break
+                rules.append(value)
+            SERVER_CONFIG["save"] = " ".join([SERVER_CONFIG["save"]] + rules).strip()
+        elif args[i] in ("--rdb-compression", "--rdb-checksum") and i + 1 < len(args):
+            SERVER_CONFIG[args[i][2:]] = args[i+1]
+        elif args[i] == "--hz" and i + 1 < len(args):
+            SERVER_CONFIG["hz"] = args[i+1]
+        elif args[i] == "--replicaof" and i + 1 < len(args):
+            # "--replicaof host port" or "--replicaof 'host port'"
+            value = args[i+1]
+            if " " not in value and i + 2 < len(args):
+                value += " " + args[i+2]
+            SERVER_CONFIG["replicaof"] = value
+        elif args[i] in ("--port", "--workers", "--repl-backlog-size", "--pubsub-output-buffer-limit") and i + 1 < len(args):
+            SERVER_CONFIG[args[i][2:]] = args[i+1]
+        elif args[i] in ("--maxmemory", "--maxmemory-policy", "--maxmemory-samples", "--keyspace-shards",
+                         "--appendonly", "--appendfilename", "--appendfsync", "--aof-use-rdb-preamble",
+                         "--auto-aof-rewrite-percentage", "--auto-aof-rewrite-min-size", "--slowlog-log-slower-than",
+                         "--slowlog-max-len", "--latency-monitor-threshold", "--tracking-table-max-keys") and i + 1 < len(args):
+            SERVER_CONFIG[args[i][2:]] = args[i+1]
+        elif args[i][2:] in ENCODING_LIMITS and i + 1 < len(args):
+            SERVER_CONFIG[args[i][2:]] = args[i+1]
     
+    if SERVER_CONFIG["io-mode"] not in ("eventloop", "threaded"):
+        print(f"Unknown --io-mode {SERVER_CONFIG['io-mode']!r}, expected 'eventloop' or 'threaded'")
+        sys.exit(1)
+    OUTPUT_BUFFER_LIMIT = int(SERVER_CONFIG["output-buffer-limit"])
+    hard, soft, seconds = SERVER_CONFIG["pubsub-output-buffer-limit"].split()
+    PUBSUB_OUTPUT_BUFFER_LIMIT = (parse_memory(hard), parse_memory(soft), int(seconds))
+    TRACKING.max_keys = int(SERVER_CONFIG["tracking-table-max-keys"])
+    if SERVER_CONFIG["maxmemory-policy"] not in MAXMEMORY_POLICIES:
+        print(f"Unknown --maxmemory-policy {SERVER_CONFIG['maxmemory-policy']!r}, expected one of {', '.join(MAXMEMORY_POLICIES)}")
+        sys.exit(1)
+    if SERVER_CONFIG["appendfsync"] not in APPENDFSYNC_POLICIES:
+        print(f"Unknown --appendfsync {SERVER_CONFIG['appendfsync']!r}, expected one of {', '.join(APPENDFSYNC_POLICIES)}")
+        sys.exit(1)
+    KEYSPACE = Keyspace(int(SERVER_CONFIG["keyspace-shards"]))
+    KEYSPACE.maxmemory = parse_memory(SERVER_CONFIG["maxmemory"])
+    KEYSPACE.policy = SERVER_CONFIG["maxmemory-policy"]
+    KEYSPACE.maxmemory_samples = int(SERVER_CONFIG["maxmemory-samples"])
+    KEYSPACE.on_drop = propagate_drop
+    SERVER_CONFIG["maxmemory"] = str(KEYSPACE.maxmemory)
+    SAVE_RULES = parse_save_rules(SERVER_CONFIG["save"])
+    for name in ENCODING_LIMITS:
+        ENCODING_LIMITS[name] = int(SERVER_CONFIG[name])
+    configure_instrumentation()
+    if SERVER_CONFIG["replicaof"]:
+        if SERVER_CONFIG["io-mode"] == "threaded" or int(SERVER_CONFIG["workers"]) > 1:
+            print("--replicaof needs --io-mode eventloop and a single worker")
+            sys.exit(1)
+        host, port = SERVER_CONFIG["replicaof"].split()
+        REPLICATION["master_host"], REPLICATION["master_port"] = host, int(port)
+        KEYSPACE.expiry = "hide"
+
+    port = int(SERVER_CONFIG["port"])
+    workers = int(SERVER_CONFIG["workers"])
+    if workers > 1:
+        server_sockets = start_worker(workers, port)
+    else:
+        server_sockets = [socket.create_server(("localhost", port), reuse_port=False)]
+
+    # Load the AOF, or else the RDB file, while already answering clients
+    # with LOADING
     db_path = os.path.join(SERVER_CONFIG["dir"], SERVER_CONFIG["dbfilename"])
-    if os.path.exists(db_path):
+    append_only = SERVER_CONFIG["appendonly"] == "yes"
+    if append_only and os.path.exists(aof_path()) and os.path.getsize(aof_path()):
+        print(f"Loading append only file from {aof_path()}")
+        LOADING["loading"] = True
+        threading.Thread(target=load_dataset, args=(aof_path(), True), daemon=True).start()
+    elif os.path.exists(db_path):
         print(f"Loading RDB file from {db_path}")
-        loaded_data, loaded_expiry = load_rdb(db_path)
-        DATA_STORE.update(loaded_data)
-        EXPIRY_STORE.update(loaded_expiry)
-        print(f"Loaded {len(loaded_data)} keys")
-            
-    server_socket = socket.create_server(("localhost", 6379), reuse_port=False)
+        LOADING["loading"] = True
+        threading.Thread(target=load_dataset, args=(db_path,), daemon=True).start()
+    elif append_only:
+        open_append_only_file()
     
+    if SERVER_CONFIG["io-mode"] == "threaded":
+        run_threaded_server(server_sockets)
+    else:
+        run_event_loop(server_sockets)
+
+def start_worker(workers, port):
+    """
+    --workers mode: forks one process per worker, each owning a range of
+    the hash slots and its own RDB and AOF files. They all accept on
+    `port` (SO_REUSEPORT spreads the connections between them) and each on
+    port + 1 + its index too; a command for keys another worker owns gets
+    a MOVED redirect there, so cluster-aware clients go straight to the
+    owner. Returns the listening sockets in each worker. The parent
+    process stays in here, passing SIGINT and SIGTERM on, until they all
+    have exited.
+    """
+    global CLUSTER
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        print("--workers needs fork() and SO_REUSEPORT, which this platform does not have")
+        sys.exit(1)
+    pids = {}
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            shared = socket.create_server(("localhost", port), reuse_port=True)
+            CLUSTER = Cluster(workers, index, shared.getsockname()[0], port)
+            own_port = CLUSTER.worker_port(index)
+            SERVER_CONFIG["port"] = str(own_port)
+            SERVER_CONFIG["dbfilename"] = worker_filename(SERVER_CONFIG["dbfilename"], own_port)
+            SERVER_CONFIG["appendfilename"] = worker_filename(SERVER_CONFIG["appendfilename"], own_port)
+            first, last = CLUSTER.slot_range(index)
+            print(f"Worker {index} (pid {os.getpid()}) serving slots {first}-{last} on port {own_port}")
+            return [shared, socket.create_server(("localhost", own_port), reuse_port=False)]
+        pids[pid] = index
+
+    def stop(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while pids:
+        pid, status = os.wait()
+        index = pids.pop(pid, None)
+        if index is not None:
+            print(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}")
+    sys.exit(0)
+
+def run_threaded_server(server_sockets):
+    # One OS thread per client; kept around so it can be benchmarked
+    # against the event loop.
+    threading.Thread(target=run_cron_thread, daemon=True).start()
+    for server_socket in server_sockets[1:]:
+        threading.Thread(target=accept_threads, args=(server_socket,), daemon=True).start()
+    accept_threads(server_sockets[0])
+
+def accept_threads(server_socket):
     while True:
         client, addr = server_socket.accept()
         print(f"Accepted connection from {addr}")
-        threading.Thread(target=handle_client, args=(client,)).start()
+        threading.Thread(target=handle_client, args=(client, addr)).start()
+
+class ClientConnection:
+    """
+    Per-connection state: the socket plus its streaming request parser and
+    the replies that have not been written yet. outbuf[sent:] is the
+    unsent part, so partial writes never shift the buffer.
+    """
+    def __init__(self, sock, addr):
+        self.id = next(CLIENT_IDS)
+        self.sock = sock
+        self.addr = addr
+        self.name = b""
+        self.created = time.time()
+        self.parser = RESPParser()
+        self.outbuf = bytearray()
+        self.sent = 0
+        self.close_after_reply = False
+        self.blocked = None # (numreplicas, offset, deadline) while in WAIT
+        self.woff = 0 # Replication offset just past this client's last write
+        self.multi = None # Commands queued since MULTI
+        self.multi_error = False # A command was refused while queueing
+        self.in_exec = False # EXEC is running the queue: WAIT must not block
+        self.exec_opened = set() # Where that EXEC's MULTI went: "aof", "replicas"
+        self.watched = {} # WATCHed key -> its version then
+        self.channels = set() # Pub/Sub subscriptions
+        self.patterns = set()
+        self.soft_limit_since = None # When its output went over the pub/sub soft limit
+        self.resp = 2 # Protocol version, set by HELLO
+        # Client-side caching, while CLIENT TRACKING is on
+        self.tracking = False
+        self.tracking_redirect = 0 # ID of the client that gets the invalidations instead
+        self.tracking_bcast = False
+        self.tracking_prefixes = []
+        self.tracking_opt = None # b"OPTIN" or b"OPTOUT"
+        self.tracking_noloop = False
+        self.tracking_caching = None # CLIENT CACHING yes/no, for the next command
+        # Replication: set on the master's own connection to a replica ...
+        self.replica_state = None # wait_bgsave_start, wait_bgsave_end or online
+        self.repl_buf = None
+        self.repl_ack_offset = 0
+        self.repl_ack_time = 0
+        self.repl_listening_port = 0
+        # ... and on a replica's connection to its master
+        self.is_master = False
+        self.last_interaction = time.monotonic()
+
+    def pending_output(self):
+        return len(self.outbuf) - self.sent
+
+    def output_full(self):
+        return len(self.outbuf) - self.sent >= OUTPUT_BUFFER_LIMIT
+
+def run_event_loop(server_sockets):
+    """
+    Single-threaded, non-blocking server. Every connection is multiplexed
+    through one selector (epoll/kqueue where available).
+    """
+    selector = selectors.DefaultSelector()
+    for server_socket in server_sockets:
+        server_socket.setblocking(False)
+        selector.register(server_socket, selectors.EVENT_READ, None)
+
+    cron_state = {}
+    cron_interval = 1 / int(SERVER_CONFIG.get("hz", 10))
+    next_cron = time.monotonic() + cron_interval
+    while True:
+        timeout = max(0, next_cron - time.monotonic())
+        ready = []
+        events = selector.select(timeout)
+        KEYSPACE.tick()
+        for key, mask in events:
+            if key.data is None:
+                accept_clients(selector, key.fileobj)
+                continue
+
+            client = key.data
+            if mask & selectors.EVENT_READ:
+                if not read_from_client(client):
+                    close_client(selector, client)
+                    continue
+            ready.append(client)
+
+        if BLOCKED_CLIENTS:
+            unblock_clients()
+        if REPLICATION["sync_result"] is not None:
+            attach_master(selector)
+
+        # Group commit: everything the commands above wrote reaches the AOF
+        # in one write (and one fsync under appendfsync always) before any
+        # of their replies goes out.
+        flush_append_only_file()
+
+        if PENDING_WRITES:
+            # Replicas and unblocked clients, given output by other clients' commands
+            seen = set(ready)
+            ready.extend(client for client in PENDING_WRITES if client not in seen and client.id in CLIENTS)
+            PENDING_WRITES.clear()
+
+        for client in ready:
+            if client.pending_output():
+                if not write_to_client(client):
+                    close_client(selector, client)
+                    continue
+                if not client.output_full() and client.parser.has_pending():
+                    # Output drained below the limit: resume commands that
+                    # backpressure left in the parser.
+                    process_input(client)
+            if client.close_after_reply and not client.pending_output():
+                close_client(selector, client)
+                continue
+            update_interest(selector, client)
+
+        if time.monotonic() >= next_cron:
+            server_cron(cron_state)
+            next_cron = time.monotonic() + cron_interval
+
+def accept_clients(selector, server_socket):
+    while True:
+        try:
+            sock, addr = server_socket.accept()
+        except BlockingIOError:
+            return
+        print(f"Accepted connection from {addr}")
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = ClientConnection(sock, addr)
+        CLIENTS[client.id] = client
+        STATS["total_connections_received"] += 1
+        selector.register(sock, selectors.EVENT_READ, client)
+
+def read_from_client(client):
+    """
+    Reads whatever is available and runs every complete command in the
+    input buffer. Returns False once the peer has gone away.
+    """
+    try:
+        n = client.sock.recv_into(client.parser.get_buffer())
+    except BlockingIOError:
+        return True
+    except ConnectionError:
+        return False
+    if not n:
+        return False
+    STATS["total_net_input_bytes"] += n
+    client.parser.advance(n)
+    process_input(client)
+    return True
+
+def process_input(client):
+    """
+    Runs every complete command in the client's input buffer in order and
+    appends the replies to its output buffer, so a pipelined batch is
+    answered with a single write. Stops early once the output buffer is
+    over OUTPUT_BUFFER_LIMIT; the rest waits in the parser.
+    """
+    parser = client.parser
+    while not client.close_after_reply and not client.output_full() and client.blocked is None:
+        try:
+            args = parser.get_command()
+        except ProtocolError as e:
+            client.outbuf += encode_error(f"Protocol error: {e}")
+            client.close_after_reply = True
+            return
+        if args is None:
+            return # Wait for more data
+        if client.is_master:
+            process_master_command(client, args)
+        else:
+            client.outbuf += handle_command(args, client)
+
+def write_to_client(client):
+    try:
+        with memoryview(client.outbuf) as view:
+            sent = client.sock.send(view[client.sent:])
+    except BlockingIOError:
+        return True
+    except ConnectionError:
+        return False
+    client.sent += sent
+    STATS["total_net_output_bytes"] += sent
+    if client.sent == len(client.outbuf):
+        client.outbuf.clear()
+        client.sent = 0
+    return True
+
+def update_interest(selector, client):
+    # A client whose output buffer is full is not read from until it drains
+    events = 0 if client.output_full() else selectors.EVENT_READ
+    if client.pending_output():
+        events |= selectors.EVENT_WRITE
+    if selector.get_key(client.sock).events != events:
+        selector.modify(client.sock, events, client)
 
-def handle_client(client_socket):
+def close_client(selector, client):
+    CLIENTS.pop(client.id, None)
+    unwatch_all(client)
+    PUBSUB.unsubscribe_all(client)
+    disable_tracking(client)
+    BLOCKED_CLIENTS.discard(client)
+    PENDING_WRITES.discard(client)
+    if client.replica_state is not None:
+        REPLICAS.remove(client)
+        print(f"Connection with replica {client.addr[0]}:{client.repl_listening_port} lost")
+    if client is REPLICATION["master_client"]:
+        REPLICATION["master_client"] = None
+        print("Connection with MASTER lost")
+    selector.unregister(client.sock)
+    client.sock.close()
+
+def handle_client(client_socket, addr):
+    client = ClientConnection(client_socket, addr)
+    CLIENTS[client.id] = client
+    STATS["total_connections_received"] += 1
     try:
-        data_buffer = b""
-        while True:
-            chunk = client_socket.recv(1024)
-            if not chunk:
+        while not client.close_after_reply:
+            n = client_socket.recv_into(client.parser.get_buffer())
+            if not n:
                 break
-            data_buffer += chunk
+            KEYSPACE.tick()
+            STATS["total_net_input_bytes"] += n
+            client.parser.advance(n)
             
-            # Attempt to parse
+            # Everything already buffered is answered with one sendall;
+            # a full output buffer is flushed before parsing the rest.
             while True:
-                if not data_buffer:
-                    break
-                
-                try:
-                    parser = RESPParser(data_buffer)
-                    # Peek to see if we have enough data? 
-                    # For simplicity, we assume we get full commands in this stage 
-                    # or that the buffer accumulates. 
-                    # Real stream parsing is harder, but let's try a simple approach:
-                    # If parser fails indexing, Wait for more data?
-                    
-                    # NOTE: A robust parser needs check validity before consuming. 
-                    # Here we just try to parse.
-                    
-                    args = parser.parse()
-                    
-                    # If successful parse
-                    if args:
-                        response = handle_command(args)
-                        client_socket.send(response)
-                        # Remove consumed data from buffer
-                        data_buffer = data_buffer[parser.pos:]
-                    else:
-                        break # Wait for more data
-                        
-                except IndexError:
-                     # Not enough data yet
+                process_input(client)
+                if not client.outbuf:
                     break
+                # Writes are logged before they are acknowledged
+                flush_append_only_file()
+                client_socket.sendall(client.outbuf)
+                STATS["total_net_output_bytes"] += len(client.outbuf)
+                client.outbuf.clear()
                     
     except ConnectionError:
         pass
     finally:
+        CLIENTS.pop(client.id, None)
+        unwatch_all(client)
         client_socket.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+import itertools
+import threading
+import time
+from collections import deque
+
+# A slow log entry keeps at most this many arguments, each cut to this many
+# bytes, so a huge MSET does not pin its whole argument list in memory
+SLOWLOG_ENTRY_MAX_ARGC = 32
+SLOWLOG_ENTRY_MAX_STRING = 128
+
+# Samples kept per latency event
+LATENCY_TS_LEN = 160
+
+class SlowLog:
+    """
+    The slow log: the last `max_len` commands that took at least
+    `threshold_us` microseconds to execute, newest first. A negative
+    threshold turns it off.
+    """
+    def __init__(self, threshold_us=10000, max_len=128):
+        self.threshold_us = threshold_us
+        self.entries = deque(maxlen=max_len)
+        self.ids = itertools.count()
+
+    def add(self, args, duration_us, client_addr="", client_name=b""):
+        shown = args[:SLOWLOG_ENTRY_MAX_ARGC]
+        if len(args) > SLOWLOG_ENTRY_MAX_ARGC:
+            shown[-1] = b"... (%d more arguments)" % (len(args) - SLOWLOG_ENTRY_MAX_ARGC + 1)
+        shown = [arg if len(arg) <= SLOWLOG_ENTRY_MAX_STRING else
+                 arg[:SLOWLOG_ENTRY_MAX_STRING] + b"... (%d more bytes)" % (len(arg) - SLOWLOG_ENTRY_MAX_STRING)
+                 for arg in shown]
+        self.entries.appendleft((next(self.ids), int(time.time()), duration_us, shown, client_addr, client_name))
+
+    def resize(self, max_len):
+        self.entries = deque(self.entries, maxlen=max_len)
+
+    def get(self, count=10):
+        if count < 0:
+            return list(self.entries)
+        return list(itertools.islice(self.entries, count))
+
+    def reset(self):
+        self.entries.clear()
+
+class LatencyMonitor:
+    """
+    Latency spikes by event ("command", "fast-command", "expire-cycle",
+    "aof-write", "fork", ...): for each, up to LATENCY_TS_LEN (unix time,
+    milliseconds) samples at or over `threshold_ms`, at most one per
+    second (the worst), plus the worst ever seen. A threshold of 0 turns it
+    off, and callers check it before timing anything.
+    """
+    def __init__(self, threshold_ms=0):
+        self.threshold_ms = threshold_ms
+        self.events = {} # event -> [samples, max_ms]
+        self.lock = threading.Lock()
+
+    def add_sample(self, event, ms):
+        if not self.threshold_ms or ms < self.threshold_ms:
+            return
+        now = int(time.time())
+        with self.lock:
+            entry = self.events.get(event)
+            if entry is None:
+                entry = self.events[event] = [deque(maxlen=LATENCY_TS_LEN), 0]
+            samples = entry[0]
+            if samples and samples[-1][0] == now:
+                samples[-1] = (now, max(samples[-1][1], ms))
+            else:
+                samples.append((now, ms))
+            entry[1] = max(entry[1], ms)
+
+    def latest(self):
+        """
+        Returns (event, unix_time, latest_ms, max_ms) for every event.
+        """
+        with self.lock:
+            return [(event, samples[-1][0], samples[-1][1], max_ms)
+                    for event, (samples, max_ms) in self.events.items()]
+
+    def history(self, event):
+        with self.lock:
+            entry = self.events.get(event)
+            return list(entry[0]) if entry else []
+
+    def reset(self, events=None):
+        """
+        Forgets the given events, or all of them. Returns how many there were.
+        """
+        with self.lock:
+            if not events:
+                count = len(self.events)
+                self.events.clear()
+                return count
+            return sum(self.events.pop(event, None) is not None for event in events)
@@ -0,0 +1,94 @@
+from app.resp import encode_bulk_string
+from app.stringmatch import compile_pattern
+
+class PubSub:
+    """
+    Channel and pattern subscriptions, indexed both ways: by channel and
+    by pattern here, so PUBLISH only visits the clients that get the
+    message, and in each client's `channels` and `patterns` sets, for
+    UNSUBSCRIBE without arguments and for disconnects.
+
+    A pattern is compiled once, when its first subscriber arrives, and the
+    matcher kept for as long as anyone is subscribed to it.
+    """
+    def __init__(self):
+        # channel -> {client: None}, in the order they subscribed
+        self.channels = {}
+        # pattern -> (matcher, {client: None})
+        self.patterns = {}
+
+    def subscribe(self, client, channel):
+        """
+        Returns whether `client` was not subscribed to `channel` yet.
+        """
+        if channel in client.channels:
+            return False
+        client.channels.add(channel)
+        self.channels.setdefault(channel, {})[client] = None
+        return True
+
+    def unsubscribe(self, client, channel):
+        if channel not in client.channels:
+            return False
+        client.channels.remove(channel)
+        subscribers = self.channels[channel]
+        del subscribers[client]
+        if not subscribers:
+            del self.channels[channel]
+        return True
+
+    def psubscribe(self, client, pattern):
+        if pattern in client.patterns:
+            return False
+        client.patterns.add(pattern)
+        entry = self.patterns.get(pattern)
+        if entry is None:
+            entry = self.patterns[pattern] = (compile_pattern(pattern), {})
+        entry[1][client] = None
+        return True
+
+    def punsubscribe(self, client, pattern):
+        if pattern not in client.patterns:
+            return False
+        client.patterns.remove(pattern)
+        subscribers = self.patterns[pattern][1]
+        del subscribers[client]
+        if not subscribers:
+            del self.patterns[pattern]
+        return True
+
+    def unsubscribe_all(self, client):
+        for channel in list(client.channels):
+            self.unsubscribe(client, channel)
+        for pattern in list(client.patterns):
+            self.punsubscribe(client, pattern)
+
+    def publish(self, channel, message, deliver):
+        """
+        Sends `message` to the subscribers of `channel` and of the patterns
+        it matches by calling deliver(client, data). The message is encoded
+        once (once per matching pattern) for each protocol, an array for
+        RESP2 clients and a push for RESP3 ones, and every subscriber is
+        handed the same bytes. deliver() may unsubscribe a client it gives
+        up on. Returns how many clients received it.
+        """
+        receivers = 0
+        tail = encode_bulk_string(channel) + encode_bulk_string(message)
+        subscribers = self.channels.get(channel)
+        if subscribers:
+            body = b"$7\r\nmessage\r\n" + tail
+            data = (b"*3\r\n" + body, b">3\r\n" + body)
+            receivers += len(subscribers)
+            for client in list(subscribers):
+                deliver(client, data[client.resp == 3])
+        for pattern, (matches, subscribers) in list(self.patterns.items()):
+            if matches(channel):
+                body = b"$8\r\npmessage\r\n" + encode_bulk_string(pattern) + tail
+                data = (b"*4\r\n" + body, b">4\r\n" + body)
+                receivers += len(subscribers)
+                for client in list(subscribers):
+                    deliver(client, data[client.resp == 3])
+        return receivers
+
+    def numsub(self, channel):
+        return len(self.channels.get(channel, ()))
@@ -1,6 +1,84 @@
+import mmap
+import os
 import struct
+import threading
 import time
 
+# Bytes buffered before each write to the dump file
+RDB_BUFFER_SIZE = 1024 * 1024
+
+# Bytes of the dump parsed between progress reports, and checksummed at a time
+RDB_LOAD_CHUNK = 1024 * 1024
+
+# Newest RDB format version the loader understands
+RDB_VERSION = 12
+
+# Opcodes
+RDB_OPCODE_SLOT_INFO = 0xF4
+RDB_OPCODE_FUNCTION2 = 0xF5
+RDB_OPCODE_FUNCTION_PRE_GA = 0xF6
+RDB_OPCODE_MODULE_AUX = 0xF7
+RDB_OPCODE_IDLE = 0xF8
+RDB_OPCODE_FREQ = 0xF9
+RDB_OPCODE_AUX = 0xFA
+RDB_OPCODE_RESIZEDB = 0xFB
+RDB_OPCODE_EXPIRETIME_MS = 0xFC
+RDB_OPCODE_EXPIRETIME = 0xFD
+RDB_OPCODE_SELECTDB = 0xFE
+RDB_OPCODE_EOF = 0xFF
+
+# Value types
+RDB_TYPE_STRING = 0
+RDB_TYPE_LIST = 1
+RDB_TYPE_SET = 2
+RDB_TYPE_ZSET = 3
+RDB_TYPE_HASH = 4
+RDB_TYPE_ZSET_2 = 5
+RDB_TYPE_HASH_ZIPMAP = 9
+RDB_TYPE_LIST_ZIPLIST = 10
+RDB_TYPE_SET_INTSET = 11
+RDB_TYPE_ZSET_ZIPLIST = 12
+RDB_TYPE_HASH_ZIPLIST = 13
+RDB_TYPE_LIST_QUICKLIST = 14
+RDB_TYPE_HASH_LISTPACK = 16
+RDB_TYPE_ZSET_LISTPACK = 17
+RDB_TYPE_LIST_QUICKLIST_2 = 18
+RDB_TYPE_SET_LISTPACK = 20
+
+# quicklist 2 node containers
+QUICKLIST_NODE_PLAIN = 1
+QUICKLIST_NODE_PACKED = 2
+
+class RDBError(Exception):
+    pass
+
+class SortedSet(dict):
+    """
+    A sorted set as loaded from a dump: member -> score.
+    """
+
+def value_type(value):
+    """
+    The Redis type name of a value: bytes or an int (a string in the int
+    encoding), one of the keyspace's collection types (which carry a
+    type_name) or a plain type as loaded from a dump. None for anything
+    else.
+    """
+    if isinstance(value, (bytes, int)):
+        return "string"
+    name = getattr(value, "type_name", None)
+    if name is not None:
+        return name
+    if isinstance(value, SortedSet):
+        return "zset"
+    if isinstance(value, dict):
+        return "hash"
+    if isinstance(value, list):
+        return "list"
+    if isinstance(value, (set, frozenset)):
+        return "set"
+    return None
+
 def load_rdb(filename):
     """
     Parses a Redis RDB file and returns a dictionary of data and expiry times.
@@ -8,91 +86,134 @@ def load_rdb(filename):
     """
     data_store = {}
     expiry_store = {}
-    
+    for key, value, expire_at in iter_rdb(filename):
+        data_store[key] = value
+        if expire_at is not None:
+            expiry_store[key] = expire_at
+    return data_store, expiry_store
+
+def iter_rdb(filename, progress=None, verify_checksum=True):
+    """
+    Yields (key, value, expire_at_ms or None) for every key in an RDB file.
+
+    The file is memory-mapped and parsed in place, so only the key being
+    decoded is ever copied out of it. Every RDB_LOAD_CHUNK bytes
+    `progress(loaded_bytes, total_bytes)` is called. At the end a non-zero
+    CRC64 trailer is checked, as Redis does (zero means the dump was saved
+    without one), and a mismatch raises RDBError. The generator's return
+    value is the offset just past the dump, where an AOF with an RDB
+    preamble continues.
+    """
     try:
-        with open(filename, "rb") as f:
-            data = f.read()
+        f = open(filename, "rb")
     except FileNotFoundError:
-        return {}, {}
-        
-    if not data.startswith(b"REDIS"):
+        return
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 9:
+            print("Invalid RDB file format")
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                # Read ahead, and let pages go once parsed
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            try:
+                return (yield from parse_rdb(mapped, progress, verify_checksum))
+            except (IndexError, ValueError, struct.error) as e:
+                raise RDBError(f"Corrupted RDB file: {e}") from None
+
+def parse_rdb(data, progress=None, verify_checksum=True):
+    # `data` is bytes or an mmap: anything whose slices are bytes, so short
+    # strings are copied out with one slice
+    size = len(data)
+    if data[:5] != b"REDIS":
         print("Invalid RDB file format")
-        return {}, {}
-    
+        return
+    version = int(str(data[5:9], "ascii"))
+    if not 1 <= version <= RDB_VERSION:
+        raise RDBError(f"Can't handle RDB format version {version}")
+
     pos = 9 # Skip REDIS + 4 byte version
-    
-    while pos < len(data):
+    next_report = RDB_LOAD_CHUNK
+    expire_at = None
+
+    while pos < size:
+        if pos >= next_report:
+            if progress:
+                progress(pos, size)
+            next_report = pos + RDB_LOAD_CHUNK
+
         opcode = data[pos]
         pos += 1
-        
-        if opcode == 0xFF: # EOF
-            break
-        elif opcode == 0xFE: # Select DB
-            # Read database index (length encoded)
-            db_index, new_pos = read_length(data, pos)
-            pos = new_pos
-            # We only support one DB (0) for now or merge all
-            continue
-        elif opcode == 0xFD: # Expire time in seconds
-            expiry_s = struct.unpack("<I", data[pos:pos+4])[0]
-            pos += 4
-            expiry_ms = expiry_s * 1000
-            # Read value type and key/value
-            value_type = data[pos]
-            pos += 1
-            key, new_pos = read_string(data, pos)
-            pos = new_pos
-            value, new_pos = read_string(data, pos)
-            pos = new_pos
-            
-            data_store[key] = value
-            expiry_store[key] = expiry_ms
-            
-        elif opcode == 0xFC: # Expire time in milliseconds
-            expiry_ms = struct.unpack("<Q", data[pos:pos+8])[0]
+
+        if opcode == RDB_OPCODE_EOF:
+            # 8-byte CRC64 of everything up to here; 0 means not computed,
+            # so only a dump saved with one pays for checking it
+            if verify_checksum and version >= 5 and size >= pos + 8:
+                expected = struct.unpack_from("<Q", data, pos)[0]
+                if expected and dump_crc64(data, pos) != expected:
+                    raise RDBError("Wrong RDB checksum")
+            if progress:
+                progress(size, size)
+            return pos + 8 if version >= 5 else pos
+        elif opcode == RDB_OPCODE_EXPIRETIME_MS:
+            expire_at = struct.unpack_from("<Q", data, pos)[0]
             pos += 8
-            # Read value type and key/value
-            value_type = data[pos]
-            pos += 1
-            key, new_pos = read_string(data, pos)
-            pos = new_pos
-            value, new_pos = read_string(data, pos)
-            pos = new_pos
-            
-            data_store[key] = value
-            expiry_store[key] = expiry_ms
-            
-        elif opcode == 0xFA: # Aux field (metadata)
-            key, new_pos = read_string(data, pos)
-            pos = new_pos
-            value, new_pos = read_string(data, pos)
-            pos = new_pos
-            
-        elif opcode == 0xFB: # Resize DB
+        elif opcode == RDB_OPCODE_EXPIRETIME:
+            expire_at = struct.unpack_from("<I", data, pos)[0] * 1000
+            pos += 4
+        elif opcode == RDB_OPCODE_SELECTDB:
+            # We only support one DB (0), so every DB is merged into it
+            _, pos = read_length(data, pos)
+        elif opcode == RDB_OPCODE_RESIZEDB:
             # Reads two length-encoded integers (db_size, expires_size)
-            _, new_pos = read_length(data, pos)
-            pos = new_pos
-            _, new_pos = read_length(data, pos)
-            pos = new_pos
-            
+            _, pos = read_length(data, pos)
+            _, pos = read_length(data, pos)
+        elif opcode == RDB_OPCODE_AUX:
+            # Metadata such as redis-ver; nothing here needs it
+            _, pos = read_blob(data, pos)
+            _, pos = read_blob(data, pos)
+        elif opcode == RDB_OPCODE_IDLE:
+            # LRU idle time of the next key; keys start fresh instead
+            _, pos = read_length(data, pos)
+        elif opcode == RDB_OPCODE_FREQ:
+            # LFU counter of the next key
+            pos += 1
+        elif opcode == RDB_OPCODE_SLOT_INFO:
+            # Cluster slot sizing hints: slot id, keys, volatile keys
+            for _ in range(3):
+                _, pos = read_length(data, pos)
+        elif opcode == RDB_OPCODE_FUNCTION2:
+            # Function library source; there is no scripting to load it into
+            _, pos = read_blob(data, pos)
+        elif opcode in (RDB_OPCODE_MODULE_AUX, RDB_OPCODE_FUNCTION_PRE_GA):
+            raise RDBError(f"Unsupported RDB opcode {opcode}")
         else:
-            # Assume it's a value type (0 = string) if it's not a special opcode
-            # Wait, standard RDB format has Value Type BEFORE Key
-            # But here, if we hit a Value Type directly, it means no expiry
-            value_type = opcode
-            if value_type == 0: # String
-                key, new_pos = read_string(data, pos)
-                pos = new_pos
-                value, new_pos = read_string(data, pos)
-                pos = new_pos
-                data_store[key] = value
+            # Anything else is the value type of a key
+            n = data[pos]
+            if n < 0x40:
+                key = data[pos+1:pos+1+n]
+                pos += 1 + n
+            else:
+                key, pos = read_string(data, pos)
+            if opcode == RDB_TYPE_STRING and data[pos] < 0x40:
+                n = data[pos]
+                value = data[pos+1:pos+1+n]
+                pos += 1 + n
             else:
-                 # TODO: Handle other types if necessary
-                 # For now, just try to read key/value as string? No, structure is different.
-                 print(f"Unknown Opcode or Type: {opcode}")
-                 break
+                value, pos = read_object(data, pos, opcode)
+            yield key, value, expire_at
+            expire_at = None
 
-    return data_store, expiry_store
+    raise RDBError("Unexpected end of RDB file")
+
+def dump_crc64(data, end):
+    # The CRC64 of data[:end], a chunk at a time so no copy of the whole
+    # dump is made
+    crc = 0
+    for start in range(0, end, RDB_LOAD_CHUNK):
+        crc = crc64(crc, data[start:min(start + RDB_LOAD_CHUNK, end)])
+    return crc
 
 def read_length(data, pos):
     """
@@ -101,42 +222,58 @@ def read_length(data, pos):
     """
     first_byte = data[pos]
     pos += 1
-    
+
     # 00xxxxxx: 6-bit length
     if (first_byte & 0xC0) == 0:
         length = first_byte & 0x3F
         return length, pos
-        
+
     # 01xxxxxx: 14-bit length
     elif (first_byte & 0xC0) == 0x40:
         next_byte = data[pos]
         pos += 1
         length = ((first_byte & 0x3F) << 8) | next_byte
         return length, pos
-        
-    # 10xxxxxx: 32-bit length
-    elif (first_byte & 0xC0) == 0x80:
-        length = struct.unpack(">I", data[pos:pos+4])[0]
+
+    # 10000000: 32-bit length, 10000001: 64-bit length
+    elif first_byte == 0x80:
+        length = struct.unpack_from(">I", data, pos)[0]
         pos += 4
         return length, pos
-        
-    # 11xxxxxx: Special format (encoded integer)
+    elif first_byte == 0x81:
+        length = struct.unpack_from(">Q", data, pos)[0]
+        pos += 8
+        return length, pos
+
+    # 11xxxxxx: Special format (signed integer stored as a string)
     elif (first_byte & 0xC0) == 0xC0:
         encoding_type = first_byte & 0x3F
         if encoding_type == 0: # 8 bit integer
-            val = int.from_bytes(data[pos:pos+1], 'little')
-            pos += 1
-            return val, pos
+            return struct.unpack_from("<b", data, pos)[0], pos + 1
         elif encoding_type == 1: # 16 bit integer
-            val = int.from_bytes(data[pos:pos+2], 'little')
-            pos += 2
-            return val, pos
+            return struct.unpack_from("<h", data, pos)[0], pos + 2
         elif encoding_type == 2: # 32 bit integer
-            val = int.from_bytes(data[pos:pos+4], 'little')
-            pos += 4
-            return val, pos
-            
-    return 0, pos
+            return struct.unpack_from("<i", data, pos)[0], pos + 4
+
+    raise RDBError(f"Unknown length encoding {first_byte:#x}")
+
+def read_blob(data, pos):
+    """
+    Reads a string from RDB data without decoding it. Plain strings come
+    back as a slice of `data`; LZF and integer-encoded strings have to be
+    materialised as bytes.
+    """
+    first_byte = data[pos]
+    if first_byte == 0xC3:
+        # LZF compressed string
+        compressed_len, pos = read_length(data, pos + 1)
+        length, pos = read_length(data, pos)
+        return lzf_decompress(data[pos:pos+compressed_len], length), pos + compressed_len
+    if (first_byte & 0xC0) == 0xC0:
+        val, pos = read_length(data, pos)
+        return b"%d" % val, pos
+    length, pos = read_length(data, pos)
+    return data[pos:pos+length], pos + length
 
 def read_string(data, pos):
     """
@@ -144,59 +281,320 @@ def read_string(data, pos):
     First reads length (which might indicate integer encoding), then reads content.
     """
     first_byte = data[pos]
-    
-    # Check if it's length encoded or special integer encoding
-    # 11xxxxxx indicates special integer encoding for the string object itself
-    if (first_byte & 0xC0) == 0xC0:
-        # It's an integer encoded as a string
-        val, new_pos = read_length(data, pos)
-        return str(val), new_pos
-        
-    length, new_pos = read_length(data, pos)
-    pos = new_pos
-    
-    val = data[pos:pos+length].decode()
-    pos += length
-    
-    return val, pos
+    if first_byte < 0x40:
+        # Short plain string, by far the most common case
+        end = pos + 1 + first_byte
+        return bytes(data[pos+1:end]), end
+    blob, pos = read_blob(data, pos)
+    return blob if blob.__class__ is bytes else bytes(blob), pos
+
+def read_double_string(data, pos):
+    # Pre-RDB 8 zset scores: length byte, then the score as ASCII
+    length = data[pos]
+    pos += 1
+    if length == 253:
+        return float("nan"), pos
+    if length == 254:
+        return float("inf"), pos
+    if length == 255:
+        return float("-inf"), pos
+    return float(str(data[pos:pos+length], "ascii")), pos + length
 
-def save_rdb(filename, data_store, expiry_store):
+def read_object(data, pos, value_type):
     """
-    Saves the current state to an RDB file.
+    Reads a value of `value_type` and returns (value, new_pos). Strings
+    load as bytes, lists as list, sets as set, hashes as dict and sorted
+    sets as SortedSet, whatever encoding they were saved in.
     """
-    with open(filename, "wb") as f:
-        # Header
-        f.write(b"REDIS0009")
-        
-        # Database Selection (DB 0)
-        f.write(b"\xFE\x00")
-        
-        # Iterate through data
-        for key, value in data_store.items():
-            # Check expiry
-            if key in expiry_store:
-                expiry = expiry_store[key]
-                if time.time() * 1000 > expiry:
-                    continue # Skip expired keys
-                
-                # Write Expire Time (ms)
-                f.write(b"\xFC")
-                f.write(struct.pack("<Q", int(expiry)))
-                
-            # Value Type (0 = String)
-            f.write(b"\x00")
+    if value_type == RDB_TYPE_STRING:
+        return read_string(data, pos)
+
+    if value_type in (RDB_TYPE_LIST, RDB_TYPE_SET):
+        count, pos = read_length(data, pos)
+        items = []
+        for _ in range(count):
+            item, pos = read_string(data, pos)
+            items.append(item)
+        return (items if value_type == RDB_TYPE_LIST else set(items)), pos
+
+    if value_type == RDB_TYPE_HASH:
+        count, pos = read_length(data, pos)
+        value = {}
+        for _ in range(count):
+            field, pos = read_string(data, pos)
+            value[field], pos = read_string(data, pos)
+        return value, pos
+
+    if value_type in (RDB_TYPE_ZSET, RDB_TYPE_ZSET_2):
+        count, pos = read_length(data, pos)
+        value = SortedSet()
+        for _ in range(count):
+            member, pos = read_string(data, pos)
+            if value_type == RDB_TYPE_ZSET_2:
+                value[member] = struct.unpack_from("<d", data, pos)[0]
+                pos += 8
+            else:
+                value[member], pos = read_double_string(data, pos)
+        return value, pos
+
+    if value_type in (RDB_TYPE_LIST_QUICKLIST, RDB_TYPE_LIST_QUICKLIST_2):
+        count, pos = read_length(data, pos)
+        value = []
+        for _ in range(count):
+            container = QUICKLIST_NODE_PACKED
+            if value_type == RDB_TYPE_LIST_QUICKLIST_2:
+                container, pos = read_length(data, pos)
+            blob, pos = read_blob(data, pos)
+            if container == QUICKLIST_NODE_PLAIN:
+                value.append(bytes(blob))
+            elif value_type == RDB_TYPE_LIST_QUICKLIST:
+                value.extend(parse_ziplist(blob))
+            else:
+                value.extend(parse_listpack(blob))
+        return value, pos
+
+    if value_type in (RDB_TYPE_HASH_ZIPMAP, RDB_TYPE_LIST_ZIPLIST, RDB_TYPE_SET_INTSET,
+                      RDB_TYPE_ZSET_ZIPLIST, RDB_TYPE_HASH_ZIPLIST, RDB_TYPE_HASH_LISTPACK,
+                      RDB_TYPE_ZSET_LISTPACK, RDB_TYPE_SET_LISTPACK):
+        # Compact encodings are a single string holding a packed structure
+        blob, pos = read_blob(data, pos)
+        if value_type == RDB_TYPE_HASH_ZIPMAP:
+            return parse_zipmap(blob), pos
+        if value_type == RDB_TYPE_SET_INTSET:
+            return set(parse_intset(blob)), pos
+        if value_type in (RDB_TYPE_LIST_ZIPLIST, RDB_TYPE_ZSET_ZIPLIST, RDB_TYPE_HASH_ZIPLIST):
+            items = parse_ziplist(blob)
+        else:
+            items = parse_listpack(blob)
+        if value_type == RDB_TYPE_LIST_ZIPLIST:
+            return items, pos
+        if value_type == RDB_TYPE_SET_LISTPACK:
+            return set(items), pos
+        pairs = zip(items[0::2], items[1::2])
+        if value_type in (RDB_TYPE_HASH_ZIPLIST, RDB_TYPE_HASH_LISTPACK):
+            return dict(pairs), pos
+        return SortedSet((member, float(score)) for member, score in pairs), pos
+
+    raise RDBError(f"Unsupported RDB value type {value_type}")
+
+def parse_ziplist(blob):
+    """
+    Returns the entries of a ziplist as bytes.
+    """
+    items = []
+    pos = 10 # zlbytes, zltail, zllen
+    while True:
+        # Previous entry length: 1 byte, or 0xFE and 4 more
+        prevlen = blob[pos]
+        if prevlen == 0xFF:
+            return items
+        pos += 5 if prevlen == 0xFE else 1
+        encoding = blob[pos]
+        kind = encoding >> 6
+        if kind == 0:
+            length = encoding & 0x3F
+            pos += 1
+        elif kind == 1:
+            length = ((encoding & 0x3F) << 8) | blob[pos + 1]
+            pos += 2
+        elif kind == 2:
+            length = struct.unpack_from(">I", blob, pos + 1)[0]
+            pos += 5
+        else:
+            if encoding == 0xC0:
+                val, size = struct.unpack_from("<h", blob, pos + 1)[0], 2
+            elif encoding == 0xD0:
+                val, size = struct.unpack_from("<i", blob, pos + 1)[0], 4
+            elif encoding == 0xE0:
+                val, size = struct.unpack_from("<q", blob, pos + 1)[0], 8
+            elif encoding == 0xF0:
+                val, size = int.from_bytes(blob[pos+1:pos+4], "little", signed=True), 3
+            elif encoding == 0xFE:
+                val, size = struct.unpack_from("<b", blob, pos + 1)[0], 1
+            elif 0xF1 <= encoding <= 0xFD:
+                # 4-bit immediate 0..12
+                val, size = (encoding & 0x0F) - 1, 0
+            else:
+                raise RDBError(f"Unknown ziplist encoding {encoding:#x}")
+            items.append(b"%d" % val)
+            pos += 1 + size
+            continue
+        items.append(bytes(blob[pos:pos+length]))
+        pos += length
+
+def parse_listpack(blob):
+    """
+    Returns the entries of a listpack as bytes.
+    """
+    items = []
+    pos = 6 # Total bytes, element count
+    while True:
+        encoding = blob[pos]
+        if encoding == 0xFF:
+            return items
+        if encoding < 0x80:
+            # 7-bit unsigned integer
+            val, entry_len = encoding, 1
+        elif encoding < 0xC0:
+            # 6-bit string length
+            length = encoding & 0x3F
+            items.append(bytes(blob[pos+1:pos+1+length]))
+            entry_len = 1 + length
+            val = None
+        elif encoding < 0xE0:
+            # 13-bit signed integer
+            val = ((encoding & 0x1F) << 8) | blob[pos + 1]
+            if val >= 1 << 12:
+                val -= 1 << 13
+            entry_len = 2
+        elif encoding < 0xF0:
+            # 12-bit string length
+            length = ((encoding & 0x0F) << 8) | blob[pos + 1]
+            items.append(bytes(blob[pos+2:pos+2+length]))
+            entry_len = 2 + length
+            val = None
+        elif encoding == 0xF0:
+            # 32-bit string length
+            length = struct.unpack_from("<I", blob, pos + 1)[0]
+            items.append(bytes(blob[pos+5:pos+5+length]))
+            entry_len = 5 + length
+            val = None
+        elif encoding in LISTPACK_INT_SIZES:
+            size = LISTPACK_INT_SIZES[encoding]
+            val = int.from_bytes(blob[pos+1:pos+1+size], "little", signed=True)
+            entry_len = 1 + size
+        else:
+            raise RDBError(f"Unknown listpack encoding {encoding:#x}")
+        if val is not None:
+            items.append(b"%d" % val)
+        # Skip the entry and its back-length, which takes 1 byte per 7 bits
+        pos += entry_len + (1 if entry_len < 128 else 2 if entry_len < 16384 else
+                            3 if entry_len < 2097152 else 4 if entry_len < 268435456 else 5)
+
+# Listpack integer encodings and their sizes in bytes
+LISTPACK_INT_SIZES = {0xF1: 2, 0xF2: 3, 0xF3: 4, 0xF4: 8}
+
+def parse_intset(blob):
+    """
+    Returns the members of an intset as bytes.
+    """
+    width, count = struct.unpack_from("<II", blob, 0)
+    fmt = {2: "h", 4: "i", 8: "q"}.get(width)
+    if fmt is None:
+        raise RDBError(f"Unknown intset encoding {width}")
+    return [b"%d" % val for val in struct.unpack_from(f"<{count}{fmt}", blob, 8)]
+
+def parse_zipmap(blob):
+    """
+    Returns the field/value pairs of a zipmap (hashes before Redis 2.6).
+    """
+    value = {}
+    pos = 1 # zmlen
+    while blob[pos] != 0xFF:
+        field, pos = zipmap_string(blob, pos, False)
+        value[field], pos = zipmap_string(blob, pos, True)
+    return value
+
+def zipmap_string(blob, pos, has_free):
+    length = blob[pos]
+    pos += 1
+    if length == 254:
+        length = struct.unpack_from("<I", blob, pos)[0]
+        pos += 4
+    free = 0
+    if has_free:
+        free = blob[pos]
+        pos += 1
+    return bytes(blob[pos:pos+length]), pos + length + free
+
+def save_rdb(filename, items, compression=False, checksum=True):
+    """
+    Saves `items`, an iterable of (key, value, expire_at_ms or None), to an
+    RDB file.
+
+    The dump is built in a large buffer that is flushed in big writes to a
+    temp file next to `filename`; the temp file is fsynced and renamed over
+    `filename`, so a crash mid-save leaves the previous dump intact. The
+    trailer is a CRC64 of everything before it, or 0 without `checksum`.
+    With `compression`, strings longer than 20 bytes are stored
+    LZF-compressed when that saves space.
+    Returns (keys_written, bytes_written, seconds).
+    """
+    start = time.perf_counter()
+    directory = os.path.dirname(filename) or "."
+    temp_filename = os.path.join(directory, f"temp-{os.getpid()}-{threading.get_ident()}.rdb")
+    crc = 0
+    keys = 0
+    written = 0
+    buf = bytearray()
+    # Strings shorter than this have a 6-bit length and are never compressed
+    inline_max = 21 if compression else 64
+    try:
+        with open(temp_filename, "wb") as f:
+            # Header
+            buf += b"REDIS0009"
             
-            # Key
-            f.write(encode_string(key))
+            # Database Selection (DB 0)
+            buf += b"\xFE\x00"
             
-            # Value
-            f.write(encode_string(value))
+            for key, value, expire_at in items:
+                if expire_at is not None:
+                    # Write Expire Time (ms)
+                    buf += b"\xFC"
+                    buf += struct.pack("<Q", int(expire_at))
+
+                # The common case inline: a string value under 16KB, under a
+                # short key, neither of them to be compressed
+                n = len(value) if value.__class__ is bytes else 16384
+                if (key.__class__ is not bytes or len(key) >= inline_max or n >= 16384
+                        or (compression and n >= inline_max)):
+                    encode_object(buf, key, value, compression)
+                elif n < 64:
+                    buf += b"\x00%c%b%c%b" % (len(key), key, n, value)
+                else:
+                    buf += b"\x00%c%b%c%c%b" % (len(key), key, 0x40 | n >> 8, n & 0xFF, value)
+                keys += 1
+
+                if len(buf) >= RDB_BUFFER_SIZE:
+                    if checksum:
+                        crc = crc64(crc, buf)
+                    f.write(buf)
+                    written += len(buf)
+                    buf.clear()
+                
+            # EOF
+            buf += b"\xFF"
+            if checksum:
+                crc = crc64(crc, buf)
             
-        # EOF
-        f.write(b"\xFF")
-        
-        # Checksum (8 bytes) - using 0 as placeholder
-        f.write(b"\x00" * 8)
+            # Checksum (8 bytes)
+            buf += struct.pack("<Q", crc)
+            f.write(buf)
+            written += len(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+        raise
+    fsync_directory(directory)
+    return keys, written, time.perf_counter() - start
+
+def fsync_directory(directory):
+    # Makes the rename itself durable; not possible on every platform
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
         
 def encode_length(length):
     """
@@ -208,14 +606,221 @@ def encode_length(length):
     elif length < 16384:
         # 01xxxxxx
         return struct.pack(">H", length | 0x4000)
-    else:
-        # 10xxxxxx + 4 bytes
+    elif length <= 0xFFFFFFFF:
+        # 10000000 + 4 bytes
         return b"\x80" + struct.pack(">I", length)
+    else:
+        # 10000001 + 8 bytes
+        return b"\x81" + struct.pack(">Q", length)
 
-def encode_string(s):
+def encode_object(buf, key, value, compression=False):
+    """
+    Appends the type, key and value of one key to `buf`. Collections are
+    written in the plain (non-packed) encodings, which every version of the
+    loader reads.
+    """
+    kind = value_type(value)
+    if kind == "string":
+        buf.append(RDB_TYPE_STRING)
+        buf += encode_string(key, compression)
+        buf += encode_string(value, compression)
+    elif kind == "zset":
+        buf.append(RDB_TYPE_ZSET_2)
+        buf += encode_string(key, compression)
+        buf += encode_length(len(value))
+        for member, score in value.items():
+            buf += encode_string(member, compression)
+            buf += struct.pack("<d", score)
+    elif kind == "hash":
+        buf.append(RDB_TYPE_HASH)
+        buf += encode_string(key, compression)
+        buf += encode_length(len(value))
+        for field, field_value in value.items():
+            buf += encode_string(field, compression)
+            buf += encode_string(field_value, compression)
+    elif kind in ("list", "set"):
+        buf.append(RDB_TYPE_LIST if kind == "list" else RDB_TYPE_SET)
+        buf += encode_string(key, compression)
+        buf += encode_length(len(value))
+        for item in value:
+            buf += encode_string(item, compression)
+    else:
+        raise RDBError(f"Can't save value of type {type(value).__name__}")
+
+def encode_string(s, compression=False):
     """
     Encodes a string into RDB format bytes.
     """
-    encoded = s.encode()
+    if isinstance(s, int):
+        # 110000xx: an integer in 1, 2 or 4 bytes; larger ones are written as text
+        for encoding, fmt in ((0xC0, "<b"), (0xC1, "<h"), (0xC2, "<i")):
+            try:
+                return bytes([encoding]) + struct.pack(fmt, s)
+            except struct.error:
+                pass
+        s = b"%d" % s
+    encoded = s.encode() if isinstance(s, str) else s
     length = len(encoded)
+    if compression and length > 20:
+        compressed = lzf_compress(encoded)
+        if len(compressed) < length - 4:
+            # 11000011: LZF compressed string
+            return b"\xC3" + encode_length(len(compressed)) + encode_length(length) + compressed
     return encode_length(length) + encoded
+
+def make_crc64_table():
+    # CRC-64/Jones, reflected, as used by Redis for the RDB trailer
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x95AC9329AC4BC9B5 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC64_TABLE = make_crc64_table()
+
+# Inputs shorter than this go through the table a byte at a time; longer
+# ones are reduced as one big integer (see crc64())
+CRC64_BULK_MIN = 1024
+
+# The CRC polynomial G(x), not reflected, with its x^64 term
+CRC64_POLY = (1 << 64) | 0xAD93D23594C935A9
+
+BIT_REVERSED = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+def reverse64(n):
+    return int.from_bytes(n.to_bytes(8, "little").translate(BIT_REVERSED), "big")
+
+def gf2_mod_small(a):
+    # a mod G(x) over GF(2), for an `a` of a few words
+    length = a.bit_length()
+    while length > 64:
+        a ^= CRC64_POLY << (length - 65)
+        length = a.bit_length()
+    return a
+
+def gf2_mul(a, c):
+    """
+    Carry-less product of a (of any size) and c (64 bits), three bits of c
+    at a time from a table of the 8 multiples of a.
+    """
+    a2 = a << 1
+    a4 = a << 2
+    a6 = a4 ^ a2
+    multiples = (0, a, a2, a2 ^ a, a4, a4 ^ a, a6, a6 ^ a)
+    product = 0
+    shift = 0
+    while c:
+        if c & 7:
+            product ^= multiples[c & 7] << shift
+        c >>= 3
+        shift += 3
+    return product
+
+# x^(2^b) mod G(x), the constants crc64() folds with
+CRC64_FOLDS = [2]
+for _ in range(63):
+    CRC64_FOLDS.append(gf2_mod_small(gf2_mul(CRC64_FOLDS[-1], CRC64_FOLDS[-1])))
+
+def crc64(crc, data):
+    """
+    Continues the CRC64 `crc` over `data`.
+
+    Without an initial or final XOR the CRC is plain polynomial arithmetic:
+    with each byte's bits reversed, `data` read big-endian is a polynomial
+    M(x), and the (unreflected) CRC is (crc·x^n + M(x)·x^64) mod G(x) for
+    n bits of data. A long input is reduced in that form as one integer,
+    folding its top half onto the bottom one (a = hi·x^k + lo ≡
+    hi·(x^k mod G) + lo) until it fits in a word, so the work happens in C
+    on whole buffers: about 8x faster than the table on 1MB.
+    """
+    n = len(data)
+    if n < CRC64_BULK_MIN:
+        table = CRC64_TABLE
+        for byte in data:
+            crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+        return crc
+    a = (reverse64(crc) << 8 * n) ^ (int.from_bytes(bytes(data).translate(BIT_REVERSED), "big") << 64)
+    length = a.bit_length()
+    while length > 128:
+        b = (length - 1).bit_length() - 1 # The largest power of two below length
+        a = (a & ((1 << (1 << b)) - 1)) ^ gf2_mul(a >> (1 << b), CRC64_FOLDS[b])
+        length = a.bit_length()
+    return reverse64(gf2_mod_small(a))
+
+def lzf_compress(data):
+    """
+    LZF-compresses `data` (the liblzf format Redis uses for RDB strings).
+    """
+    out = bytearray()
+    table = {}
+    n = len(data)
+    literal_start = 0
+    ip = 0
+    while ip < n - 2:
+        triple = data[ip:ip + 3]
+        ref = table.get(triple)
+        table[triple] = ip
+        if ref is None or ip - ref > 8192:
+            ip += 1
+            continue
+
+        max_len = min(264, n - ip)
+        length = 3
+        while length < max_len and data[ref + length] == data[ip + length]:
+            length += 1
+
+        lzf_literals(out, data, literal_start, ip)
+        offset = ip - ref - 1
+        encoded_len = length - 2
+        if encoded_len < 7:
+            out.append((encoded_len << 5) | (offset >> 8))
+        else:
+            out.append((7 << 5) | (offset >> 8))
+            out.append(encoded_len - 7)
+        out.append(offset & 0xFF)
+        ip += length
+        literal_start = ip
+
+    lzf_literals(out, data, literal_start, n)
+    return bytes(out)
+
+def lzf_literals(out, data, start, end):
+    # Literal runs are at most 32 bytes, each preceded by its length - 1
+    while start < end:
+        run = min(32, end - start)
+        out.append(run - 1)
+        out += data[start:start + run]
+        start += run
+
+def lzf_decompress(data, expected_length):
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            # Literal run
+            out += data[i:i + ctrl + 1]
+            i += ctrl + 1
+            continue
+        length = ctrl >> 5
+        if length == 7:
+            length += data[i]
+            i += 1
+        ref = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+        i += 1
+        length += 2
+        if ref < 0:
+            raise RDBError("Invalid LZF back reference")
+        if ref + length <= len(out):
+            out += out[ref:ref + length]
+        else:
+            # Overlapping copy repeats the last bytes
+            for k in range(length):
+                out.append(out[ref + k])
+    if len(out) != expected_length:
+        raise RDBError("LZF decompressed length mismatch")
+    return bytes(out)
@@ -0,0 +1,165 @@
+import os
+import socket
+
+from app.aof import encode_command
+
+# Seconds to wait on the master during the handshake and the RDB transfer
+REPL_TIMEOUT = 60
+
+# Bytes read from the master per step of the RDB transfer
+REPL_TRANSFER_CHUNK = 1024 * 1024
+
+class ReplicationError(Exception):
+    pass
+
+def new_replid():
+    """
+    A replication ID: 40 random hex digits naming one history of the
+    dataset, which an offset is a position in.
+    """
+    return os.urandom(20).hex()
+
+class ReplicationBacklog:
+    """
+    The last `size` bytes of the replication stream, in a ring buffer, so a
+    replica that lost its connection can be sent just what it missed
+    (PSYNC) instead of the whole dataset again.
+
+    `offset` is the replication offset: how many bytes the stream has had
+    in all, the first one being offset 1 as in Redis.
+    """
+    def __init__(self, size, offset=0):
+        self.size = size
+        self.buf = bytearray(size)
+        self.idx = 0     # Where the next byte goes
+        self.histlen = 0 # Bytes of history held, at most size
+        self.offset = offset
+
+    def feed(self, data):
+        n = len(data)
+        self.offset += n
+        if n >= self.size:
+            self.buf[:] = data[n - self.size:]
+            self.idx = 0
+            self.histlen = self.size
+            return
+        end = self.idx + n
+        if end <= self.size:
+            self.buf[self.idx:end] = data
+        else:
+            first = self.size - self.idx
+            self.buf[self.idx:] = data[:first]
+            self.buf[:n - first] = data[first:]
+        self.idx = end % self.size
+        self.histlen = min(self.size, self.histlen + n)
+
+    def first_byte_offset(self):
+        return self.offset - self.histlen + 1
+
+    def since(self, offset):
+        """
+        The stream from replication offset `offset` on, or None if it is no
+        longer (or not yet) held.
+        """
+        n = self.offset - offset + 1
+        if n < 0 or n > self.histlen:
+            return None
+        start = (self.idx - n) % self.size
+        if start + n <= self.size:
+            return bytes(self.buf[start:start + n])
+        return bytes(self.buf[start:]) + bytes(self.buf[:n - (self.size - start)])
+
+class SyncResult:
+    """
+    What sync_with_master() got: the connection to `master` (host, port)
+    to keep reading the stream from, the replication ID and offset it
+    starts at, whether `rdb_path` holds a full copy of the dataset to load
+    first, and bytes of the stream already read past the handshake.
+    """
+    def __init__(self, sock, master, replid, offset, full, leftover, rdb_path):
+        self.sock = sock
+        self.master = master
+        self.replid = replid
+        self.offset = offset
+        self.full = full
+        self.leftover = leftover
+        self.rdb_path = rdb_path
+
+class _Reader:
+    # Line and bulk reads over a blocking socket, for the handshake
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray()
+
+    def fill(self):
+        data = self.sock.recv(REPL_TRANSFER_CHUNK)
+        if not data:
+            raise ReplicationError("master closed the connection")
+        self.buf += data
+
+    def line(self):
+        while True:
+            end = self.buf.find(b"\r\n")
+            if end != -1:
+                line = bytes(self.buf[:end])
+                del self.buf[:end + 2]
+                return line
+            self.fill()
+
+    def command(self, *args):
+        self.sock.sendall(encode_command(list(args)))
+        reply = self.line()
+        if reply.startswith(b"-"):
+            raise ReplicationError(f"{b' '.join(args).decode(errors='replace')} failed: {reply[1:].decode(errors='replace')}")
+        return reply
+
+def sync_with_master(host, port, listening_port, replid, offset, rdb_path):
+    """
+    Connects to the master and asks to continue from `offset` of `replid`
+    (PSYNC); with replid None, or if the master no longer has that part of
+    the stream, it sends the whole dataset as an RDB file instead, which is
+    written to `rdb_path`. Blocks, so it runs in its own thread. Raises
+    ReplicationError or OSError.
+    """
+    sock = socket.create_connection((host, port), timeout=REPL_TIMEOUT)
+    try:
+        reader = _Reader(sock)
+        reader.command(b"PING")
+        reader.command(b"REPLCONF", b"listening-port", b"%d" % listening_port)
+        reader.command(b"REPLCONF", b"capa", b"psync2")
+        if replid is None:
+            reply = reader.command(b"PSYNC", b"?", b"-1")
+        else:
+            reply = reader.command(b"PSYNC", replid.encode(), b"%d" % (offset + 1))
+        parts = reply.split()
+
+        if parts[0] == b"+CONTINUE":
+            if len(parts) > 1:
+                replid = parts[1].decode()
+            return SyncResult(sock, (host, port), replid, offset, False, bytes(reader.buf), None)
+        if parts[0] != b"+FULLRESYNC" or len(parts) != 3:
+            raise ReplicationError(f"unexpected reply to PSYNC: {reply.decode(errors='replace')}")
+        replid, offset = parts[1].decode(), int(parts[2])
+
+        # A master may send bare newlines to keep the link alive while it
+        # produces the RDB file
+        header = reader.line().lstrip(b"\n")
+        if not header.startswith(b"$"):
+            raise ReplicationError(f"bad RDB transfer header {header.decode(errors='replace')}")
+        remaining = int(header[1:])
+        with open(rdb_path, "wb") as f:
+            # The file has no trailing CRLF; whatever follows is the stream
+            chunk = reader.buf[:remaining]
+            f.write(chunk)
+            remaining -= len(chunk)
+            del reader.buf[:len(chunk)]
+            while remaining:
+                data = sock.recv(min(remaining, REPL_TRANSFER_CHUNK))
+                if not data:
+                    raise ReplicationError("master closed the connection during the RDB transfer")
+                f.write(data)
+                remaining -= len(data)
+        return SyncResult(sock, (host, port), replid, offset, True, bytes(reader.buf), rdb_path)
+    except BaseException:
+        sock.close()
+        raise
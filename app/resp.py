@@ -0,0 +1,271 @@
+READ_CHUNK_SIZE = 16384
+MAX_INLINE_SIZE = 64 * 1024
+MAX_BULK_LEN = 512 * 1024 * 1024
+MAX_MULTIBULK_LEN = 1024 * 1024
+
+class ProtocolError(ValueError):
+    pass
+
+class RESPParser:
+    """
+    Incremental RESP request parser.
+
+    The parser owns a growable receive buffer. Callers read straight into it
+    (`sock.recv_into(parser.get_buffer())` followed by `parser.advance(n)`)
+    or copy bytes in with `feed()`, then call `get_command()` until it
+    returns None. Partially received commands are kept as parser state, so
+    no byte is scanned twice and nothing is re-sliced between `recv` calls.
+    """
+    def __init__(self, size=READ_CHUNK_SIZE):
+        self.buf = bytearray(size)
+        self.pos = 0  # Read cursor
+        self.end = 0  # End of received data
+        # State of the multibulk command currently being assembled
+        self.multibulk_len = 0
+        self.bulk_len = -1
+        self.args = []
+
+    def get_buffer(self, min_free=READ_CHUNK_SIZE):
+        """
+        Returns a writable memoryview over the free tail of the buffer,
+        large enough for the pending bulk string when one is known.
+        """
+        buf = self.buf
+        if self.pos == self.end:
+            self.pos = self.end = 0
+            if len(buf) > 4 * READ_CHUNK_SIZE:
+                # Drop the memory a previous large value needed
+                buf = self.buf = bytearray(READ_CHUNK_SIZE)
+
+        need = min_free
+        if self.bulk_len >= 0:
+            need = max(need, self.bulk_len + 2 - (self.end - self.pos))
+
+        if len(buf) - self.end < need:
+            if self.pos:
+                pending = self.end - self.pos
+                buf[:pending] = buf[self.pos:self.end]
+                self.pos = 0
+                self.end = pending
+            if len(buf) - self.end < need:
+                buf.extend(bytes(need - (len(buf) - self.end)))
+        return memoryview(buf)[self.end:]
+
+    def advance(self, n):
+        self.end += n
+
+    def feed(self, data):
+        view = self.get_buffer(len(data))
+        view[:len(data)] = data
+        view.release()
+        self.advance(len(data))
+
+    def has_pending(self):
+        return self.pos < self.end or self.multibulk_len > 0
+
+    def get_command(self):
+        """
+        Returns the next complete command as a list of arguments, or None
+        if the buffer does not hold one yet. Raises ProtocolError for input
+        that can never become a valid command.
+        """
+        while True:
+            if self.multibulk_len == 0:
+                if self.pos >= self.end:
+                    return None
+                if self.buf[self.pos] != 42: # '*'
+                    args = self.parse_inline()
+                    if args is None:
+                        return None
+                    if args:
+                        return args
+                    continue # Empty line, nothing to run
+                if not self.parse_multibulk_header():
+                    return None
+                if self.multibulk_len == 0:
+                    continue # Zero-length array, nothing to run
+
+            if not self.parse_bulk_strings():
+                return None
+            args = self.args
+            self.args = []
+            return args
+
+    def parse_inline(self):
+        buf = self.buf
+        newline = buf.find(b"\n", self.pos, self.end)
+        if newline == -1:
+            if self.end - self.pos > MAX_INLINE_SIZE:
+                raise ProtocolError("too big inline request")
+            return None
+        line = bytes(buf[self.pos:newline])
+        self.pos = newline + 1
+        return line.split()
+
+    def parse_multibulk_header(self):
+        buf = self.buf
+        newline = buf.find(b"\r\n", self.pos, self.end)
+        if newline == -1:
+            if self.end - self.pos > MAX_INLINE_SIZE:
+                raise ProtocolError("too big mbulk count string")
+            return False
+        try:
+            count = int(buf[self.pos + 1:newline])
+        except ValueError:
+            raise ProtocolError("invalid multibulk length")
+        if count > MAX_MULTIBULK_LEN:
+            raise ProtocolError("invalid multibulk length")
+        self.pos = newline + 2
+        if count > 0:
+            self.multibulk_len = count
+            self.args = []
+        return True
+
+    def parse_bulk_strings(self):
+        """
+        Consumes as many bulk strings of the current command as are fully
+        buffered. Returns True once the command is complete.
+        """
+        with memoryview(self.buf) as view:
+            return self._parse_bulk_strings(view)
+
+    def _parse_bulk_strings(self, view):
+        # Arguments are copied out of the buffer once, as bytes; nothing is
+        # decoded.
+        buf = self.buf
+        pos = self.pos
+        end = self.end
+        args = self.args
+        while self.multibulk_len:
+            if self.bulk_len == -1:
+                if pos >= end:
+                    break
+                if buf[pos] != 36: # '$'
+                    self.pos = pos
+                    raise ProtocolError(f"expected '$', got '{chr(buf[pos])}'")
+                newline = buf.find(b"\r\n", pos, end)
+                if newline == -1:
+                    if end - pos > MAX_INLINE_SIZE:
+                        raise ProtocolError("too big bulk count string")
+                    break
+                try:
+                    length = int(buf[pos + 1:newline])
+                except ValueError:
+                    raise ProtocolError("invalid bulk length")
+                if length < 0 or length > MAX_BULK_LEN:
+                    raise ProtocolError("invalid bulk length")
+                self.bulk_len = length
+                pos = newline + 2
+
+            if end - pos < self.bulk_len + 2:
+                break
+            args.append(bytes(view[pos:pos + self.bulk_len]))
+            pos += self.bulk_len + 2
+            self.bulk_len = -1
+            self.multibulk_len -= 1
+
+        self.pos = pos
+        return self.multibulk_len == 0
+
+# Replies. Constant replies and the headers of small integers, bulk strings
+# and arrays are built once at import time and shared, so the common
+# replies allocate nothing.
+
+OBJ_SHARED_INTEGERS = 10000
+OBJ_SHARED_HDR_LEN = 32
+
+OK = b"+OK\r\n"
+PONG = b"+PONG\r\n"
+QUEUED = b"+QUEUED\r\n"
+NULL_BULK = b"$-1\r\n"
+NULL_ARRAY = b"*-1\r\n"
+EMPTY_ARRAY = b"*0\r\n"
+EMPTY_BULK = b"$0\r\n\r\n"
+CRLF = b"\r\n"
+
+SYNTAX_ERROR = b"-ERR syntax error\r\n"
+NOT_INTEGER_ERROR = b"-ERR value is not an integer or out of range\r\n"
+WRONGTYPE_ERROR = b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+LOADING_ERROR = b"-LOADING Redis is loading the dataset in memory\r\n"
+OOM_ERROR = b"-OOM command not allowed when used memory > 'maxmemory'.\r\n"
+
+SHARED_INTEGERS = [b":%d\r\n" % n for n in range(OBJ_SHARED_INTEGERS)]
+ZERO, ONE = SHARED_INTEGERS[0], SHARED_INTEGERS[1]
+SHARED_BULK_HEADERS = [b"$%d\r\n" % n for n in range(OBJ_SHARED_HDR_LEN)]
+SHARED_MULTIBULK_HEADERS = [b"*%d\r\n" % n for n in range(OBJ_SHARED_HDR_LEN)]
+
+def encode_bulk_string(s):
+    if s is None:
+        return NULL_BULK
+    if isinstance(s, str):
+        s = s.encode()
+    n = len(s)
+    header = SHARED_BULK_HEADERS[n] if n < OBJ_SHARED_HDR_LEN else b"$%d\r\n" % n
+    # Values are bytes already, so they are copied once and never transcoded
+    return b"".join((header, s, CRLF))
+
+def encode_simple_string(s):
+    return b"+%b\r\n" % s.encode()
+
+def encode_error(msg):
+    return b"-ERR %b\r\n" % msg.encode()
+
+def encode_integer(n):
+    if 0 <= n < OBJ_SHARED_INTEGERS:
+        return SHARED_INTEGERS[n]
+    return b":%d\r\n" % n
+
+def encode_array(arr):
+    """
+    Encodes a list of bulk strings (bytes or str), integers, None and
+    nested lists. The pieces are collected and joined once, so the cost
+    is linear in the size of the reply.
+    """
+    parts = []
+    append_array(parts, arr)
+    return b"".join(parts)
+
+def append_array(parts, arr):
+    n = len(arr)
+    parts.append(SHARED_MULTIBULK_HEADERS[n] if n < OBJ_SHARED_HDR_LEN else b"*%d\r\n" % n)
+    append_items(parts, arr)
+
+def append_items(parts, arr):
+    for item in arr:
+        if isinstance(item, bytes):
+            n = len(item)
+            parts.append(SHARED_BULK_HEADERS[n] if n < OBJ_SHARED_HDR_LEN else b"$%d\r\n" % n)
+            parts.append(item)
+            parts.append(CRLF)
+        elif isinstance(item, int):
+            parts.append(encode_integer(item))
+        elif isinstance(item, list):
+            append_array(parts, item)
+        else:
+            parts.append(encode_bulk_string(item))
+
+# RESP3 types, for clients that asked for them with HELLO 3. Requests are
+# arrays of bulk strings in both versions, so only replies differ; the
+# RESP2 nil and array replies are read by RESP3 clients too, so they stay.
+
+RESP3_NULL = b"_\r\n"
+
+def encode_map(pairs):
+    """
+    Encodes a dict as a RESP3 map; keys and values are what encode_array()
+    takes.
+    """
+    parts = [b"%%%d\r\n" % len(pairs)]
+    for key, value in pairs.items():
+        append_items(parts, (key, value))
+    return b"".join(parts)
+
+def encode_push(arr):
+    """
+    Encodes a RESP3 push: data the server sends on its own, like Pub/Sub
+    messages and invalidations, which a client tells from the reply to
+    its current command by the type.
+    """
+    parts = [b">%d\r\n" % len(arr)]
+    append_items(parts, arr)
+    return b"".join(parts)
@@ -0,0 +1,59 @@
+import re
+
+def compile_pattern(pattern):
+    """
+    Compiles a Redis glob-style pattern (bytes) into a function that tells
+    whether a whole key matches it:
+
+        *       any run of bytes, including none
+        ?       any single byte
+        [abc]   one of the listed bytes; [^abc] any other; [a-z] a range
+        \\x      x itself, even if it is one of the special characters
+
+    As in Redis, an unterminated [ closes at the end of the pattern and a
+    reversed range such as [z-a] is the same as [a-z].
+    """
+    out = bytearray()
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == 42: # '*'
+            while i + 1 < n and pattern[i + 1] == 42:
+                i += 1
+            out += b".*"
+        elif c == 63: # '?'
+            out += b"."
+        elif c == 91: # '['
+            i += 1
+            negate = i < n and pattern[i] == 94 # '^'
+            if negate:
+                i += 1
+            items = bytearray()
+            while i < n and pattern[i] != 93: # ']'
+                if pattern[i] == 92 and i + 1 < n: # '\'
+                    i += 1
+                    items += escape(pattern[i])
+                elif i + 2 < n and pattern[i + 1] == 45: # '-'
+                    start, end = sorted((pattern[i], pattern[i + 2]))
+                    items += escape(start) + b"-" + escape(end)
+                    i += 2
+                else:
+                    items += escape(pattern[i])
+                i += 1
+            if items:
+                out += b"[" + (b"^" if negate else b"") + items + b"]"
+            else:
+                # [] matches nothing, [^] any byte
+                out += b"." if negate else b"(?!)"
+        elif c == 92 and i + 1 < n: # '\'
+            i += 1
+            out += escape(pattern[i])
+        else:
+            out += escape(c)
+        i += 1
+    matcher = re.compile(bytes(out), re.DOTALL).fullmatch
+    return lambda key: matcher(key) is not None
+
+def escape(byte):
+    return re.escape(bytes((byte,)))
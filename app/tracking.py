@@ -0,0 +1,95 @@
+class TrackingTable:
+    """
+    Client-side caching: which clients may hold which keys in a local
+    cache, so they can be told when one changes (CLIENT TRACKING).
+
+    In the default mode a client is remembered, by ID, for every key it
+    reads; the first change to the key invalidates it for those clients
+    and forgets them, until they read it again. The table holds at most
+    `max_keys` keys: past that the oldest are invalidated early, which
+    costs the clients a cache miss instead of the server unbounded memory.
+
+    In broadcasting mode (BCAST) nothing is kept per key. A client names
+    key prefixes instead (none meaning every key) and hears about every
+    change to a key that starts with one of them.
+    """
+    def __init__(self, max_keys=1000000):
+        self.max_keys = max_keys
+        # key -> {client ID: None}, oldest key first
+        self.keys = {}
+        # prefix -> {client ID: None}
+        self.prefixes = {}
+        # First byte of a prefix -> the prefixes starting with it, so a write
+        # is only compared with those; the empty prefix is under b""
+        self.prefix_index = {}
+        # IDs of the clients with tracking on
+        self.clients = set()
+        # The tracking client running a command, so NOLOOP can leave it
+        # out of the invalidations for its own writes
+        self.writer = None
+
+    def enable(self, client_id, prefixes=()):
+        self.clients.add(client_id)
+        for prefix in prefixes:
+            if prefix not in self.prefixes:
+                self.prefixes[prefix] = {}
+                self.prefix_index.setdefault(prefix[:1], []).append(prefix)
+            self.prefixes[prefix][client_id] = None
+
+    def disable(self, client_id, prefixes=()):
+        """
+        Forgets a client. Its entries in `keys` are left to be dropped when
+        the keys change; invalidations for clients that are gone or no
+        longer tracking are not sent.
+        """
+        self.clients.discard(client_id)
+        for prefix in prefixes:
+            ids = self.prefixes[prefix]
+            del ids[client_id]
+            if not ids:
+                del self.prefixes[prefix]
+                same_first = self.prefix_index[prefix[:1]]
+                same_first.remove(prefix)
+                if not same_first:
+                    del self.prefix_index[prefix[:1]]
+        if not self.clients:
+            self.keys.clear()
+
+    def remember(self, client_id, keys):
+        """
+        Records that the client read `keys`. Returns the (key, client IDs)
+        pairs pushed out to stay within max_keys, to be invalidated now.
+        """
+        table = self.keys
+        for key in keys:
+            ids = table.get(key)
+            if ids is None:
+                ids = table[key] = {}
+            ids[client_id] = None
+        evicted = []
+        while len(table) > self.max_keys:
+            key = next(iter(table))
+            evicted.append((key, table.pop(key)))
+        return evicted
+
+    def changed(self, key):
+        """
+        Returns the IDs of the clients to tell that `key` changed, and
+        forgets the key.
+        """
+        ids = list(self.keys.pop(key, ()))
+        if not self.prefixes:
+            return ids
+        index = self.prefix_index
+        for prefix in index.get(key[:1], ()):
+            if key.startswith(prefix):
+                ids.extend(self.prefixes[prefix])
+        if key:
+            for prefix in index.get(b"", ()):
+                ids.extend(self.prefixes[prefix])
+        return ids
+
+    def flushed(self):
+        # Every key went: every tracking client drops its whole cache
+        self.keys.clear()
+        return list(self.clients)
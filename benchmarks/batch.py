@@ -0,0 +1,54 @@
+"""
+Multi-key command benchmark: keys/s through MSET, MGET, EXISTS and DEL for
+batch sizes from 1 to 1000, run straight through the command dispatcher,
+and how long DEL and UNLINK take to reply when deleting a large value.
+
+    python -m benchmarks.batch --keys 100000
+"""
+import argparse
+import time
+
+from app.main import KEYSPACE, LAZYFREE, handle_command
+
+BATCH_SIZES = (1, 10, 100, 1000)
+
+def run_batches(name, keys, batch_size, make_args):
+    start = time.perf_counter()
+    for i in range(0, len(keys), batch_size):
+        reply = handle_command([name] + make_args(keys[i:i + batch_size]))
+        assert not reply.startswith(b"-"), reply
+    return len(keys) / (time.perf_counter() - start)
+
+def time_delete(name, elements):
+    KEYSPACE.set(b"big", [b"%d" % i for i in range(elements)])
+    start = time.perf_counter()
+    handle_command([name, b"big"])
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--value-size", type=int, default=16)
+    parser.add_argument("--big-value", type=int, default=1000000, help="elements in the value DEL and UNLINK delete")
+    args = parser.parse_args()
+
+    keys = [b"key:%d" % i for i in range(args.keys)]
+    value = b"x" * args.value_size
+    print(f"{'batch':>6} {'MSET':>12} {'MGET':>12} {'EXISTS':>12} {'DEL':>12}   keys/s")
+    for batch_size in BATCH_SIZES:
+        rates = [
+            run_batches(b"MSET", keys, batch_size, lambda batch: [arg for key in batch for arg in (key, value)]),
+            run_batches(b"MGET", keys, batch_size, list),
+            run_batches(b"EXISTS", keys, batch_size, list),
+            run_batches(b"DEL", keys, batch_size, list),
+        ]
+        print(f"{batch_size:6} " + " ".join(f"{rate:12.0f}" for rate in rates))
+
+    for name in (b"DEL", b"UNLINK"):
+        seconds = time_delete(name, args.big_value)
+        print(f"{name.decode():6} of a {args.big_value}-element value replied in {seconds * 1000:8.2f} ms")
+    while LAZYFREE.pending:
+        time.sleep(0.01)
+
+if __name__ == "__main__":
+    main()
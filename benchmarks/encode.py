@@ -0,0 +1,40 @@
+"""
+Reply encoder micro-benchmark: nanoseconds per call of each encode_*
+function on typical and large replies.
+
+    python -m benchmarks.encode --number 100000
+"""
+import argparse
+import timeit
+
+from app.resp import encode_array, encode_bulk_string, encode_integer, encode_simple_string
+
+def cases():
+    small = b"value"
+    large = b"x" * (1024 * 1024)
+    keys = [b"key:%d" % i for i in range(10000)]
+    return [
+        ("encode_integer(42)", lambda: encode_integer(42)),
+        ("encode_integer(10**12)", lambda: encode_integer(10 ** 12)),
+        ("encode_simple_string('OK')", lambda: encode_simple_string("OK")),
+        ("encode_bulk_string(5 bytes)", lambda: encode_bulk_string(small)),
+        ("encode_bulk_string(1 MB)", lambda: encode_bulk_string(large)),
+        ("encode_array(10 keys)", lambda: encode_array(keys[:10])),
+        ("encode_array(10000 keys)", lambda: encode_array(keys)),
+        ("encode_array(nested)", lambda: encode_array([[b"a", 1], [b"b", 2], None] * 10)),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=100000, help="calls per case (scaled down for large cases)")
+    args = parser.parse_args()
+
+    for name, fn in cases():
+        # One warm-up call also tells how slow the case is
+        seconds = timeit.timeit(fn, number=1)
+        number = max(10, min(args.number, int(0.5 / max(seconds, 1e-7))))
+        best = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        print(f"{name:32} {best * 1e9:12.0f} ns/call")
+
+if __name__ == "__main__":
+    main()
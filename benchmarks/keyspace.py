@@ -0,0 +1,94 @@
+"""
+Keyspace layout benchmark: bytes per key and GET time of the Keyspace (one
+Entry per key holding the value, integer-ms expiry and eviction clock)
+against the layout it replaced, a dict of values beside a dict of float
+expiry times, with and without TTLs. Keys and values are built first and
+shared, so only what each layout adds is counted.
+
+    python -m benchmarks.keyspace --keys 1000000
+    python -m benchmarks.keyspace --keys 10000000 --lookups 1000000
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from app.keyspace import Keyspace
+
+class TwoDicts:
+    # The old layout: values in one dict, expiry times in another
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def set(self, key, value, expire_at=None):
+        self.data[key] = value
+        if expire_at is not None:
+            self.expiry[key] = expire_at
+
+    def get(self, key):
+        expire_at = self.expiry.get(key)
+        if expire_at is not None and time.time() * 1000 > expire_at:
+            del self.data[key]
+            del self.expiry[key]
+            return None
+        return self.data.get(key)
+
+def build(layout, keys, value, ttl):
+    # Returns the populated store and the bytes it allocated per key
+    expire_at = time.time() * 1000 + 3600 * 1000
+    tracemalloc.start()
+    store = layout()
+    if ttl and layout is Keyspace:
+        for i, key in enumerate(keys):
+            store.set(key, value, int(expire_at) + i)
+    elif ttl:
+        for i, key in enumerate(keys):
+            store.set(key, value, expire_at + i)
+    else:
+        for key in keys:
+            store.set(key, value)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return store, size / len(keys)
+
+def time_gets(store, lookups):
+    # Nanoseconds per GET, best of three passes
+    get = store.get
+    best = None
+    for _ in range(3):
+        start = time.perf_counter_ns()
+        for key in lookups:
+            get(key)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(lookups)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--keys", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=200000, help="random GETs timed per layout")
+    parser.add_argument("--value-size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    keys = [b"key:%d" % i for i in range(args.keys)]
+    value = b"x" * args.value_size
+    rng = random.Random(args.seed)
+    lookups = [keys[rng.randrange(args.keys)] for _ in range(args.lookups)]
+
+    print(f"{args.keys} keys, {args.value_size}-byte values")
+    print(f"{'layout':28} {'bytes/key':>10} {'GET ns':>8}")
+    for ttl in (False, True):
+        for name, layout in (("two dicts", TwoDicts), ("keyspace", Keyspace)):
+            store, size = build(layout, keys, value, ttl)
+            label = f"{name}{', with TTL' if ttl else ''}"
+            print(f"{label:28} {size:10.1f} {time_gets(store, lookups):8.0f}")
+            if layout is Keyspace and ttl:
+                # What the server does: one clock read per event loop tick
+                store.tick()
+                print(f"{label + ', cached clock':28} {'':10} {time_gets(store, lookups):8.0f}")
+            del store
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Load generator: drives a running server on localhost over concurrent
+connections with PING, SET, GET, INCR, MGET and MULTI/EXEC workloads and
+reports ops/s and p50/p99/p99.9 latency, like redis-benchmark. Results can be written as
+JSON, tagged with the server's INFO server section, to compare runs
+between server modes. With --cluster, connections are spread over the
+--workers processes and send each key to the worker that owns it.
+
+    python -m app.main --io-mode eventloop &
+    python -m benchmarks.load --clients 50 --requests 100000 --pipeline 16 --json eventloop.json
+
+Each multi request is one transaction of --multi-commands INCRs, so its
+keys/s compares with that of the incr test, which sends them one by one.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import random
+import selectors
+import socket
+import time
+
+from app.aof import encode_command
+from app.cluster import key_hash_slot
+
+HOST = "localhost"
+TESTS = ("ping", "set", "get", "incr", "mget", "multi")
+
+# Upper bounds of the latency histogram buckets, in microseconds: 1-2-5
+# steps from 10us to 10s
+HISTOGRAM_BOUNDS = [m * 10 ** e for e in range(1, 7) for m in (1, 2, 5)] + [10 ** 7]
+
+def reply_end(buf, pos):
+    """
+    Returns the offset just past the reply starting at buf[pos], or -1 if
+    buf does not hold all of it yet.
+    """
+    newline = buf.find(b"\r\n", pos)
+    if newline == -1:
+        return -1
+    kind = buf[pos]
+    if kind == 36: # '$'
+        length = int(buf[pos + 1:newline])
+        end = newline + 2 if length < 0 else newline + length + 4
+        return end if end <= len(buf) else -1
+    if kind == 42: # '*'
+        count = int(buf[pos + 1:newline])
+        pos = newline + 2
+        for _ in range(count):
+            pos = reply_end(buf, pos)
+            if pos == -1:
+                return -1
+        return pos
+    return newline + 2
+
+def key_picker(population, options, rng):
+    """
+    Returns a function giving the next key index out of `population`:
+    uniformly, or zipf-like so a few keys take most requests.
+    """
+    if options["distribution"] == "uniform":
+        return lambda: population[rng.randrange(len(population))]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** options["zipf_exponent"] for rank in range(len(population))))
+    # Drawn in blocks, as one choices() call is much cheaper than many
+    block = []
+    def pick():
+        if not block:
+            block.extend(rng.choices(population, cum_weights=cum_weights, k=4096))
+        return block.pop()
+    return pick
+
+def key_populations(options):
+    """
+    The key indexes each port is sent: all of them, or with --cluster the
+    ones whose keys the worker on that port owns.
+    """
+    if not options["slots"]:
+        return {options["port"]: range(options["keyspace"])}
+    owners = {}
+    for first, last, port in options["slots"]:
+        owners.update(dict.fromkeys(range(first, last + 1), port))
+    populations = {port: [] for _, _, port in options["slots"]}
+    for i in range(options["keyspace"]):
+        populations[owners[key_hash_slot(b"key:%d" % i)]].append(i)
+    return populations
+
+def request_maker(test, population, options, rng):
+    """
+    Returns a function building the next request of `test`, RESP-encoded.
+    """
+    if test == "ping":
+        ping = encode_command([b"PING"])
+        return lambda: ping
+    pick = key_picker(population, options, rng)
+    if test == "get":
+        return lambda: encode_command([b"GET", b"key:%d" % pick()])
+    if test == "mget":
+        batch = options["mget_keys"]
+        return lambda: encode_command([b"MGET"] + [b"key:%d" % pick() for _ in range(batch)])
+    # Counters hash to the same slot as key:N, which SET fills with text
+    if test == "incr":
+        return lambda: encode_command([b"INCR", b"counter:{key:%d}" % pick()])
+    if test == "multi":
+        batch = options["multi_commands"]
+        multi, exec_ = encode_command([b"MULTI"]), encode_command([b"EXEC"])
+        return lambda: multi + b"".join(encode_command([b"INCR", b"counter:{key:%d}" % pick()])
+                                        for _ in range(batch)) + exec_
+    low, high = options["data_size"]
+    values = [b"x" * size for size in range(low, high + 1)] if high - low < 4096 else None
+    if values is None:
+        return lambda: encode_command([b"SET", b"key:%d" % pick(), b"x" * rng.randint(low, high)])
+    return lambda: encode_command([b"SET", b"key:%d" % pick(), rng.choice(values)])
+
+class Connection:
+    __slots__ = ("sock", "make_request", "inbuf", "batch", "waiting", "sent_at")
+
+    def __init__(self, port, make_request):
+        self.sock = socket.create_connection((HOST, port))
+        self.make_request = make_request
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.inbuf = bytearray()
+        self.batch = 0 # Requests in the last batch sent
+        self.waiting = 0 # Replies still due for it
+        self.sent_at = 0
+
+def request_replies(test, options):
+    # A transaction is answered with +OK, a +QUEUED per command and the EXEC array
+    return options["multi_commands"] + 2 if test == "multi" else 1
+
+def run_clients(test, ports, requests, options, seed):
+    """
+    Runs `requests` requests of `test` over one connection to each of
+    `ports` from one event loop, each connection keeping `pipeline`
+    requests in flight. Returns (start, end, latencies in microseconds,
+    error replies).
+    """
+    rng = random.Random(seed)
+    populations = key_populations(options)
+    makers = {port: request_maker(test, population, options, rng) for port, population in populations.items()}
+    pipeline = options["pipeline"]
+    replies = request_replies(test, options)
+    connections = [Connection(port, makers[port]) for port in ports]
+    selector = selectors.DefaultSelector()
+    latencies = []
+    errors = 0
+    unsent = requests
+
+    def send_batch(conn):
+        nonlocal unsent
+        count = min(pipeline, unsent)
+        unsent -= count
+        conn.batch = count
+        conn.waiting = count * replies
+        conn.sent_at = time.perf_counter_ns()
+        conn.sock.sendall(b"".join(conn.make_request() for _ in range(count)))
+
+    start = time.monotonic()
+    for conn in connections:
+        if unsent:
+            send_batch(conn)
+            selector.register(conn.sock, selectors.EVENT_READ, conn)
+    active = len(selector.get_map())
+    while active:
+        for key, _ in selector.select():
+            conn = key.data
+            data = conn.sock.recv(65536)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            conn.inbuf += data
+            pos = 0
+            while conn.waiting:
+                end = reply_end(conn.inbuf, pos)
+                if end == -1:
+                    break
+                if conn.inbuf[pos] == 45: # '-'
+                    errors += 1
+                conn.waiting -= 1
+                pos = end
+            del conn.inbuf[:pos]
+            if conn.waiting:
+                continue
+            # Every request of a pipelined batch waited as long as the last
+            latencies.extend([(time.perf_counter_ns() - conn.sent_at) // 1000] * conn.batch)
+            if unsent:
+                send_batch(conn)
+            else:
+                selector.unregister(conn.sock)
+                active -= 1
+    end = time.monotonic()
+    for conn in connections:
+        conn.sock.close()
+    return start, end, latencies, errors
+
+def run_test(test, options):
+    processes = min(options["processes"], options["clients"])
+    # Connections go round-robin over the workers
+    ports = [port for _, _, port in options["slots"]] or [options["port"]]
+    connection_ports = [ports[i % len(ports)] for i in range(options["clients"])]
+    jobs = [(test, connection_ports[i::processes],
+             options["requests"] * (i + 1) // processes - options["requests"] * i // processes,
+             options, options["seed"] + i) for i in range(processes)]
+    if processes == 1:
+        results = [run_clients(*jobs[0])]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(run_clients, jobs)
+    latencies = sorted(latency for result in results for latency in result[2])
+    seconds = max(result[1] for result in results) - min(result[0] for result in results)
+    return summarize(test, latencies, seconds, sum(result[3] for result in results), options)
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def summarize(test, latencies, seconds, errors, options):
+    histogram = {}
+    i = 0
+    for bound in HISTOGRAM_BOUNDS:
+        count = 0
+        while i < len(latencies) and latencies[i] <= bound:
+            count += 1
+            i += 1
+        histogram[f"<={bound}us"] = count
+    histogram[f">{HISTOGRAM_BOUNDS[-1]}us"] = len(latencies) - i
+    requests = len(latencies)
+    # Each MGET reads mget_keys keys and each transaction increments multi_commands
+    keys_per_request = {"mget": options["mget_keys"], "multi": options["multi_commands"]}.get(test, 1)
+    return {
+        "test": test,
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(seconds, 6),
+        "ops_per_sec": round(requests / seconds, 1),
+        "keys_per_sec": round(requests * keys_per_request / seconds, 1),
+        "latency_us": {
+            "min": latencies[0],
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "p99.9": percentile(latencies, 99.9),
+            "max": latencies[-1],
+            "mean": round(sum(latencies) / requests, 1),
+        },
+        "histogram_us": histogram,
+    }
+
+def query(port, *args):
+    # One command, answered in full; for setting the run up
+    with socket.create_connection((HOST, port)) as sock:
+        sock.sendall(encode_command(list(args)))
+        buf = bytearray()
+        while not buf or reply_end(buf, 0) == -1:
+            data = sock.recv(65536)
+            if not data:
+                break
+            buf += data
+    return bytes(buf)
+
+def server_info(port):
+    # The server's INFO server section, to tell runs against different modes apart
+    reply = query(port, b"INFO", b"server")
+    body = reply[reply.find(b"\r\n") + 2:-2].decode()
+    return dict(line.split(":", 1) for line in body.splitlines() if ":" in line)
+
+def cluster_slots(port):
+    """
+    (first slot, last slot, port) of every worker, from CLUSTER SLOTS.
+    """
+    reply = query(port, b"CLUSTER", b"SLOTS")
+    if reply.startswith(b"-"):
+        raise SystemExit(f"CLUSTER SLOTS failed: {reply.decode().strip()}")
+    # Each entry is *3 :first :last *3 $host :port $id
+    numbers = [int(line[1:]) for line in reply.split(b"\r\n") if line.startswith(b":")]
+    return [tuple(numbers[i:i + 3]) for i in range(0, len(numbers), 3)]
+
+def parse_size_range(text):
+    low, _, high = text.partition("-")
+    return int(low), int(high or low)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--tests", default=",".join(TESTS), help=f"comma-separated, from {', '.join(TESTS)}")
+    parser.add_argument("--clients", type=int, default=50, help="concurrent connections")
+    parser.add_argument("--requests", type=int, default=100000, help="requests per test")
+    parser.add_argument("--pipeline", type=int, default=1, help="requests each connection keeps in flight")
+    parser.add_argument("--processes", type=int, default=1, help="client processes the connections are spread over")
+    parser.add_argument("--data-size", type=parse_size_range, default=(3, 3), metavar="BYTES[-BYTES]",
+                        help="SET value size, or a range to pick sizes from uniformly")
+    parser.add_argument("--keyspace", type=int, default=10000, help="distinct keys SET, GET and MGET use")
+    parser.add_argument("--distribution", choices=("uniform", "zipf"), default="uniform", help="how keys are picked")
+    parser.add_argument("--zipf-exponent", type=float, default=0.99)
+    parser.add_argument("--mget-keys", type=int, default=10, help="keys per MGET")
+    parser.add_argument("--multi-commands", type=int, default=50, help="INCRs per MULTI/EXEC transaction")
+    parser.add_argument("--cluster", action="store_true", help="route keys to the --workers process owning them")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="also write the results here")
+    args = parser.parse_args()
+
+    tests = args.tests.lower().split(",")
+    unknown = set(tests) - set(TESTS)
+    if unknown:
+        parser.error(f"unknown tests: {', '.join(sorted(unknown))}")
+    if args.cluster and "mget" in tests:
+        parser.error("mget reads keys from many slots, so it cannot run with --cluster")
+    options = {name: value for name, value in vars(args).items() if name not in ("tests", "json", "cluster")}
+    options["slots"] = cluster_slots(args.port) if args.cluster else []
+
+    info = server_info(args.port)
+    print(f"redis_version {info.get('redis_version')}, io_mode {info.get('io_mode')}, {len(options['slots']) or 1} workers, "
+          f"{args.clients} clients, pipeline {args.pipeline}, {args.requests} requests per test")
+    print(f"{'test':6} {'ops/s':>10} {'keys/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'p99.9 ms':>9} {'max ms':>8} {'errors':>7}")
+    results = []
+    for test in tests:
+        result = run_test(test, options)
+        results.append(result)
+        latency = result["latency_us"]
+        print(f"{test.upper():6} {result['ops_per_sec']:10.0f} {result['keys_per_sec']:10.0f} {latency['p50'] / 1000:8.3f} "
+              f"{latency['p99'] / 1000:8.3f} {latency['p99.9'] / 1000:9.3f} {latency['max'] / 1000:8.3f} {result['errors']:7}")
+
+    if args.json:
+        options["data_size"] = list(args.data_size)
+        with open(args.json, "w") as f:
+            json.dump({"time": int(time.time()), "server": info, "options": options, "results": results}, f, indent=2)
+            f.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Collection memory benchmark: bytes per small hash, set and sorted set in
+their compact encodings, against the plain dict/set a naive store would
+use, measured with tracemalloc. The elements themselves are built first
+and shared, so only what each structure adds is counted.
+
+    python -m benchmarks.memory --count 10000 --fields 10
+"""
+import argparse
+import tracemalloc
+
+from app.datatypes import Hash, Set, ZSet
+
+def measure(build, inputs):
+    # Allocations still live after building a value from each input, per value
+    tracemalloc.start()
+    values = [build(elements) for elements in inputs]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del values
+    return size / len(inputs)
+
+def cases(count, fields):
+    pairs = [[(b"field:%d" % j, b"value:%d:%d" % (i, j)) for j in range(fields)] for i in range(count)]
+    members = [[b"%d" % (i * fields + j) for j in range(fields)] for i in range(count)]
+    scored = [[(member, float(j)) for j, member in enumerate(elements)] for elements in members]
+    return [
+        ("hash", dict, Hash, pairs),
+        ("set of integers", set, Set, members),
+        ("sorted set", dict, ZSet, scored),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000, help="values of each kind to build")
+    parser.add_argument("--fields", type=int, default=10, help="fields or members per value")
+    args = parser.parse_args()
+
+    print(f"{'':16} {'plain':>12} {'compact':>12}   bytes per value ({args.fields} elements)")
+    for name, plain, compact, inputs in cases(args.count, args.fields):
+        baseline = measure(plain, inputs)
+        size = measure(compact, inputs)
+        encoding = compact(inputs[0]).encoding
+        print(f"{name:16} {baseline:12.0f} {size:12.0f}   {size / baseline:5.0%} ({encoding})")
+
+if __name__ == "__main__":
+    main()
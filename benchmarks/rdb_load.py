@@ -0,0 +1,97 @@
+"""
+RDB load benchmark: writes a dump with save_rdb and times loading it back
+into a keyspace, with and without checksum verification, against the
+loader it replaced (the whole file read into memory and decoded into dicts
+first, without checksum verification).
+
+    python -m benchmarks.rdb_load --keys 200000 --value-size 64
+"""
+import argparse
+import os
+import struct
+import tempfile
+import time
+
+from app.keyspace import Keyspace
+from app.rdb_parser import SortedSet, iter_rdb, read_length, read_string, save_rdb
+
+def make_items(keys, value_size, collections):
+    value = b"x" * value_size
+    for i in range(keys):
+        key = b"key:%d" % i
+        if collections and i % 4 == 1:
+            yield key, [value + b"%d" % j for j in range(8)], None
+        elif collections and i % 4 == 2:
+            yield key, {b"field%d" % j: value for j in range(8)}, None
+        elif collections and i % 4 == 3:
+            yield key, SortedSet((b"member%d" % j, float(j)) for j in range(8)), None
+        else:
+            yield key, value, None
+
+def old_load_rdb(path):
+    # The old loader, for strings only
+    with open(path, "rb") as f:
+        data = f.read()
+    data_store = {}
+    expiry_store = {}
+    pos = 9
+    while True:
+        opcode = data[pos]
+        pos += 1
+        if opcode == 0xFF:
+            break
+        if opcode == 0xFE:
+            _, pos = read_length(data, pos)
+            continue
+        if opcode == 0xFC:
+            expire_at = struct.unpack("<Q", data[pos:pos+8])[0]
+            pos += 9
+        else:
+            expire_at = None
+        key, pos = read_string(data, pos)
+        data_store[key], pos = read_string(data, pos)
+        if expire_at is not None:
+            expiry_store[key] = expire_at
+    return data_store, expiry_store
+
+def time_load(path, verify_checksum):
+    keyspace = Keyspace()
+    start = time.perf_counter()
+    for key, value, expire_at in iter_rdb(path, verify_checksum=verify_checksum):
+        keyspace.set(key, value, expire_at)
+    return len(keyspace), time.perf_counter() - start
+
+def time_old_load(path):
+    keyspace = Keyspace()
+    start = time.perf_counter()
+    data_store, expiry_store = old_load_rdb(path)
+    for key, value in data_store.items():
+        keyspace.set(key, value, expiry_store.get(key))
+    return len(keyspace), time.perf_counter() - start
+
+def best_of(runs, load):
+    return min((load() for _ in range(runs)), key=lambda result: result[1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--keys", type=int, default=200000)
+    parser.add_argument("--value-size", type=int, default=64)
+    parser.add_argument("--collections", action="store_true", help="mix in lists, hashes and sorted sets")
+    parser.add_argument("--runs", type=int, default=3, help="best of this many loads each")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "dump.rdb")
+        save_rdb(path, make_items(args.keys, args.value_size, args.collections), checksum=True)
+        size = os.path.getsize(path)
+        loaders = [("checksum=yes", lambda: time_load(path, True)), ("checksum=no", lambda: time_load(path, False))]
+        if not args.collections:
+            loaders.append(("old loader", lambda: time_old_load(path)))
+        for name, load in loaders:
+            keys, seconds = best_of(args.runs, load)
+            print(f"{name:12}  {size / 1e6:8.2f} MB  {keys} keys  "
+                  f"{seconds:7.3f}s  {keys / seconds:9.0f} keys/s  {size / 1e6 / seconds:6.2f} MB/s  "
+                  f"{seconds * 1e9 / size:7.1f} s/GB")
+
+if __name__ == "__main__":
+    main()
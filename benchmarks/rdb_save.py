@@ -0,0 +1,71 @@
+"""
+RDB save benchmark: seconds to save a generated keyspace with save_rdb,
+with and without the CRC64 trailer, against the writer it replaced (one
+small f.write per opcode, length and string, a zero trailer, no fsync), and
+MB/s of the CRC64 itself, bulk against a byte at a time through the table.
+
+    python -m benchmarks.rdb_save --keys 200000 --value-size 32
+"""
+import argparse
+import os
+import struct
+import tempfile
+import time
+
+from app.rdb_parser import CRC64_TABLE, crc64, encode_string, save_rdb
+from benchmarks.rdb_load import make_items
+
+def old_save_rdb(filename, items):
+    # The old writer, for strings only
+    with open(filename, "wb") as f:
+        f.write(b"REDIS0009")
+        f.write(b"\xFE\x00")
+        for key, value, expire_at in items:
+            if expire_at is not None:
+                f.write(b"\xFC")
+                f.write(struct.pack("<Q", int(expire_at)))
+            f.write(b"\x00")
+            f.write(encode_string(key))
+            f.write(encode_string(value))
+        f.write(b"\xFF")
+        f.write(b"\x00" * 8)
+
+def table_crc64(crc, data):
+    for byte in data:
+        crc = CRC64_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc
+
+def best_of(runs, fn):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--keys", type=int, default=200000)
+    parser.add_argument("--value-size", type=int, default=32)
+    parser.add_argument("--runs", type=int, default=3, help="best of this many saves each")
+    args = parser.parse_args()
+
+    items = list(make_items(args.keys, args.value_size, False))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "dump.rdb")
+        print(f"{args.keys} keys, {args.value_size}-byte values")
+        print(f"{'writer':24} {'seconds':>8} {'keys/s':>10}")
+        for name, save in (("old writer", lambda: old_save_rdb(path, items)),
+                           ("save_rdb", lambda: save_rdb(path, items, checksum=False)),
+                           ("save_rdb, checksum", lambda: save_rdb(path, items, checksum=True))):
+            seconds = best_of(args.runs, save)
+            print(f"{name:24} {seconds:8.3f} {args.keys / seconds:10.0f}")
+
+    data = os.urandom(1024 * 1024)
+    for name, fn in (("crc64, table", table_crc64), ("crc64, bulk", crc64)):
+        seconds = best_of(args.runs, lambda: fn(0, data))
+        print(f"{name:24} {1 / seconds:8.1f} MB/s")
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,11 @@ def encode_resp(command_str):
     parts = command_str.split()
     if not parts:
         return None
-    proto = f"*{len(parts)}\r\n"
+    proto = f"*{len(parts)}\r\n".encode()
     for part in parts:
-        proto += f"${len(part)}\r\n{part}\r\n"
-    return proto.encode()
+        part = part.encode()
+        proto += b"$%d\r\n%s\r\n" % (len(part), part)
+    return proto
 
 def main():
     print("Welcome to your custom Redis CLI via Python!")
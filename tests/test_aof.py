@@ -0,0 +1,140 @@
+import os
+
+import pytest
+
+import app.main as main
+from app.aof import AppendOnlyFile, encode_command, load_aof, rewrite_aof
+from app.rdb_parser import SortedSet
+
+def replay(path):
+    keys = {}
+    commands = []
+    load_aof(path, lambda key, value, expire_at: keys.__setitem__(key, value), commands.append)
+    return keys, commands
+
+def test_encode_command():
+    assert encode_command([b"SET", b"k", 10]) == b"*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$2\r\n10\r\n"
+
+def test_flush_and_replay(tmp_path):
+    path = str(tmp_path / "appendonly.aof")
+    aof = AppendOnlyFile(path, "always")
+    aof.append([b"SET", b"a", b"1"])
+    aof.append([b"SET", b"b", b"2"])
+    assert os.path.getsize(path) == 0
+    aof.flush()
+    assert aof.synced == aof.written == aof.appended == os.path.getsize(path)
+    assert replay(path) == ({}, [[b"SET", b"a", b"1"], [b"SET", b"b", b"2"]])
+
+def test_truncated_tail_is_dropped(tmp_path):
+    path = str(tmp_path / "appendonly.aof")
+    with open(path, "wb") as f:
+        f.write(encode_command([b"SET", b"a", b"1"]) + b"*3\r\n$3\r\nSET\r\n$1\r\nb")
+    assert replay(path) == ({}, [[b"SET", b"a", b"1"]])
+    assert os.path.getsize(path) == len(encode_command([b"SET", b"a", b"1"]))
+
+def test_unfinished_transaction_is_dropped(tmp_path):
+    path = str(tmp_path / "appendonly.aof")
+    done = b"".join(encode_command(args) for args in ([b"MULTI"], [b"SET", b"a", b"1"], [b"EXEC"]))
+    with open(path, "wb") as f:
+        f.write(done + encode_command([b"MULTI"]) + encode_command([b"SET", b"b", b"2"]))
+    assert replay(path) == ({}, [[b"SET", b"a", b"1"]])
+    assert os.path.getsize(path) == len(done)
+
+def test_rewrite_keeps_writes_made_meanwhile(tmp_path):
+    path = str(tmp_path / "appendonly.aof")
+    temp = str(tmp_path / "temp-rewrite.aof")
+    items = [(b"s", b"v", None), (b"h", {b"f": b"v"}, None), (b"z", SortedSet({b"m": 2.0}), 2 ** 50)]
+    for preamble in (True, False):
+        aof = AppendOnlyFile(path, "no")
+        aof.append([b"SET", b"old", b"x"])
+        aof.flush()
+        aof.start_rewrite()
+        rewrite_aof(temp, items, preamble)
+        aof.append([b"SET", b"during", b"y"])
+        aof.finish_rewrite(temp)
+        aof.append([b"SET", b"after", b"z"])
+        aof.flush()
+        keys, commands = replay(path)
+        if preamble:
+            assert keys == {b"s": b"v", b"h": {b"f": b"v"}, b"z": {b"m": 2.0}}
+            assert commands == [[b"SET", b"during", b"y"], [b"SET", b"after", b"z"]]
+        else:
+            assert commands == [[b"SET", b"s", b"v"], [b"HSET", b"h", b"f", b"v"], [b"ZADD", b"z", b"2.0", b"m"],
+                                [b"PEXPIREAT", b"z", b"%d" % 2 ** 50], [b"SET", b"during", b"y"], [b"SET", b"after", b"z"]]
+        assert aof.size == aof.base_size + len(encode_command([b"SET", b"after", b"z"]))
+        os.remove(path)
+
+def test_bad_record_stops_the_load(tmp_path, monkeypatch, capsys):
+    def exit(code):
+        raise SystemExit(code)
+    monkeypatch.setattr(os, "_exit", exit)
+    path = str(tmp_path / "appendonly.aof")
+    with open(path, "wb") as f:
+        f.write(encode_command([b"SET", b"a", b"1"]) + encode_command([b"SET", b"b"]))
+    monkeypatch.setitem(main.LOADING, "loading", True)
+    with pytest.raises(SystemExit) as exited:
+        main.load_dataset(path, append_only=True)
+    assert exited.value.code == 1
+    assert f"Failed to load {path} past offset " in capsys.readouterr().out
+    main.KEYSPACE.flush()
+
+def test_writes_that_change_nothing_are_not_logged(tmp_path, monkeypatch):
+    path = str(tmp_path / "appendonly.aof")
+    aof = AppendOnlyFile(path, "no")
+    monkeypatch.setattr(main, "AOF", aof)
+    client = main.ClientConnection(None, ("127.0.0.1", 1))
+    try:
+        assert main.handle_command([b"SET", b"k", b"v"], client) == b"+OK\r\n"
+        assert main.handle_command([b"SET", b"k", b"w", b"NX"], client) == b"$-1\r\n"
+        assert main.handle_command([b"SET", b"other", b"w", b"XX"], client) == b"$-1\r\n"
+        assert main.handle_command([b"PERSIST", b"k"], client) == b":0\r\n"
+        assert main.handle_command([b"GETEX", b"k"], client) == b"$1\r\nv\r\n"
+        assert main.handle_command([b"DEL", b"nothing"], client) == b":0\r\n"
+        aof.flush()
+        assert replay(path) == ({}, [[b"SET", b"k", b"v"]])
+    finally:
+        main.KEYSPACE.flush()
+
+def test_transactions_are_logged_around_their_changes_only(tmp_path, monkeypatch):
+    path = str(tmp_path / "appendonly.aof")
+    aof = AppendOnlyFile(path, "no")
+    monkeypatch.setattr(main, "AOF", aof)
+    client = main.ClientConnection(None, ("127.0.0.1", 1))
+    try:
+        main.handle_command([b"SET", b"k", b"v"], client)
+        for args in ([b"MULTI"], [b"SET", b"k", b"w", b"NX"], [b"PERSIST", b"k"]):
+            main.handle_command(args, client)
+        assert main.handle_command([b"EXEC"], client) == b"*2\r\n$-1\r\n:0\r\n"
+        for args in ([b"MULTI"], [b"SET", b"k", b"w", b"NX"], [b"SET", b"j", b"1"]):
+            main.handle_command(args, client)
+        main.handle_command([b"EXEC"], client)
+        aof.flush()
+        with open(path, "rb") as f:
+            assert f.read() == b"".join(encode_command(args) for args in (
+                [b"SET", b"k", b"v"], [b"MULTI"], [b"SET", b"j", b"1"], [b"EXEC"]))
+    finally:
+        main.KEYSPACE.flush()
+
+def test_expired_and_evicted_keys_are_logged_as_dels(tmp_path, monkeypatch):
+    path = str(tmp_path / "appendonly.aof")
+    aof = AppendOnlyFile(path, "no")
+    monkeypatch.setattr(main, "AOF", aof)
+    monkeypatch.setattr(main.KEYSPACE, "on_drop", main.propagate_drop)
+    past = main.KEYSPACE.now_ms() - 1000
+    try:
+        main.KEYSPACE.set(b"lazy", b"1", past)
+        main.KEYSPACE.set(b"active", b"1", past)
+        dirty = main.KEYSPACE.dirty()
+        assert main.handle_command([b"GET", b"lazy"]) == b"$-1\r\n"
+        main.KEYSPACE.active_expire_cycle(1000000)
+        monkeypatch.setattr(main.KEYSPACE, "maxmemory", 1)
+        monkeypatch.setattr(main.KEYSPACE, "policy", "volatile-ttl")
+        main.KEYSPACE.set(b"evicted", b"1", past + 3600000)
+        main.KEYSPACE.perform_evictions()
+        # Not changes a command made, for the save rules
+        assert main.KEYSPACE.dirty() == dirty + 1
+        aof.flush()
+        with open(path, "rb") as f:
+            assert f.read() == b"".join(encode_command([b"DEL", key]) for key in (b"lazy", b"active", b"evicted"))
+    finally:
+        main.KEYSPACE.flush()
@@ -0,0 +1,21 @@
+from app.cluster import CLUSTER_SLOTS, Cluster, crc16, key_hash_slot
+
+def test_crc16_and_key_slots():
+    # The reference values from the Redis Cluster specification
+    assert crc16(b"123456789") == 0x31C3
+    assert key_hash_slot(b"foo") == 12182
+    assert key_hash_slot(b"{user1000}.following") == key_hash_slot(b"{user1000}.followers") == key_hash_slot(b"user1000")
+    # Only a non-empty tag counts, and only the first one
+    assert key_hash_slot(b"foo{}{bar}") == crc16(b"foo{}{bar}") % CLUSTER_SLOTS
+    assert key_hash_slot(b"foo{{bar}}zap") == key_hash_slot(b"{bar")
+    assert key_hash_slot(b"foo{bar}{zap}") == key_hash_slot(b"bar")
+
+def test_slot_ranges_cover_every_slot_once():
+    cluster = Cluster(3, 1, "127.0.0.1", 6379)
+    ranges = [cluster.slot_range(worker) for worker in range(3)]
+    assert ranges[0][0] == 0 and ranges[-1][1] == CLUSTER_SLOTS - 1
+    assert all(ranges[i][1] + 1 == ranges[i + 1][0] for i in range(2))
+    assert cluster.worker_port(1) == 6381
+    assert cluster.keys_slot([]) is None
+    assert cluster.keys_slot([b"{a}x", b"{a}y"]) == key_hash_slot(b"a")
+    assert cluster.keys_slot([b"a", b"b"]) == -1
@@ -0,0 +1,374 @@
+import time
+
+from app.main import handle_command
+
+def test_dispatch_is_case_insensitive():
+    assert handle_command([b"PING"]) == b"+PONG\r\n"
+    assert handle_command([b"ping"]) == b"+PONG\r\n"
+    assert handle_command([b"PiNg"]) == b"+PONG\r\n"
+
+def test_unknown_command_is_an_error():
+    reply = handle_command([b"NOSUCH", b"a"])
+    assert reply == b"-ERR unknown command 'NOSUCH', with args beginning with: 'a'\r\n"
+
+def test_arity_is_checked_before_the_handler():
+    assert handle_command([b"GET"]) == b"-ERR wrong number of arguments for 'get' command\r\n"
+    assert handle_command([b"SET", b"k"]) == b"-ERR wrong number of arguments for 'set' command\r\n"
+
+def test_command_info():
+    reply = handle_command([b"COMMAND", b"INFO", b"get", b"nosuch"])
+    assert reply.startswith(b"*2\r\n*6\r\n$3\r\nget\r\n:2\r\n")
+    assert reply.endswith(b"*-1\r\n")
+
+def test_active_expire_cycle_reclaims_unread_keys():
+    from app.main import KEYSPACE, active_expire_cycle
+    handle_command([b"SET", b"volatile", b"v", b"PX", b"1"])
+    handle_command([b"SET", b"persistent", b"v"])
+    time.sleep(0.01)
+    before = KEYSPACE.expired_keys()
+    assert active_expire_cycle(25000) == 1
+    assert b"volatile" not in KEYSPACE.shard_for(b"volatile").data
+    assert KEYSPACE.exists(b"persistent")
+    assert KEYSPACE.expired_keys() == before + 1
+
+def test_keys_skips_expired_keys():
+    handle_command([b"SET", b"gone", b"v", b"PX", b"1"])
+    time.sleep(0.01)
+    assert b"gone" not in handle_command([b"KEYS", b"*"])
+
+def test_volatile_ttl_evicts_soonest_expiring_key():
+    from app.main import KEYSPACE
+    handle_command([b"SET", b"ttl-long", b"v", b"PX", b"100000"])
+    handle_command([b"SET", b"ttl-short", b"v", b"PX", b"50000"])
+    KEYSPACE.active_expire_cycle(25000) # Leave no already-expired keys to evict first
+    saved = KEYSPACE.maxmemory, KEYSPACE.policy
+    KEYSPACE.maxmemory, KEYSPACE.policy = KEYSPACE.used_memory() - 1, "volatile-ttl"
+    try:
+        assert KEYSPACE.perform_evictions()
+    finally:
+        KEYSPACE.maxmemory, KEYSPACE.policy = saved
+    assert not KEYSPACE.exists(b"ttl-short")
+    assert KEYSPACE.exists(b"ttl-long")
+
+def test_noeviction_rejects_writes_over_maxmemory():
+    from app.main import KEYSPACE
+    KEYSPACE.maxmemory = 1
+    try:
+        assert handle_command([b"SET", b"k", b"v"]).startswith(b"-OOM")
+        assert handle_command([b"GET", b"k"]) == b"$-1\r\n"
+        # EXEC is refused, and the transaction dropped, if one of its commands would be
+        from app.main import ClientConnection
+        client = ClientConnection(None, ("127.0.0.1", 1))
+        for args in ([b"MULTI"], [b"GET", b"k"], [b"SET", b"k", b"v"]):
+            handle_command(args, client)
+        assert handle_command([b"EXEC"], client).startswith(b"-EXECABORT Transaction discarded because of: OOM")
+        assert client.multi is None
+    finally:
+        KEYSPACE.maxmemory = 0
+
+def test_values_are_binary_safe():
+    value = "héllo".encode() + bytes(range(256))
+    assert handle_command([b"SET", b"bin", value]) == b"+OK\r\n"
+    assert handle_command([b"GET", b"bin"]) == b"$%d\r\n%b\r\n" % (len(value), value)
+
+def test_keys_and_scan_with_patterns():
+    for key in (b"scan:a", b"scan:b", b"scan:c1"):
+        handle_command([b"SET", key, b"v"])
+    assert sorted(parse_array(handle_command([b"KEYS", b"scan:?"]))) == [b"scan:a", b"scan:b"]
+    found = []
+    cursor = b"0"
+    while True:
+        reply = handle_command([b"SCAN", cursor, b"MATCH", b"scan:[a-b]", b"COUNT", b"3", b"TYPE", b"string"])
+        cursor, keys = reply.split(b"\r\n", 3)[2], parse_array(reply.split(b"\r\n", 3)[3])
+        found += keys
+        if cursor == b"0":
+            break
+    assert sorted(found) == [b"scan:a", b"scan:b"]
+    assert handle_command([b"SCAN", b"x"]) == b"-ERR invalid cursor\r\n"
+    assert handle_command([b"SCAN", b"0", b"COUNT", b"0"]) == b"-ERR syntax error\r\n"
+
+def parse_array(reply):
+    # Bulk strings of a flat RESP array
+    return reply.split(b"\r\n")[2:-1:2]
+
+def test_multi_key_commands():
+    assert handle_command([b"MSET", b"m1", b"a", b"m2", b"b"]) == b"+OK\r\n"
+    assert handle_command([b"MSET", b"m1", b"a", b"m2"]) == b"-ERR wrong number of arguments for 'mset' command\r\n"
+    assert handle_command([b"MGET", b"m1", b"nosuch", b"m2"]) == b"*3\r\n$1\r\na\r\n$-1\r\n$1\r\nb\r\n"
+    assert handle_command([b"MSETNX", b"m3", b"c", b"m1", b"x"]) == b":0\r\n"
+    assert handle_command([b"EXISTS", b"m1", b"m1", b"m3"]) == b":2\r\n"
+    assert handle_command([b"DEL", b"m1", b"nosuch"]) == b":1\r\n"
+    assert handle_command([b"UNLINK", b"m2", b"m1"]) == b":1\r\n"
+    assert handle_command([b"EXISTS", b"m1", b"m2"]) == b":0\r\n"
+
+def test_flushall_async():
+    from app.main import KEYSPACE, LAZYFREE
+    handle_command([b"MSET"] + [b"flush%d" % (i // 2) for i in range(200)])
+    assert handle_command([b"FLUSHALL", b"ASYNC"]) == b"+OK\r\n"
+    assert len(KEYSPACE) == 0
+    deadline = time.time() + 5
+    while LAZYFREE.pending and time.time() < deadline:
+        time.sleep(0.01)
+    assert LAZYFREE.pending == 0
+    assert handle_command([b"FLUSHALL", b"LATER"]) == b"-ERR syntax error\r\n"
+
+def test_hash_commands():
+    assert handle_command([b"HSET", b"h", b"a", b"1", b"b", b"2"]) == b":2\r\n"
+    assert handle_command([b"HSET", b"h", b"a", b"3"]) == b":0\r\n"
+    assert handle_command([b"HGET", b"h", b"a"]) == b"$1\r\n3\r\n"
+    assert handle_command([b"HMGET", b"h", b"a", b"nosuch"]) == b"*2\r\n$1\r\n3\r\n$-1\r\n"
+    assert handle_command([b"HINCRBY", b"h", b"b", b"5"]) == b":7\r\n"
+    assert handle_command([b"HINCRBY", b"h", b"b", b"x"]) == b"-ERR value is not an integer or out of range\r\n"
+    assert handle_command([b"HLEN", b"h"]) == b":2\r\n"
+    assert handle_command([b"OBJECT", b"ENCODING", b"h"]) == b"$8\r\nlistpack\r\n"
+    assert handle_command([b"HDEL", b"h", b"a", b"b"]) == b":2\r\n"
+    assert handle_command([b"EXISTS", b"h"]) == b":0\r\n"
+
+def test_list_commands():
+    assert handle_command([b"RPUSH", b"l", b"a", b"b"]) == b":2\r\n"
+    assert handle_command([b"LPUSH", b"l", b"c"]) == b":3\r\n"
+    assert handle_command([b"LRANGE", b"l", b"0", b"-1"]) == b"*3\r\n$1\r\nc\r\n$1\r\na\r\n$1\r\nb\r\n"
+    assert handle_command([b"LINDEX", b"l", b"-1"]) == b"$1\r\nb\r\n"
+    assert handle_command([b"LSET", b"l", b"5", b"x"]) == b"-ERR index out of range\r\n"
+    assert handle_command([b"RPOP", b"l", b"2"]) == b"*2\r\n$1\r\nb\r\n$1\r\na\r\n"
+    assert handle_command([b"LPOP", b"l"]) == b"$1\r\nc\r\n"
+    assert handle_command([b"LPOP", b"l"]) == b"$-1\r\n"
+    assert handle_command([b"TYPE", b"l"]) == b"+none\r\n"
+
+def test_set_and_sorted_set_commands():
+    assert handle_command([b"SADD", b"s", b"1", b"2", b"1"]) == b":2\r\n"
+    assert handle_command([b"OBJECT", b"ENCODING", b"s"]) == b"$6\r\nintset\r\n"
+    assert handle_command([b"SISMEMBER", b"s", b"2"]) == b":1\r\n"
+    assert handle_command([b"SREM", b"s", b"2", b"3"]) == b":1\r\n"
+    assert handle_command([b"ZADD", b"z", b"1", b"a", b"2.5", b"b", b"3", b"c"]) == b":3\r\n"
+    assert handle_command([b"ZADD", b"z", b"XX", b"CH", b"5", b"a", b"1", b"d"]) == b":1\r\n"
+    assert handle_command([b"ZRANGE", b"z", b"0", b"1", b"WITHSCORES"]) == b"*4\r\n$1\r\nb\r\n$3\r\n2.5\r\n$1\r\nc\r\n$1\r\n3\r\n"
+    assert handle_command([b"ZRANGEBYSCORE", b"z", b"(2.5", b"+inf"]) == b"*2\r\n$1\r\nc\r\n$1\r\na\r\n"
+    assert handle_command([b"ZCOUNT", b"z", b"-inf", b"3"]) == b":2\r\n"
+    assert handle_command([b"ZRANK", b"z", b"a"]) == b":2\r\n"
+    assert handle_command([b"ZINCRBY", b"z", b"1", b"b"]) == b"$3\r\n3.5\r\n"
+    assert handle_command([b"ZADD", b"z", b"nan", b"x"]) == b"-ERR value is not a valid float\r\n"
+
+def test_wrong_type_is_an_error():
+    handle_command([b"SET", b"str", b"v"])
+    handle_command([b"RPUSH", b"lst", b"v"])
+    wrongtype = b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+    assert handle_command([b"HSET", b"str", b"f", b"v"]) == wrongtype
+    assert handle_command([b"SADD", b"lst", b"m"]) == wrongtype
+    assert handle_command([b"GET", b"lst"]) == wrongtype
+    assert handle_command([b"LRANGE", b"lst", b"0", b"-1"]) == b"*1\r\n$1\r\nv\r\n"
+
+def test_set_options():
+    assert handle_command([b"SET", b"opt", b"1", b"NX"]) == b"+OK\r\n"
+    assert handle_command([b"SET", b"opt", b"2", b"NX"]) == b"$-1\r\n"
+    assert handle_command([b"SET", b"opt", b"3", b"XX", b"GET"]) == b"$1\r\n1\r\n"
+    assert handle_command([b"SET", b"opt-missing", b"1", b"XX"]) == b"$-1\r\n"
+    assert handle_command([b"SET", b"opt", b"4", b"EX", b"100"]) == b"+OK\r\n"
+    assert handle_command([b"SET", b"opt", b"5", b"KEEPTTL"]) == b"+OK\r\n"
+    assert 99 <= int(handle_command([b"TTL", b"opt"])[1:]) <= 100
+    assert handle_command([b"SET", b"opt", b"6"]) == b"+OK\r\n"
+    assert handle_command([b"PTTL", b"opt"]) == b":-1\r\n"
+    assert handle_command([b"SET", b"opt", b"7", b"NX", b"XX"]) == b"-ERR syntax error\r\n"
+    assert handle_command([b"SET", b"opt", b"7", b"EX", b"1", b"KEEPTTL"]) == b"-ERR syntax error\r\n"
+    assert handle_command([b"SET", b"opt", b"7", b"PX"]) == b"-ERR syntax error\r\n"
+    assert handle_command([b"SET", b"opt", b"7", b"EX", b"0"]) == b"-ERR invalid expire time in 'set' command\r\n"
+    assert handle_command([b"GET", b"opt"]) == b"$1\r\n6\r\n"
+    # Relative times are rewritten to absolute ones for the AOF and replicas
+    args = [b"SET", b"opt", b"8", b"EX", b"10"]
+    handle_command(args)
+    assert args[3] == b"PXAT" and int(args[4]) > time.time() * 1000 + 9000
+
+def test_counters_and_ttls():
+    from app.main import KEYSPACE
+    assert handle_command([b"INCR", b"n"]) == b":1\r\n"
+    assert handle_command([b"INCRBY", b"n", b"41"]) == b":42\r\n"
+    assert handle_command([b"DECRBY", b"n", b"2"]) == b":40\r\n"
+    assert handle_command([b"DECR", b"n"]) == b":39\r\n"
+    assert KEYSPACE.get(b"n") == 39 # The int encoding
+    assert handle_command([b"OBJECT", b"ENCODING", b"n"]) == b"$3\r\nint\r\n"
+    assert handle_command([b"GET", b"n"]) == b"$2\r\n39\r\n"
+    assert handle_command([b"SET", b"max", b"9223372036854775807"]) == b"+OK\r\n"
+    assert handle_command([b"INCR", b"max"]) == b"-ERR increment or decrement would overflow\r\n"
+    assert handle_command([b"SET", b"text", b"abc"]) == b"+OK\r\n"
+    assert handle_command([b"INCR", b"text"]) == b"-ERR value is not an integer or out of range\r\n"
+    assert handle_command([b"INCRBYFLOAT", b"n", b"0.5"]) == b"$4\r\n39.5\r\n"
+    assert handle_command([b"INCRBYFLOAT", b"n", b"inf"]) == b"-ERR increment would produce NaN or Infinity\r\n"
+
+    assert handle_command([b"GETSET", b"n", b"1"]) == b"$4\r\n39.5\r\n"
+    assert handle_command([b"GETDEL", b"n"]) == b"$1\r\n1\r\n"
+    assert handle_command([b"GETDEL", b"n"]) == b"$-1\r\n"
+
+    handle_command([b"SET", b"t", b"v"])
+    assert handle_command([b"TTL", b"t"]) == b":-1\r\n"
+    assert handle_command([b"TTL", b"no-such-key"]) == b":-2\r\n"
+    assert handle_command([b"EXPIRE", b"t", b"100", b"XX"]) == b":0\r\n"
+    assert handle_command([b"EXPIRE", b"t", b"100"]) == b":1\r\n"
+    assert handle_command([b"EXPIRE", b"t", b"50", b"GT"]) == b":0\r\n"
+    assert handle_command([b"PEXPIRE", b"t", b"50000", b"LT"]) == b":1\r\n"
+    assert handle_command([b"TTL", b"t"]) == b":50\r\n"
+    assert handle_command([b"GETEX", b"t", b"PERSIST"]) == b"$1\r\nv\r\n"
+    assert handle_command([b"PERSIST", b"t"]) == b":0\r\n"
+    assert handle_command([b"GETEX", b"t", b"PX", b"100000"]) == b"$1\r\nv\r\n"
+    assert handle_command([b"PERSIST", b"t"]) == b":1\r\n"
+    # A time already past deletes the key, and is logged as DEL
+    args = [b"EXPIRE", b"t", b"-1"]
+    assert handle_command(args) == b":1\r\n"
+    assert args == [b"DEL", b"t"]
+    assert handle_command([b"EXISTS", b"t"]) == b":0\r\n"
+
+def test_transactions():
+    from app.main import ClientConnection
+    client, other = ClientConnection(None, ("127.0.0.1", 1)), ClientConnection(None, ("127.0.0.1", 2))
+    assert handle_command([b"EXEC"], client) == b"-ERR EXEC without MULTI\r\n"
+    assert handle_command([b"MULTI"], client) == b"+OK\r\n"
+    assert handle_command([b"SET", b"tx", b"1"], client) == b"+QUEUED\r\n"
+    assert handle_command([b"INCR", b"tx"], client) == b"+QUEUED\r\n"
+    assert handle_command([b"LPUSH", b"tx", b"x"], client) == b"+QUEUED\r\n"
+    assert handle_command([b"GET", b"tx"], other) == b"$-1\r\n"
+    # A command that fails at EXEC does not stop the others
+    assert handle_command([b"EXEC"], client) == (b"*3\r\n+OK\r\n:2\r\n"
+                                                 b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n")
+
+    # One refused while queueing aborts the whole transaction
+    handle_command([b"MULTI"], client)
+    handle_command([b"INCR", b"tx"], client)
+    assert handle_command([b"GET"], client).startswith(b"-ERR wrong number of arguments")
+    assert handle_command([b"EXEC"], client) == b"-EXECABORT Transaction discarded because of previous errors.\r\n"
+    assert handle_command([b"GET", b"tx"], client) == b"$1\r\n2\r\n"
+
+    # WATCH: EXEC does nothing once another client has changed a watched key
+    assert handle_command([b"WATCH", b"tx"], client) == b"+OK\r\n"
+    handle_command([b"MULTI"], client)
+    assert handle_command([b"WATCH", b"tx"], client) == b"-ERR WATCH inside MULTI is not allowed\r\n"
+    handle_command([b"INCR", b"tx"], client)
+    handle_command([b"SET", b"tx", b"10"], other)
+    assert handle_command([b"EXEC"], client) == b"*-1\r\n"
+    assert handle_command([b"GET", b"tx"], client) == b"$2\r\n10\r\n"
+    handle_command([b"WATCH", b"tx"], client)
+    handle_command([b"MULTI"], client)
+    handle_command([b"INCR", b"tx"], client)
+    assert handle_command([b"EXEC"], client) == b"*1\r\n:11\r\n"
+    handle_command([b"WATCH", b"tx"], client)
+    handle_command([b"MULTI"], client)
+    assert handle_command([b"DISCARD"], client) == b"+OK\r\n"
+    assert handle_command([b"DISCARD"], client) == b"-ERR DISCARD without MULTI\r\n"
+    assert not client.watched
+
+def test_writes_that_change_nothing_leave_watched_keys_alone():
+    from app.main import KEYSPACE, ClientConnection
+    client, other = ClientConnection(None, ("127.0.0.1", 1)), ClientConnection(None, ("127.0.0.1", 2))
+    handle_command([b"HSET", b"nc:h", b"f", b"1"])
+    handle_command([b"SADD", b"nc:s", b"a"])
+    handle_command([b"ZADD", b"nc:z", b"1", b"a"])
+    handle_command([b"WATCH", b"nc:h", b"nc:s", b"nc:z"], client)
+    dirty = KEYSPACE.dirty()
+    assert handle_command([b"HSETNX", b"nc:h", b"f", b"2"], other) == b":0\r\n"
+    assert handle_command([b"HDEL", b"nc:h", b"nosuch"], other) == b":0\r\n"
+    assert handle_command([b"HINCRBY", b"nc:h", b"f", b"%d" % (2 ** 63 - 1)], other).endswith(b"overflow\r\n")
+    assert handle_command([b"SADD", b"nc:s", b"a"], other) == b":0\r\n"
+    assert handle_command([b"SREM", b"nc:s", b"b"], other) == b":0\r\n"
+    assert handle_command([b"ZADD", b"nc:z", b"1", b"a"], other) == b":0\r\n"
+    assert handle_command([b"ZREM", b"nc:z", b"b"], other) == b":0\r\n"
+    assert KEYSPACE.dirty() == dirty
+    handle_command([b"MULTI"], client)
+    handle_command([b"HGET", b"nc:h", b"f"], client)
+    assert handle_command([b"EXEC"], client) == b"*1\r\n$1\r\n1\r\n"
+
+def test_exec_with_a_keyless_command_locks_shards_in_order():
+    import sys
+    import threading
+    from app.main import ClientConnection
+    keys = [b"order:%d" % i for i in range(64)]
+    deadline = time.time() + 1
+
+    def transactions():
+        client = ClientConnection(None, ("127.0.0.1", 1))
+        while time.time() < deadline:
+            for args in ([b"MULTI"], [b"SET", b"order:63", b"1"], [b"KEYS", b"order:1*"], [b"EXEC"]):
+                handle_command(args, client)
+
+    def batches():
+        while time.time() < deadline:
+            handle_command([b"MSET"] + [part for key in keys for part in (key, b"v")])
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    try:
+        threads = [threading.Thread(target=target, daemon=True) for target in (transactions, batches)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert not any(thread.is_alive() for thread in threads)
+    finally:
+        sys.setswitchinterval(interval)
+    handle_command([b"DEL"] + keys)
+
+def test_rewritten_commands_rebuild_collections():
+    from app.aof import rebuild_commands
+    from app.main import KEYSPACE
+    handle_command([b"RPUSH", b"big"] + [b"%d" % i for i in range(200)])
+    handle_command([b"ZADD", b"scores", b"1.5", b"a", b"-inf", b"b"])
+    handle_command([b"PEXPIREAT", b"scores", b"%d" % (time.time() * 1000 + 60000)])
+    for key in (b"big", b"scores"):
+        value = KEYSPACE.get(key)
+        expire_at = KEYSPACE.shard_for(key).data[key].expire_at
+        commands = rebuild_commands(key, value, expire_at)
+        handle_command([b"DEL", key])
+        for args in commands:
+            reply = handle_command([arg if isinstance(arg, bytes) else str(arg).encode() for arg in args])
+            assert not reply.startswith(b"-"), reply
+        assert list(KEYSPACE.get(key).items() if key == b"scores" else KEYSPACE.get(key)) == list(
+            value.items() if key == b"scores" else value)
+    assert len(rebuild_commands(b"big", KEYSPACE.get(b"big"), None)) == 4
+
+def test_commandstats_and_slowlog():
+    from app import main
+    main.SERVER_CONFIG.update({"slowlog-log-slower-than": "0", "slowlog-max-len": "128",
+                               "latency-monitor-threshold": "0"})
+    main.configure_instrumentation()
+    # configure_instrumentation() swaps the timed dispatcher in
+    handle_command = main.handle_command
+    try:
+        get, hget = main.lookup_command(b"get"), main.lookup_command(b"hget")
+        before = [(cmd.calls, cmd.rejected_calls, cmd.failed_calls) for cmd in (get, hget)]
+        handle_command([b"SLOWLOG", b"RESET"])
+        handle_command([b"SET", b"stat", b"v"])
+        handle_command([b"GET", b"stat"])
+        handle_command([b"GET"])
+        handle_command([b"HGET", b"stat", b"f"])
+        after = [(cmd.calls, cmd.rejected_calls, cmd.failed_calls) for cmd in (get, hget)]
+        assert [tuple(b - a for a, b in zip(*pair)) for pair in zip(before, after)] == [(1, 1, 0), (1, 0, 1)]
+        assert b"cmdstat_hget:calls=" in handle_command([b"INFO", b"commandstats"])
+        assert b"# Commandstats" not in handle_command([b"INFO"])
+        # With a threshold of 0 everything that ran is logged, SLOWLOG RESET and INFO too
+        assert handle_command([b"SLOWLOG", b"LEN"]) == b":6\r\n"
+        newest = handle_command([b"SLOWLOG", b"GET", b"1"])
+        assert newest.startswith(b"*1\r\n*6\r\n:") and b"$3\r\nLEN\r\n" in newest
+    finally:
+        main.SERVER_CONFIG["slowlog-log-slower-than"] = "-1"
+        main.configure_instrumentation()
+    assert main.handle_command is main.dispatch_command
+
+def test_info_sections():
+    info = handle_command([b"INFO"])
+    for section in (b"# Server", b"# Clients", b"# Memory", b"# Persistence", b"# Stats", b"# Cpu"):
+        assert section in info
+    assert b"total_commands_processed:" in info and b"keyspace_hits:" in info
+
+def test_workers_redirect_to_slot_owner():
+    from app import main
+    from app.cluster import Cluster, key_hash_slot
+    assert handle_command([b"CLUSTER", b"SLOTS"]).startswith(b"-ERR This instance has cluster support disabled")
+    main.CLUSTER = Cluster(2, 0, "127.0.0.1", 6379)
+    try:
+        # "foo" hashes to slot 12182, which the second of two workers owns
+        assert handle_command([b"GET", b"foo"]) == b"-MOVED 12182 127.0.0.1:6381\r\n"
+        assert handle_command([b"SET", b"bar", b"v"]) == b"+OK\r\n"
+        assert handle_command([b"MSET", b"bar", b"1", b"foo", b"2"]).startswith(b"-CROSSSLOT")
+        assert handle_command([b"MGET", b"{bar}1", b"{bar}2"]) == b"*2\r\n$-1\r\n$-1\r\n"
+        assert handle_command([b"CLUSTER", b"KEYSLOT", b"{foo}x"]) == b":%d\r\n" % key_hash_slot(b"foo")
+        assert handle_command([b"CLUSTER", b"SLOTS"]).startswith(b"*2\r\n*3\r\n:0\r\n:8191\r\n*3\r\n$9\r\n127.0.0.1\r\n:6380\r\n")
+        assert b"cluster_enabled:1" in handle_command([b"INFO", b"cluster"])
+    finally:
+        main.CLUSTER = None
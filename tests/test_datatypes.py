@@ -0,0 +1,61 @@
+from app.datatypes import ENCODING_LIMITS, Hash, List, Set, ZSet, from_loaded
+from app.rdb_parser import SortedSet
+
+def test_hash_converts_past_limits():
+    h = Hash()
+    assert h.set(b"f", b"v") and not h.set(b"f", b"w")
+    assert h.get(b"f") == b"w" and h.encoding == "listpack"
+    # A value equal to a field name is not mistaken for the field
+    h.set(b"g", b"f")
+    assert h.get(b"f") == b"w" and len(h) == 2
+    h.set(b"long", b"x" * (ENCODING_LIMITS["hash-max-listpack-value"] + 1))
+    assert h.encoding == "hashtable" and h.get(b"g") == b"f"
+    h = Hash((b"f%d" % i, b"v") for i in range(ENCODING_LIMITS["hash-max-listpack-entries"] + 1))
+    assert h.encoding == "hashtable"
+    assert h.delete(b"f0") and not h.delete(b"f0")
+
+def test_list_push_pop():
+    lst = List()
+    lst.push([b"a", b"b"], left=True)
+    lst.push([b"c"])
+    assert list(lst) == [b"b", b"a", b"c"]
+    assert lst.pop(2, left=False) == [b"c", b"a"]
+    lst.push([b"%d" % i for i in range(ENCODING_LIMITS["list-max-listpack-size"])])
+    assert lst.encoding == "quicklist"
+    lst.push([b"x", b"y"], left=True)
+    assert lst.range(0, 2) == [b"y", b"x", b"b"]
+    assert lst.pop(1, left=True) == [b"y"]
+
+def test_set_encodings():
+    s = Set()
+    assert s.add(b"3") and s.add(b"-1") and not s.add(b"3")
+    assert s.encoding == "intset" and list(s) == [b"-1", b"3"]
+    assert b"3" in s and b"03" not in s
+    s.add(b"03")
+    assert s.encoding == "listpack" and len(s) == 3
+    s.add(b"x" * (ENCODING_LIMITS["set-max-listpack-value"] + 1))
+    assert s.encoding == "hashtable"
+    assert s.remove(b"-1") and not s.remove(b"-1")
+    big = Set(b"%d" % i for i in range(ENCODING_LIMITS["set-max-intset-entries"]))
+    assert big.encoding == "intset"
+    big.add(b"1000000")
+    assert big.encoding == "hashtable"
+
+def test_zset_ranges():
+    z = ZSet()
+    for i in range(200):
+        z.add(b"m%d" % i, float(i % 100))
+    assert z.encoding == "skiplist"
+    assert z.score(b"m150") == 50.0
+    assert z.score_bounds(10, 12) == (20, 26)
+    assert z.score_bounds(10, 12, low_exclusive=True, high_exclusive=True) == (22, 24)
+    assert not z.add(b"m150", -1.0)
+    assert z.rank(b"m150") == 0 and z.entries(0, 1) == [(-1.0, b"m150")]
+    assert z.remove(b"m150") and z.score(b"m150") is None and len(z) == 199
+
+def test_loaded_values_are_converted():
+    assert from_loaded(b"v") == b"v"
+    assert isinstance(from_loaded(SortedSet({b"m": 1.0})), ZSet)
+    assert from_loaded({b"f": b"v"}).get(b"f") == b"v"
+    assert list(from_loaded([b"a", b"b"])) == [b"a", b"b"]
+    assert from_loaded({b"1", b"2"}).encoding == "intset"
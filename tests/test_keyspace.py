@@ -0,0 +1,109 @@
+import threading
+import time
+
+from app.keyspace import Keyspace
+
+def test_set_get_delete():
+    keyspace = Keyspace(4)
+    keyspace.set("a", "1")
+    assert keyspace.get("a") == "1"
+    assert keyspace.delete("a")
+    assert keyspace.get("a") is None
+    assert not keyspace.delete("a")
+    assert len(keyspace) == 0
+
+def test_set_clears_ttl_unless_kept():
+    keyspace = Keyspace(4)
+    keyspace.set("a", "1", expire_at=2 ** 62)
+    assert keyspace.expires_count() == 1
+    keyspace.set("a", "2", keep_ttl=True)
+    assert keyspace.expires_count() == 1
+    keyspace.set("a", "3")
+    assert keyspace.expires_count() == 0
+    assert keyspace.snapshot() == [("a", "3", None)]
+
+def test_expiry_checks_the_cached_clock():
+    keyspace = Keyspace(4)
+    keyspace.tick()
+    keyspace.set("a", "1", expire_at=keyspace.now_ms() + 1)
+    time.sleep(0.01)
+    # Still the time of the last tick, as for the rest of an event loop pass
+    assert keyspace.get("a") == "1"
+    keyspace.tick()
+    assert keyspace.get("a") is None
+    assert keyspace.expired_keys() == 1
+
+def test_concurrent_writers_and_expiry():
+    keyspace = Keyspace(8)
+    errors = []
+
+    def writer(n):
+        try:
+            for i in range(2000):
+                key = f"k{i % 50}"
+                keyspace.set(key, str(n), expire_at=1 if i % 3 == 0 else None)
+                keyspace.get(key)
+                if i % 7 == 0:
+                    keyspace.delete(key)
+                if i % 100 == 0:
+                    keyspace.active_expire_cycle(1000)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert keyspace.expires_count() == sum(
+        1 for shard in keyspace.shards for entry in shard.data.values() if entry.expire_at is not None)
+
+def test_lock_keys_orders_shards():
+    keyspace = Keyspace(16)
+    keys = [f"key{i}" for i in range(40)]
+    # Opposite key orders must not deadlock
+    def lock_twice(order):
+        for _ in range(200):
+            with keyspace.lock_keys(order):
+                pass
+    threads = [threading.Thread(target=lock_twice, args=(keys,)),
+               threading.Thread(target=lock_twice, args=(keys[::-1],))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+        assert not t.is_alive()
+
+def test_scan_returns_every_key_present_throughout():
+    keyspace = Keyspace(4)
+    for i in range(1000):
+        keyspace.set(b"k%d" % i, b"v")
+    seen = []
+    cursor, calls = 0, 0
+    while True:
+        cursor, keys = keyspace.scan(cursor, 20)
+        seen += keys
+        calls += 1
+        # Churn while scanning: add new keys, delete some of the later ones
+        for j in range(30):
+            keyspace.set(b"new%d:%d" % (calls, j), b"v")
+        keyspace.delete(b"k%d" % (999 - calls))
+        if cursor == 0:
+            break
+    assert calls > 10
+    survivors = {b"k%d" % i for i in range(1000 - calls)}
+    assert survivors <= set(seen)
+
+def test_batch_operations_and_flush():
+    keyspace = Keyspace(4)
+    assert keyspace.set_many([(b"a", b"1"), (b"b", b"2")])
+    assert not keyspace.set_many([(b"c", b"3"), (b"a", b"x")], only_if_none_exist=True)
+    assert keyspace.get_many([b"a", b"c", b"b"]) == [b"1", None, b"2"]
+    released = []
+    assert keyspace.delete_many([b"a", b"a", b"c"], released.extend) == 1
+    assert released == [b"1"]
+    keyspace.set(b"t", b"v", expire_at=time.time() * 1000 + 60000)
+    old = keyspace.flush()
+    assert len(keyspace) == 0 and keyspace.expires_count() == 0 and keyspace.used_memory() == 0
+    assert sorted(key for data in old for key in data) == [b"b", b"t"]
@@ -0,0 +1,55 @@
+import time
+
+import app.lazyfree as lazyfree_module
+import app.main as main
+from app.lazyfree import LazyFree
+
+def wait_until_freed(lazyfree):
+    deadline = time.time() + 5
+    while lazyfree.pending and time.time() < deadline:
+        time.sleep(0.01)
+    assert lazyfree.pending == 0
+
+def test_small_values_are_not_queued():
+    lazyfree = LazyFree()
+    lazyfree.free([b"x" * 1000000, [1, 2, 3]])
+    assert lazyfree.freed == 0 and lazyfree.thread is None
+
+def test_values_still_referenced_are_not_emptied():
+    lazyfree = LazyFree()
+    shared = list(range(100000))
+    lazyfree.free([shared, {i: i for i in range(100000)}])
+    wait_until_freed(lazyfree)
+    assert lazyfree.freed == 2
+    assert len(shared) == 100000
+
+def record_releases(monkeypatch):
+    emptied = []
+    release = lazyfree_module.release
+    def record(value):
+        release(value)
+        emptied.append((type(value).__name__, len(value)))
+    monkeypatch.setattr(lazyfree_module, "release", record)
+    return emptied
+
+def test_values_are_taken_out_of_the_list(monkeypatch):
+    emptied = record_releases(monkeypatch)
+    lazyfree = LazyFree()
+    values = [list(range(100000)), {i: i for i in range(100000)}]
+    lazyfree.free(values) # Still referenced here, as a caller may
+    wait_until_freed(lazyfree)
+    assert values == [] and sorted(emptied) == [("dict", 0), ("list", 0)]
+
+def test_unlinked_values_are_emptied(monkeypatch):
+    emptied = record_releases(monkeypatch)
+    main.handle_command([b"RPUSH", b"big:list"] + [b"%d" % i for i in range(5000)])
+    main.handle_command([b"SADD", b"big:set"] + [b"%d" % i for i in range(5000)])
+    assert main.handle_command([b"UNLINK", b"big:list", b"big:set", b"nosuch"]) == b":2\r\n"
+    wait_until_freed(main.LAZYFREE)
+    assert ("List", 0) in emptied and ("Set", 0) in emptied
+    del emptied[:]
+    main.handle_command([b"SADD", b"big:set"] + [b"%d" % i for i in range(5000)])
+    assert main.handle_command([b"FLUSHALL", b"ASYNC"]) == b"+OK\r\n"
+    wait_until_freed(main.LAZYFREE)
+    assert emptied.count(("dict", 0)) == len(main.KEYSPACE.shards)
+    assert all(size == 0 for _, size in emptied)
@@ -0,0 +1,31 @@
+from app.monitoring import SLOWLOG_ENTRY_MAX_ARGC, LatencyMonitor, SlowLog
+
+def test_slowlog_keeps_newest_entries_truncated():
+    slowlog = SlowLog(max_len=2)
+    slowlog.add([b"GET", b"a"], 5)
+    slowlog.add([b"SET", b"k", b"x" * 200], 6, "127.0.0.1:5000")
+    slowlog.add([b"MSET"] + [b"k"] * 40, 7)
+    entries = slowlog.get()
+    assert [entry[0] for entry in entries] == [2, 1]
+    mset_args = entries[0][3]
+    assert len(mset_args) == SLOWLOG_ENTRY_MAX_ARGC and mset_args[-1] == b"... (10 more arguments)"
+    assert entries[1][3][2] == b"x" * 128 + b"... (72 more bytes)"
+    assert entries[1][4] == "127.0.0.1:5000"
+    assert len(slowlog.get(1)) == 1
+    slowlog.reset()
+    assert slowlog.get(-1) == []
+
+def test_latency_monitor_keeps_worst_sample_per_second():
+    latency = LatencyMonitor(threshold_ms=0)
+    latency.add_sample("command", 500)
+    assert latency.latest() == []
+    latency.threshold_ms = 10
+    latency.add_sample("command", 5)
+    latency.add_sample("command", 20)
+    latency.add_sample("command", 15)
+    latency.add_sample("fork", 12)
+    (event, when, latest, worst), _ = latency.latest()
+    assert (event, latest, worst) == ("command", 20, 20)
+    assert [ms for _, ms in latency.history("command")] == [20]
+    assert latency.reset(["fork", "nosuch"]) == 1
+    assert latency.reset() == 1
@@ -0,0 +1,44 @@
+import app.main as main
+from app.main import ClientConnection, handle_command
+
+def new_client(port):
+    return ClientConnection(None, ("127.0.0.1", port))
+
+def test_publish_reaches_channel_and_pattern_subscribers():
+    a, b, c = new_client(1), new_client(2), new_client(3)
+    assert handle_command([b"SUBSCRIBE", b"news", b"sport"], a) == (b"*3\r\n$9\r\nsubscribe\r\n$4\r\nnews\r\n:1\r\n"
+                                                                     b"*3\r\n$9\r\nsubscribe\r\n$5\r\nsport\r\n:2\r\n")
+    assert handle_command([b"PSUBSCRIBE", b"n*"], b) == b"*3\r\n$10\r\npsubscribe\r\n$2\r\nn*\r\n:1\r\n"
+    assert handle_command([b"PUBLISH", b"news", b"hi"], c) == b":2\r\n"
+    assert bytes(a.outbuf) == b"*3\r\n$7\r\nmessage\r\n$4\r\nnews\r\n$2\r\nhi\r\n"
+    assert bytes(b.outbuf) == b"*4\r\n$8\r\npmessage\r\n$2\r\nn*\r\n$4\r\nnews\r\n$2\r\nhi\r\n"
+    assert handle_command([b"PUBLISH", b"weather", b"rain"], c) == b":0\r\n"
+
+    assert handle_command([b"GET", b"k"], a).startswith(b"-ERR Can't execute 'get'")
+    assert handle_command([b"PING"], a) == b"*2\r\n$4\r\npong\r\n$0\r\n\r\n"
+    assert handle_command([b"PUBSUB", b"CHANNELS", b"s*"], c) == b"*1\r\n$5\r\nsport\r\n"
+    assert handle_command([b"PUBSUB", b"NUMSUB", b"news", b"none"], c) == b"*4\r\n$4\r\nnews\r\n:1\r\n$4\r\nnone\r\n:0\r\n"
+    assert handle_command([b"PUBSUB", b"NUMPAT"], c) == b":1\r\n"
+
+    assert handle_command([b"UNSUBSCRIBE"], a) == (b"*3\r\n$11\r\nunsubscribe\r\n$4\r\nnews\r\n:1\r\n"
+                                                   b"*3\r\n$11\r\nunsubscribe\r\n$5\r\nsport\r\n:0\r\n")
+    assert handle_command([b"PUNSUBSCRIBE", b"n*"], b) == b"*3\r\n$12\r\npunsubscribe\r\n$2\r\nn*\r\n:0\r\n"
+    assert main.PUBSUB.channels == {} and main.PUBSUB.patterns == {}
+    assert handle_command([b"UNSUBSCRIBE"], a) == b"*3\r\n$11\r\nunsubscribe\r\n$-1\r\n:0\r\n"
+
+def test_slow_subscriber_is_disconnected():
+    fast, slow, publisher = new_client(1), new_client(2), new_client(3)
+    handle_command([b"SUBSCRIBE", b"events"], fast)
+    handle_command([b"SUBSCRIBE", b"events"], slow)
+    saved = main.PUBSUB_OUTPUT_BUFFER_LIMIT
+    main.PUBSUB_OUTPUT_BUFFER_LIMIT = (1000, 0, 0)
+    try:
+        for i in range(5):
+            fast.outbuf.clear() # Reads everything as it comes
+            handle_command([b"PUBLISH", b"events", b"x" * 300], publisher)
+    finally:
+        main.PUBSUB_OUTPUT_BUFFER_LIMIT = saved
+    assert slow.close_after_reply and not slow.outbuf and not slow.channels
+    assert not fast.close_after_reply and fast.channels == {b"events"}
+    assert main.PUBSUB.numsub(b"events") == 1
+    main.PUBSUB.unsubscribe_all(fast)
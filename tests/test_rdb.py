@@ -0,0 +1,120 @@
+import os
+import struct
+
+import app.main as main
+from app.rdb_parser import (CRC64_TABLE, RDBError, SortedSet, crc64, encode_string, iter_rdb, load_rdb, lzf_compress,
+                            lzf_decompress, parse_intset, parse_listpack, parse_ziplist, read_string, save_rdb)
+
+def test_crc64_matches_redis():
+    assert crc64(0, b"123456789") == 0xE9C6D914C4B8D9CA
+    # Long inputs take the bulk path, which must agree with the table
+    data = os.urandom(100000)
+    expected = 0xFFFF
+    for byte in data:
+        expected = CRC64_TABLE[(expected ^ byte) & 0xFF] ^ (expected >> 8)
+    assert crc64(0xFFFF, data) == crc64(crc64(0xFFFF, data[:5000]), memoryview(data)[5000:]) == expected
+
+def test_lzf_round_trip():
+    for data in [b"a" * 1000, b"hello world " * 50, bytes(range(256)) * 3]:
+        compressed = lzf_compress(data)
+        assert lzf_decompress(compressed, len(data)) == data
+    assert len(lzf_compress(b"a" * 1000)) < 50
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "dump.rdb")
+    items = [("plain", "value", None), ("long", "abc" * 100, None), ("volatile", "v", 2 ** 50),
+             ("huge", "x" * 20000, None)]
+    items = [(key.encode(), value.encode(), expire_at) for key, value, expire_at in items]
+    for compression in (False, True):
+        keys, size, _ = save_rdb(path, items, compression)
+        assert keys == 4
+        assert size == os.path.getsize(path)
+        data, expiry = load_rdb(path)
+        assert data == {b"plain": b"value", b"long": b"abc" * 100, b"volatile": b"v", b"huge": b"x" * 20000}
+        assert expiry == {b"volatile": 2 ** 50}
+    assert os.listdir(tmp_path) == ["dump.rdb"]
+
+def test_corrupted_dump_is_rejected(tmp_path):
+    path = str(tmp_path / "dump.rdb")
+    save_rdb(path, [(b"key", b"value", None)])
+    with open(path, "r+b") as f:
+        f.seek(15)
+        f.write(b"X")
+    try:
+        load_rdb(path)
+    except RDBError:
+        pass
+    else:
+        assert False, "expected RDBError"
+
+def test_checksummed_dump_is_verified_whatever_the_config(tmp_path, monkeypatch, capsys):
+    def exit(code):
+        raise SystemExit(code)
+    monkeypatch.setattr(os, "_exit", exit)
+    monkeypatch.setattr("app.rdb_parser.RDB_LOAD_CHUNK", 64)
+    monkeypatch.setitem(main.SERVER_CONFIG, "rdb-checksum", "no")
+    monkeypatch.setitem(main.LOADING, "loading", True)
+    path = str(tmp_path / "dump.rdb")
+    for checksum in (False, True):
+        save_rdb(path, [(b"key:%d" % i, b"x" * 20, None) for i in range(50)], checksum=checksum)
+        with open(path, "r+b") as f:
+            data = f.read()
+            f.seek(data.rindex(b"x"))
+            f.write(b"y") # Still a valid dump
+        if checksum:
+            try:
+                main.load_dataset(path)
+            except SystemExit as e:
+                assert e.code == 1
+            else:
+                assert False, "expected the load to fail"
+            assert "Wrong RDB checksum" in capsys.readouterr().out
+        else:
+            main.load_dataset(path) # A zero trailer is not checked
+            assert len(main.KEYSPACE) == 50
+        main.KEYSPACE.flush()
+
+def test_collections_round_trip(tmp_path):
+    path = str(tmp_path / "dump.rdb")
+    items = [
+        (b"list", [b"a", b"b", b"a"], None),
+        (b"set", {b"x", b"y"}, None),
+        (b"hash", {b"f": b"v", b"g": b"w"}, 2 ** 50),
+        (b"zset", SortedSet({b"m": 1.5, b"n": float("-inf")}), None),
+        (b"binary", bytes(range(256)), None),
+    ]
+    save_rdb(path, items, checksum=False)
+    loaded = list(iter_rdb(path))
+    assert loaded == items
+    assert isinstance(loaded[3][1], SortedSet)
+
+def test_progress_is_reported(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.rdb_parser.RDB_LOAD_CHUNK", 64)
+    path = str(tmp_path / "dump.rdb")
+    save_rdb(path, [(b"key:%d" % i, b"x" * 20, None) for i in range(50)])
+    reports = []
+    assert len(list(iter_rdb(path, progress=lambda done, total: reports.append((done, total))))) == 50
+    size = os.path.getsize(path)
+    assert len(reports) > 10
+    assert reports[-1] == (size, size)
+
+def test_integer_encoded_strings_are_signed():
+    assert read_string(b"\xC0\xFF", 0) == (b"-1", 2)
+    assert read_string(b"\xC1" + struct.pack("<h", -300), 0) == (b"-300", 3)
+    assert read_string(b"\xC2" + struct.pack("<i", 70000), 0) == (b"70000", 5)
+    # Counters kept as ints are written in the same encodings
+    for n in (-1, -300, 70000, 1 << 40):
+        assert read_string(encode_string(n), 0)[0] == b"%d" % n
+
+def test_compact_encodings():
+    intset = struct.pack("<II", 2, 3) + struct.pack("<hhh", 1, 2, -3)
+    assert parse_intset(intset) == [b"1", b"2", b"-3"]
+
+    # "a", "bb", 5, 1000
+    listpack = struct.pack("<IH", 19, 4) + b"\x81a\x02" + b"\x82bb\x03" + b"\x05\x01" + b"\xC3\xE8\x02" + b"\xFF"
+    assert parse_listpack(listpack) == [b"a", b"bb", b"5", b"1000"]
+
+    # "a", immediate 7, int16 300
+    entries = b"\x00\x01a" + b"\x03\xF8" + b"\x02\xC0" + struct.pack("<h", 300)
+    ziplist = struct.pack("<IIH", 10 + len(entries) + 1, 0, 3) + entries + b"\xFF"
+    assert parse_ziplist(ziplist) == [b"a", b"7", b"300"]
@@ -0,0 +1,177 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from app.replication import ReplicationBacklog
+
+def test_backlog_keeps_the_last_bytes_across_wraparound():
+    backlog = ReplicationBacklog(16)
+    backlog.feed(b"0123456789")
+    assert backlog.since(1) == b"0123456789"
+    assert backlog.since(11) == b""
+    assert backlog.since(12) is None
+    backlog.feed(b"abcdefghij")
+    assert (backlog.offset, backlog.histlen, backlog.first_byte_offset()) == (20, 16, 5)
+    assert backlog.since(5) == b"456789abcdefghij"
+    assert backlog.since(4) is None
+    backlog.feed(b"x" * 40)
+    assert backlog.since(45) == b"x" * 16
+
+def test_partial_resync_follows_the_replication_ids():
+    from app import main
+    saved = dict(main.REPLICATION)
+    try:
+        main.create_backlog(100)
+        main.REPLICATION["backlog"].feed(b"*1\r\n$4\r\nPING\r\n")
+        replid = main.REPLICATION["replid"]
+        assert main.partial_resync_data(replid, 101) == b"*1\r\n$4\r\nPING\r\n"
+        assert main.partial_resync_data(replid, 100) is None
+        assert main.partial_resync_data("f" * 40, 101) is None
+        # After a promotion the old ID is still good up to where it ended
+        main.shift_replid()
+        assert main.partial_resync_data(replid, 115) == b""
+        assert main.partial_resync_data(replid, 116) is None
+    finally:
+        main.REPLICATION.update(saved)
+
+def test_publish_reaches_the_replicas_but_not_the_aof(tmp_path, monkeypatch):
+    from app import main
+    from app.aof import AppendOnlyFile
+    aof = AppendOnlyFile(str(tmp_path / "appendonly.aof"), "no")
+    monkeypatch.setattr(main, "AOF", aof)
+    saved = dict(main.REPLICATION)
+    try:
+        main.create_backlog(100)
+        offset = main.REPLICATION["backlog"].offset
+        assert main.handle_command([b"PUBLISH", b"news", b"hi"]) == b":0\r\n"
+        assert main.REPLICATION["backlog"].since(offset + 1) == b"*3\r\n$7\r\nPUBLISH\r\n$4\r\nnews\r\n$2\r\nhi\r\n"
+        assert aof.appended == 0
+    finally:
+        main.REPLICATION.update(saved)
+
+def test_publish_on_a_replica_stays_out_of_its_stream():
+    from app import main
+    saved = dict(main.REPLICATION)
+    try:
+        main.create_backlog(100)
+        main.REPLICATION["master_host"] = "127.0.0.1"
+        offset = main.REPLICATION["backlog"].offset
+        assert main.handle_command([b"PUBLISH", b"news", b"hi"]) == b":0\r\n"
+        assert main.REPLICATION["backlog"].offset == offset
+    finally:
+        main.REPLICATION.update(saved)
+
+def test_transaction_on_a_replica_stays_out_of_its_stream():
+    from app import main
+    saved = dict(main.REPLICATION)
+    client = main.ClientConnection(None, ("127.0.0.1", 1))
+    try:
+        main.create_backlog(100)
+        main.REPLICATION["master_host"] = "127.0.0.1"
+        offset = main.REPLICATION["backlog"].offset
+        for args in ([b"MULTI"], [b"SET", b"k", b"v"], [b"PUBLISH", b"news", b"hi"], [b"EXEC"]):
+            main.handle_command(args, client)
+        assert main.REPLICATION["backlog"].offset == offset
+    finally:
+        main.REPLICATION.update(saved)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def start_server(directory, port, *args):
+    os.makedirs(directory, exist_ok=True)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "app.main", "--port", str(port), "--dir", str(directory),
+         "--io-mode", "eventloop", *args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            return process, socket.create_connection(("localhost", port)).makefile("rwb")
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.05)
+
+def call(conn, *args):
+    from app.aof import encode_command
+    conn.write(encode_command([arg.encode() if isinstance(arg, str) else arg for arg in args]))
+    conn.flush()
+    line = conn.readline()
+    if line.startswith(b"$") and line != b"$-1\r\n":
+        return conn.read(int(line[1:]) + 2)[:-2]
+    return line.rstrip(b"\r\n")
+
+def info(conn, section):
+    return dict(line.split(":", 1) for line in call(conn, "INFO", section).decode().splitlines()
+                if ":" in line)
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+def dbsize(conn):
+    # Counts keys past their TTL too, unlike KEYS
+    db = info(conn, "keyspace").get("db0", "keys=0")
+    return int(db.split(",")[0][len("keys="):])
+
+def in_sync(master, replica):
+    return (info(replica, "replication").get("slave_repl_offset")
+            == info(master, "replication")["master_repl_offset"])
+
+def test_replica_drops_keys_when_its_master_expires_or_evicts_them(tmp_path):
+    master_port, replica_port = free_port(), free_port()
+    master, master_conn = start_server(tmp_path / "master", master_port, "--hz", "100",
+                                       "--appendonly", "yes", "--appendfsync", "always",
+                                       "--maxmemory", "20000", "--maxmemory-policy", "allkeys-lru")
+    try:
+        replica, replica_conn = start_server(tmp_path / "replica", replica_port, "--hz", "100",
+                                             "--replicaof", "localhost", str(master_port))
+        try:
+            assert call(master_conn, "SET", "kept", "v") == b"+OK"
+            assert call(master_conn, "SET", "gone", "v", "PX", "300") == b"+OK"
+            wait_for(lambda: dbsize(replica_conn) == 2 and in_sync(master_conn, replica_conn))
+
+            # Past its TTL the key reads as missing on the replica, but it
+            # is the master's DEL that removes it
+            master.send_signal(signal.SIGSTOP)
+            try:
+                time.sleep(0.5)
+                assert call(replica_conn, "GET", "gone") == b"$-1"
+                assert call(replica_conn, "GET", "kept") == b"v"
+                assert dbsize(replica_conn) == 2
+            finally:
+                master.send_signal(signal.SIGCONT)
+            wait_for(lambda: dbsize(replica_conn) == 1 and in_sync(master_conn, replica_conn))
+
+            # Only the master is over maxmemory; the replica evicts nothing
+            # itself and ends up with the keys the master kept
+            for i in range(300):
+                call(master_conn, "SET", f"key:{i}", "x" * 100)
+            assert int(info(master_conn, "stats")["evicted_keys"]) > 0
+            wait_for(lambda: in_sync(master_conn, replica_conn))
+            assert dbsize(replica_conn) == dbsize(master_conn)
+            assert int(info(replica_conn, "stats")["evicted_keys"]) == 0
+        finally:
+            replica.kill()
+            replica.wait()
+
+        # Replaying the AOF doesn't bring any of them back
+        keys = dbsize(master_conn)
+        master.kill()
+        master.wait()
+        master, master_conn = start_server(tmp_path / "master", master_port, "--appendonly", "yes")
+        wait_for(lambda: not call(master_conn, "EXISTS", "gone").startswith(b"-LOADING"))
+        assert dbsize(master_conn) == keys
+        assert call(master_conn, "EXISTS", "gone") == b":0"
+    finally:
+        master.kill()
+        master.wait()
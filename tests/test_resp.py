@@ -0,0 +1,53 @@
+from app.resp import (SHARED_INTEGERS, ProtocolError, RESPParser, encode_array, encode_bulk_string,
+                      encode_integer)
+
+def test_split_command_across_reads():
+    parser = RESPParser()
+    frame = b"*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$5\r\nhello\r\n"
+    for i in range(len(frame) - 1):
+        parser.feed(frame[i:i + 1])
+        assert parser.get_command() is None
+    parser.feed(frame[-1:])
+    assert parser.get_command() == [b"SET", b"foo", b"hello"]
+    assert parser.get_command() is None
+
+def test_pipelined_and_inline_commands():
+    parser = RESPParser()
+    parser.feed(b"PING\r\n\r\n*1\r\n$4\r\nPING\r\n*2\r\n$4\r\nECHO\r\n$2\r\nhi\r\n*0\r\n")
+    assert parser.get_command() == [b"PING"]
+    assert parser.get_command() == [b"PING"]
+    assert parser.get_command() == [b"ECHO", b"hi"]
+    assert parser.get_command() is None
+    assert not parser.has_pending()
+
+def test_large_bulk_string_grows_buffer():
+    parser = RESPParser(size=16)
+    value = b"x" * 100000
+    parser.feed(b"*2\r\n$4\r\nECHO\r\n$100000\r\n")
+    assert parser.get_command() is None
+    view = parser.get_buffer()
+    assert len(view) >= len(value) + 2
+    view[:len(value) + 2] = value + b"\r\n"
+    view.release()
+    parser.advance(len(value) + 2)
+    assert parser.get_command() == [b"ECHO", value]
+
+def test_malformed_frame_raises():
+    parser = RESPParser()
+    parser.feed(b"*1\r\n:12\r\n")
+    try:
+        parser.get_command()
+    except ProtocolError:
+        pass
+    else:
+        assert False, "expected ProtocolError"
+
+def test_reply_encoders():
+    assert encode_integer(7) is SHARED_INTEGERS[7]
+    assert encode_integer(-1) == b":-1\r\n"
+    assert encode_integer(10 ** 6) == b":1000000\r\n"
+    assert encode_bulk_string("é") == b"$2\r\n\xc3\xa9\r\n"
+    assert encode_bulk_string(b"x" * 40) == b"$40\r\n" + b"x" * 40 + b"\r\n"
+    assert encode_array([b"a", 1, None, [b"b"]]) == b"*4\r\n$1\r\na\r\n:1\r\n$-1\r\n*1\r\n$1\r\nb\r\n"
+    keys = [b"key:%d" % i for i in range(1000)]
+    assert encode_array(keys) == b"*1000\r\n" + b"".join(b"$%d\r\n%b\r\n" % (len(k), k) for k in keys)
@@ -0,0 +1,26 @@
+from app.stringmatch import compile_pattern
+
+def matches(pattern, key):
+    return compile_pattern(pattern)(key)
+
+def test_wildcards():
+    assert matches(b"*", b"")
+    assert matches(b"user:*", b"user:1")
+    assert not matches(b"user:*", b"session:1")
+    assert matches(b"h?llo", b"hello")
+    assert not matches(b"h?llo", b"hllo")
+    assert matches(b"a**b", b"a\nb")
+
+def test_classes_and_escapes():
+    assert matches(b"h[ae]llo", b"hallo")
+    assert not matches(b"h[ae]llo", b"hillo")
+    assert matches(b"h[^e]llo", b"hallo")
+    assert not matches(b"h[^e]llo", b"hello")
+    assert matches(b"key[0-9]", b"key7")
+    assert matches(b"key[9-0]", b"key7")
+    assert not matches(b"key[0-9]", b"keyx")
+    assert matches(b"a\\*b", b"a*b")
+    assert not matches(b"a\\*b", b"axb")
+    assert matches(b"[\\]]", b"]")
+    assert matches(b"x[ab", b"xb")
+    assert not matches(b"x[]", b"x")
@@ -0,0 +1,109 @@
+import time
+
+import app.main as main
+from app.main import ClientConnection, handle_command
+from app.tracking import TrackingTable
+
+def new_client(port):
+    client = ClientConnection(None, ("127.0.0.1", port))
+    main.CLIENTS[client.id] = client
+    return client
+
+def close(*clients):
+    for client in clients:
+        main.disable_tracking(client)
+        main.PUBSUB.unsubscribe_all(client)
+        main.CLIENTS.pop(client.id, None)
+
+def invalidation(*keys):
+    return b">2\r\n$10\r\ninvalidate\r\n" + main.encode_array(list(keys))
+
+def test_hello_switches_protocol():
+    client = new_client(1)
+    assert handle_command([b"HELLO", b"4"], client) == b"-NOPROTO unsupported protocol version\r\n"
+    reply = handle_command([b"HELLO", b"3", b"SETNAME", b"app"], client)
+    assert reply.startswith(b"%7\r\n$6\r\nserver\r\n$5\r\nredis\r\n") and b"$5\r\nproto\r\n:3\r\n" in reply
+    assert client.resp == 3 and handle_command([b"CLIENT", b"GETNAME"], client) == b"$3\r\napp\r\n"
+    # RESP3 subscribers get pushes, and may run any command
+    assert handle_command([b"SUBSCRIBE", b"news"], client) == b">3\r\n$9\r\nsubscribe\r\n$4\r\nnews\r\n:1\r\n"
+    assert handle_command([b"GET", b"nothing"], client) == b"$-1\r\n"
+    handle_command([b"PUBLISH", b"news", b"hi"], new_client(2))
+    assert bytes(client.outbuf) == b">3\r\n$7\r\nmessage\r\n$4\r\nnews\r\n$2\r\nhi\r\n"
+    close(client)
+
+def test_default_mode_invalidates_what_was_read():
+    reader, writer = new_client(1), new_client(2)
+    handle_command([b"HELLO", b"3"], reader)
+    assert handle_command([b"CLIENT", b"TRACKING", b"ON"], reader) == b"+OK\r\n"
+    handle_command([b"SET", b"a", b"1"], writer)
+    handle_command([b"SET", b"b", b"1", b"PX", b"5"], writer)
+    assert not reader.outbuf # Not read yet
+    handle_command([b"MGET", b"a", b"b"], reader)
+    handle_command([b"SET", b"a", b"2"], writer)
+    handle_command([b"SET", b"a", b"3"], writer)
+    assert bytes(reader.outbuf) == invalidation(b"a") # Once, until it reads the key again
+    reader.outbuf.clear()
+    time.sleep(0.01)
+    handle_command([b"GET", b"b"], writer) # Expires it
+    assert bytes(reader.outbuf) == invalidation(b"b")
+    reader.outbuf.clear()
+    handle_command([b"FLUSHALL"], writer)
+    assert bytes(reader.outbuf) == b">2\r\n$10\r\ninvalidate\r\n_\r\n"
+    reader.outbuf.clear()
+
+    # NOLOOP: its own writes are not reported back
+    handle_command([b"CLIENT", b"TRACKING", b"ON", b"NOLOOP"], reader)
+    handle_command([b"GET", b"a"], reader)
+    handle_command([b"SET", b"a", b"4"], reader)
+    assert not reader.outbuf
+    handle_command([b"CLIENT", b"TRACKING", b"OFF"], reader)
+    assert main.KEYSPACE.on_change is None
+    close(reader, writer)
+
+def test_broadcast_redirect_and_table_limit():
+    tracker, listener, writer = new_client(1), new_client(2), new_client(3)
+    handle_command([b"SUBSCRIBE", b"__redis__:invalidate"], listener)
+    listener.outbuf.clear()
+    assert handle_command([b"CLIENT", b"TRACKING", b"ON", b"PREFIX", b"user:"], tracker).startswith(b"-ERR PREFIX")
+    reply = handle_command([b"CLIENT", b"TRACKING", b"ON", b"BCAST", b"PREFIX", b"user:", b"PREFIX", b"user:1"], tracker)
+    assert b"overlaps" in reply
+    handle_command([b"CLIENT", b"TRACKING", b"ON", b"BCAST", b"PREFIX", b"user:", b"REDIRECT", b"%d" % listener.id],
+                   tracker)
+    assert handle_command([b"CLIENT", b"GETREDIR"], tracker) == b":%d\r\n" % listener.id
+    handle_command([b"SET", b"user:1", b"x"], writer)
+    handle_command([b"SET", b"order:1", b"x"], writer)
+    assert bytes(listener.outbuf) == (b"*3\r\n$7\r\nmessage\r\n$20\r\n__redis__:invalidate\r\n"
+                                      b"*1\r\n$6\r\nuser:1\r\n")
+    assert not tracker.outbuf
+    handle_command([b"CLIENT", b"TRACKING", b"OFF"], tracker)
+
+    # Past max_keys the oldest keys are invalidated early
+    handle_command([b"HELLO", b"3"], tracker)
+    handle_command([b"CLIENT", b"TRACKING", b"ON", b"OPTIN"], tracker)
+    saved = main.TRACKING.max_keys
+    main.TRACKING.max_keys = 2
+    try:
+        handle_command([b"GET", b"k0"], tracker) # Not cached without CLIENT CACHING yes
+        assert not main.TRACKING.keys
+        for key in (b"k1", b"k2", b"k3"):
+            handle_command([b"CLIENT", b"CACHING", b"YES"], tracker)
+            handle_command([b"GET", key], tracker)
+    finally:
+        main.TRACKING.max_keys = saved
+    assert list(main.TRACKING.keys) == [b"k2", b"k3"] and bytes(tracker.outbuf) == invalidation(b"k1")
+    close(tracker, listener, writer)
+
+def test_prefixes_are_matched_by_first_byte():
+    table = TrackingTable()
+    table.enable(1, [b"user:"])
+    table.enable(2, [b"u", b"order:"])
+    table.enable(3, [b""])
+    assert sorted(table.changed(b"user:1")) == [1, 2, 3]
+    assert sorted(table.changed(b"order:1")) == [2, 3]
+    assert table.changed(b"") == [3] and table.changed(b"x") == [3]
+    table.disable(2, [b"u", b"order:"])
+    table.disable(3, [b""])
+    assert table.changed(b"user:1") == [1] and table.changed(b"order:1") == []
+    assert table.prefix_index == {b"u": [b"user:"]}
+    table.disable(1, [b"user:"])
+    assert not table.prefixes and not table.prefix_index